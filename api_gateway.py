@@ -3,13 +3,13 @@ FastAPI Gateway pour le service PDF Stamp
 Fournit une API REST simple qui communique avec le service gRPC existant
 """
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, Header
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, Header, Request
 from fastapi.responses import Response, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field, HttpUrl
 from typing import Optional, List
+import asyncio
 import grpc
-import tempfile
 import os
 import logging
 from enum import Enum
@@ -26,6 +26,8 @@ logger = logging.getLogger(__name__)
 GRPC_HOST = os.getenv("GRPC_HOST", "localhost")
 GRPC_PORT = os.getenv("GRPC_PORT", "50051")
 MAX_FILE_SIZE = 200 * 1024 * 1024  # 200MB
+# Délai maximal d'un traitement, transmis au service gRPC comme échéance de l'appel
+PROCESSING_TIMEOUT_S = float(os.getenv("PROCESSING_TIMEOUT_S", "300"))
 
 app = FastAPI(
     title="PDF Stamp Service",
@@ -67,6 +69,11 @@ class SourceType(str, Enum):
     OODRIVE = "oodrive"
 
 
+class OutputMode(str, Enum):
+    RASTER = "raster"
+    OVERLAY = "overlay"
+
+
 class GoogleDriveSource(BaseModel):
     """Source Google Drive"""
     file_id: str = Field(..., description="ID du fichier Google Drive")
@@ -88,6 +95,15 @@ class StampRequest(BaseModel):
     document_index: int = Field(1, ge=1, description="Numéro de la pièce")
     prefix: str = Field("", description="Préfixe pour la numérotation (ex: 'DOC')")
     stamp_only_first_page: bool = Field(False, description="Tamponner uniquement la première page")
+    pages: Optional[str] = Field(
+        None,
+        description="Pages à tamponner : numéros, intervalles, first/last, odd/even, pas (ex: '1,5-7,last' ou '1-/3'). "
+                    "Les autres pages sont conservées telles quelles, sans traitement."
+    )
+    output_mode: OutputMode = Field(
+        OutputMode.RASTER,
+        description="raster : pages rastérisées ; overlay : tampon dessiné sur le PDF original (texte préservé, fichier léger)"
+    )
 
     class Config:
         json_schema_extra = {
@@ -107,6 +123,11 @@ class CoordinatesResponse(BaseModel):
     x: float
     y: float
     size: float
+    engine: str = Field("", description="Moteur d'analyse de la page (vector ou raster)")
+    analysis_ms: float = Field(0, description="Coût de l'analyse de la page en millisecondes")
+    color_mode: str = Field("", description="Espace couleur de la page rastérisée (1, L ou RGB)")
+    encode_ms: float = Field(0, description="Durée d'encodage de la page rastérisée en millisecondes")
+    encoded_bytes: int = Field(0, description="Taille de l'image encodée de la page en octets")
 
 
 class StampResponse(BaseModel):
@@ -117,6 +138,30 @@ class StampResponse(BaseModel):
     pages_processed: int
 
 
+class StatusResponse(BaseModel):
+    """Activité du scheduler de pages du service gRPC"""
+    page_workers: int = Field(..., description="Budget de pages traitées simultanément")
+    active_requests: int = Field(..., description="Requêtes en cours de traitement")
+    queued_pages: int = Field(..., description="Pages en attente d'un worker")
+    running_pages: int = Field(..., description="Pages en cours de traitement")
+    peak_queued_pages: int = Field(..., description="Profondeur de file maximale depuis le démarrage")
+    completed_pages: int = Field(..., description="Pages traitées depuis le démarrage")
+    memory_budget_bytes: int = Field(..., description="Budget mémoire partagé par les requêtes")
+    memory_reserved_bytes: int = Field(..., description="Pic mémoire estimé des requêtes admises en cours")
+    memory_peak_reserved_bytes: int = Field(..., description="Réservation maximale depuis le démarrage")
+    admission_waiting: int = Field(..., description="Requêtes en attente de place dans le budget mémoire")
+    admitted_requests: int = Field(..., description="Requêtes admises depuis le démarrage")
+    rejected_requests: int = Field(..., description="Requêtes refusées faute de mémoire depuis le démarrage")
+    worker_pid: int = Field(..., description="Process du service qui a répondu (worker pré-forké)")
+    worker_jobs: int = Field(..., description="Requêtes traitées par ce worker depuis son démarrage")
+    worker_rss_bytes: int = Field(..., description="Mémoire résidente de ce worker")
+    page_limit: int = Field(..., description="Pages exécutées simultanément, ajusté au débit et au bridage CPU")
+    cpu_limit: float = Field(..., description="CPU du worker (quota et affinité du conteneur)")
+    pages_per_second: float = Field(..., description="Débit mesuré sur la dernière période")
+    cpu_throttled_ratio: float = Field(..., description="Part des périodes CFS bridées sur la dernière période")
+    native_threads: int = Field(..., description="Threads par appel OpenCV/BLAS (0 = réglage des bibliothèques)")
+
+
 class HealthResponse(BaseModel):
     """Réponse du health check"""
     status: str
@@ -153,16 +198,56 @@ class GRPCClient:
             self.channel = None
             self.stub = None
 
-    def process_pdf(self, request: pdf_service_pb2.PDFRequest) -> pdf_service_pb2.PDFResponse:
-        """Appelle le service gRPC pour traiter le PDF"""
+    async def process_pdf(self, request: pdf_service_pb2.PDFRequest, http_request: Optional[Request] = None,
+                          timeout: float = PROCESSING_TIMEOUT_S) -> pdf_service_pb2.PDFResponse:
+        """
+        Appelle le service gRPC pour traiter le PDF, sans bloquer la boucle d'événements.
+
+        Le délai est transmis au service (échéance gRPC). Si le client HTTP se déconnecte avant
+        la réponse, l'appel gRPC est annulé : le service retire les pages en attente et arrête
+        les pages en cours.
+        """
         stub = self.connect()
+        call = stub.ProcessPDF.future(request, timeout=timeout)
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
+        call.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(None)))
+        waiters = {finished}
+        if http_request is not None:
+            waiters.add(asyncio.ensure_future(wait_for_disconnect(http_request)))
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+            if not call.done():
+                # Client HTTP parti (ou requête annulée) : plus personne n'attend le résultat
+                call.cancel()
+                logger.info("Client déconnecté - traitement gRPC annulé")
+        if call.cancelled():
+            raise HTTPException(status_code=499, detail="Client déconnecté")
         try:
-            response = stub.ProcessPDF(request, timeout=300)  # 5 minutes timeout
-            return response
+            return call.result()
         except grpc.RpcError as e:
             logger.error(f"Erreur gRPC: {e.code()} - {e.details()}")
             raise
 
+    async def get_status(self) -> pdf_service_pb2.StatusResponse:
+        """Activité du scheduler de pages, sans bloquer la boucle d'événements"""
+        stub = self.connect()
+        call = stub.GetStatus.future(pdf_service_pb2.StatusRequest(), timeout=5)
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
+        call.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(None)))
+        try:
+            await finished
+        finally:
+            if not call.done():
+                call.cancel()
+        return call.result()
+
 
 # Instance globale du client
 grpc_client = GRPCClient()
@@ -173,6 +258,47 @@ def get_grpc_client() -> GRPCClient:
     return grpc_client
 
 
+def processing_timeout(
+    x_request_timeout: Optional[float] = Header(None, gt=0, description="Délai accordé au traitement, en secondes")
+) -> float:
+    """Délai du traitement : celui du client (X-Request-Timeout) s'il est plus court que PROCESSING_TIMEOUT_S"""
+    return min(x_request_timeout or PROCESSING_TIMEOUT_S, PROCESSING_TIMEOUT_S)
+
+
+async def wait_for_disconnect(http_request: Request):
+    """Retourne quand le client HTTP se déconnecte (le corps de la requête est déjà lu)"""
+    while True:
+        message = await http_request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+def processing_error(e: grpc.RpcError) -> HTTPException:
+    """Erreur HTTP correspondant à l'échec d'un traitement gRPC"""
+    if e.code() == grpc.StatusCode.RESOURCE_EXHAUSTED:
+        # Budget mémoire du service occupé : la requête peut être renvoyée plus tard
+        return HTTPException(
+            status_code=503,
+            detail=f"Service de traitement saturé: {e.details()}",
+            headers={"Retry-After": "30"}
+        )
+    if e.code() == grpc.StatusCode.INVALID_ARGUMENT:
+        # Paramètre de la requête rejeté (sélection de pages, mode de sortie) : erreur du client
+        return HTTPException(
+            status_code=400,
+            detail=f"Requête invalide: {e.details()}"
+        )
+    if e.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
+        return HTTPException(
+            status_code=504,
+            detail=f"Délai de traitement dépassé: {e.details()}"
+        )
+    return HTTPException(
+        status_code=500,
+        detail=f"Erreur de traitement: {e.details()}"
+    )
+
+
 # ============== Endpoints ==============
 
 @app.get("/health", response_model=HealthResponse, tags=["System"])
@@ -201,6 +327,41 @@ async def health_check():
     )
 
 
+@app.get("/status", response_model=StatusResponse, tags=["System"])
+async def service_status(client: GRPCClient = Depends(get_grpc_client)):
+    """
+    Charge du service de traitement : requêtes actives et profondeur de la file de pages
+    """
+    try:
+        status = await client.get_status()
+    except grpc.RpcError as e:
+        logger.error(f"Erreur gRPC: {e.code()} - {e.details()}")
+        raise HTTPException(status_code=503, detail=f"Service de traitement indisponible: {e.details()}")
+
+    return StatusResponse(
+        page_workers=status.page_workers,
+        active_requests=status.active_requests,
+        queued_pages=status.queued_pages,
+        running_pages=status.running_pages,
+        peak_queued_pages=status.peak_queued_pages,
+        completed_pages=status.completed_pages,
+        memory_budget_bytes=status.memory_budget_bytes,
+        memory_reserved_bytes=status.memory_reserved_bytes,
+        memory_peak_reserved_bytes=status.memory_peak_reserved_bytes,
+        admission_waiting=status.admission_waiting,
+        admitted_requests=status.admitted_requests,
+        rejected_requests=status.rejected_requests,
+        worker_pid=status.worker_pid,
+        worker_jobs=status.worker_jobs,
+        worker_rss_bytes=status.worker_rss_bytes,
+        page_limit=status.page_limit,
+        cpu_limit=status.cpu_limit,
+        pages_per_second=status.pages_per_second,
+        cpu_throttled_ratio=status.cpu_throttled_ratio,
+        native_threads=status.native_threads
+    )
+
+
 @app.post(
     "/stamp",
     tags=["PDF Processing"],
@@ -212,12 +373,16 @@ async def health_check():
             "description": "PDF tamponné"
         },
         400: {"description": "Requête invalide"},
-        500: {"description": "Erreur de traitement"}
+        500: {"description": "Erreur de traitement"},
+        503: {"description": "Service saturé (budget mémoire), réessayer après Retry-After"},
+        504: {"description": "Délai de traitement dépassé (PROCESSING_TIMEOUT_S ou X-Request-Timeout)"}
     }
 )
 async def stamp_pdf_from_url(
     request: StampRequest,
-    client: GRPCClient = Depends(get_grpc_client)
+    http_request: Request,
+    client: GRPCClient = Depends(get_grpc_client),
+    timeout: float = Depends(processing_timeout)
 ):
     """
     Tamponne un PDF à partir d'une URL ou d'un service cloud.
@@ -249,7 +414,9 @@ async def stamp_pdf_from_url(
         stamp_url=str(request.stamp_url),
         document_index=request.document_index,
         prefix=request.prefix,
-        stampOnlyFirstPage=request.stamp_only_first_page
+        stampOnlyFirstPage=request.stamp_only_first_page,
+        output_mode=request.output_mode.value,
+        pages=request.pages or ""
     )
 
     # Ajout de la source Google Drive si présente
@@ -262,10 +429,18 @@ async def stamp_pdf_from_url(
         grpc_request.ooDriveFile.id = request.oodrive.file_id
         grpc_request.ooDriveFile.accessToken = request.oodrive.access_token
 
+    # Appel gRPC
+    logger.info(f"Traitement PDF - Index: {request.document_index}, Prefix: {request.prefix}")
+    return await _stamped_pdf_response(client, grpc_request, request.prefix, request.document_index,
+                                       http_request, timeout)
+
+
+async def _stamped_pdf_response(client: GRPCClient, grpc_request: pdf_service_pb2.PDFRequest,
+                                prefix: str, document_index: int, http_request: Request,
+                                timeout: float) -> Response:
+    """Appelle le service gRPC et retourne le PDF tamponné avec les coordonnées dans les headers"""
     try:
-        # Appel gRPC
-        logger.info(f"Traitement PDF - Index: {request.document_index}, Prefix: {request.prefix}")
-        response = client.process_pdf(grpc_request)
+        response = await client.process_pdf(grpc_request, http_request, timeout)
 
         # Extraction des coordonnées pour les headers
         coordinates = [
@@ -273,7 +448,12 @@ async def stamp_pdf_from_url(
                 "page_number": coord.page_number,
                 "x": coord.x,
                 "y": coord.y,
-                "size": coord.size
+                "size": coord.size,
+                "engine": coord.engine,
+                "analysis_ms": round(coord.analysis_ms, 1),
+                "color_mode": coord.color_mode,
+                "encode_ms": round(coord.encode_ms, 1),
+                "encoded_bytes": coord.encoded_bytes
             }
             for coord in response.coordinates
         ]
@@ -285,7 +465,7 @@ async def stamp_pdf_from_url(
             content=response.processed_pdf,
             media_type="application/pdf",
             headers={
-                "Content-Disposition": f'attachment; filename="stamped_{request.prefix}_{request.document_index}.pdf"',
+                "Content-Disposition": f'attachment; filename="stamped_{prefix}_{document_index}.pdf"',
                 "X-Stamp-Coordinates": json.dumps(coordinates),
                 "X-Pages-Processed": str(len(coordinates))
             }
@@ -293,10 +473,9 @@ async def stamp_pdf_from_url(
 
     except grpc.RpcError as e:
         logger.error(f"Erreur gRPC: {e.code()} - {e.details()}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"Erreur de traitement: {e.details()}"
-        )
+        raise processing_error(e)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erreur inattendue: {str(e)}")
         raise HTTPException(
@@ -317,16 +496,22 @@ async def stamp_pdf_from_url(
         },
         400: {"description": "Requête invalide"},
         413: {"description": "Fichier trop volumineux"},
-        500: {"description": "Erreur de traitement"}
+        500: {"description": "Erreur de traitement"},
+        503: {"description": "Service saturé (budget mémoire), réessayer après Retry-After"},
+        504: {"description": "Délai de traitement dépassé (PROCESSING_TIMEOUT_S ou X-Request-Timeout)"}
     }
 )
 async def stamp_pdf_upload(
+    http_request: Request,
     pdf_file: UploadFile = File(..., description="Fichier PDF à tamponner"),
     stamp_url: str = Form(..., description="URL de l'image du tampon"),
     document_index: int = Form(1, ge=1, description="Numéro de la pièce"),
     prefix: str = Form("", description="Préfixe pour la numérotation"),
     stamp_only_first_page: bool = Form(False, description="Tamponner uniquement la première page"),
-    client: GRPCClient = Depends(get_grpc_client)
+    pages: str = Form("", description="Pages à tamponner (ex: '1,5-7,last', 'odd', '1-/3')"),
+    output_mode: OutputMode = Form(OutputMode.RASTER, description="raster ou overlay"),
+    client: GRPCClient = Depends(get_grpc_client),
+    timeout: float = Depends(processing_timeout)
 ):
     """
     Tamponne un PDF uploadé directement.
@@ -369,27 +554,19 @@ async def stamp_pdf_upload(
             detail=f"Fichier trop volumineux. Maximum: {MAX_FILE_SIZE // (1024*1024)}MB"
         )
 
-    # Sauvegarde temporaire du PDF pour le traitement
-    # Note: Dans une version future, on pourrait modifier le service gRPC
-    # pour accepter les bytes directement
-    temp_pdf = None
-    try:
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as f:
-            f.write(content)
-            temp_pdf = f.name
-
-        # Pour l'instant, on utilise une URL locale temporaire
-        # TODO: Améliorer en passant les bytes directement au service gRPC
-        # ou en utilisant un stockage temporaire accessible par URL
-
-        raise HTTPException(
-            status_code=501,
-            detail="Upload direct non encore implémenté. Utilisez /stamp avec une URL pour le moment."
-        )
+    # Le contenu est transmis tel quel au service gRPC, sans fichier temporaire
+    grpc_request = pdf_service_pb2.PDFRequest(
+        pdf_data=content,
+        stamp_url=stamp_url,
+        document_index=document_index,
+        prefix=prefix,
+        stampOnlyFirstPage=stamp_only_first_page,
+        output_mode=output_mode.value,
+        pages=pages
+    )
 
-    finally:
-        if temp_pdf and os.path.exists(temp_pdf):
-            os.remove(temp_pdf)
+    logger.info(f"Traitement PDF uploadé ({len(content)} octets) - Index: {document_index}, Prefix: {prefix}")
+    return await _stamped_pdf_response(client, grpc_request, prefix, document_index, http_request, timeout)
 
 
 @app.post(
@@ -400,7 +577,9 @@ async def stamp_pdf_upload(
 )
 async def stamp_pdf_metadata(
     request: StampRequest,
-    client: GRPCClient = Depends(get_grpc_client)
+    http_request: Request,
+    client: GRPCClient = Depends(get_grpc_client),
+    timeout: float = Depends(processing_timeout)
 ):
     """
     Tamponne un PDF et retourne les métadonnées (sans le PDF).
@@ -421,7 +600,9 @@ async def stamp_pdf_metadata(
         stamp_url=str(request.stamp_url),
         document_index=request.document_index,
         prefix=request.prefix,
-        stampOnlyFirstPage=request.stamp_only_first_page
+        stampOnlyFirstPage=request.stamp_only_first_page,
+        output_mode=request.output_mode.value,
+        pages=request.pages or ""
     )
 
     if request.google_drive:
@@ -433,14 +614,19 @@ async def stamp_pdf_metadata(
         grpc_request.ooDriveFile.accessToken = request.oodrive.access_token
 
     try:
-        response = client.process_pdf(grpc_request)
+        response = await client.process_pdf(grpc_request, http_request, timeout)
 
         coordinates = [
             CoordinatesResponse(
                 page_number=coord.page_number,
                 x=coord.x,
                 y=coord.y,
-                size=coord.size
+                size=coord.size,
+                engine=coord.engine,
+                analysis_ms=coord.analysis_ms,
+                color_mode=coord.color_mode,
+                encode_ms=coord.encode_ms,
+                encoded_bytes=coord.encoded_bytes
             )
             for coord in response.coordinates
         ]
@@ -453,10 +639,7 @@ async def stamp_pdf_metadata(
         )
 
     except grpc.RpcError as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Erreur de traitement: {e.details()}"
-        )
+        raise processing_error(e)
 
 
 # ============== Événements de lifecycle ==============
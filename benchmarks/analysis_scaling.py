@@ -0,0 +1,98 @@
+"""
+Passage à l'échelle de l'analyse raster des pages (find_whitest_space) : pool de threads
+contre pool de process alimenté par mémoire partagée (ANALYSIS_PROCESSES), et bandes d'une
+même page analysées en parallèle (ANALYSIS_BANDS, latence d'une requête d'une page).
+
+Les pages sont rendues une fois en niveaux de gris, puis analysées avec 1 à N workers
+(en mode bandes, une page après l'autre avec N bandes par page).
+L'efficacité est l'accélération rapportée au nombre de workers (1.0 = passage à l'échelle
+parfait).
+
+Usage :
+    python benchmarks/analysis_scaling.py --pdf exemple.pdf [--pages 64] [--workers 1 2 4 8]
+"""
+import argparse
+import math
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from server import AnalysisPool, PDFProcessor, detect_cpu_limit  # noqa: E402
+
+
+def render_pages(pdf_path, num_pages, dpi):
+    """Rend num_pages pages (en répétant celles du PDF) en tableaux NumPy indépendants"""
+    processor = PDFProcessor()
+    available = processor.get_page_count(pdf_path)
+    pages = []
+    for i in range(num_pages):
+        gray, pix = processor.render_page(i % available + 1, pdf_path, dpi, grayscale=True)
+        pages.append(gray.copy())
+        del gray, pix
+    processor._release_render_documents(pdf_path)
+    return pages
+
+
+def run_threads(processor, context, pages, workers):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        started = time.perf_counter()
+        list(executor.map(lambda page: processor.find_whitest_space(page, context), pages))
+        return time.perf_counter() - started
+
+
+def run_processes(context, pages, workers):
+    pool = AnalysisPool(workers)
+    try:
+        # Comme dans le serveur : les threads de traitement confient l'analyse au pool
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            started = time.perf_counter()
+            list(executor.map(lambda page: pool.find_whitest_space(page, context), pages))
+            return time.perf_counter() - started
+    finally:
+        pool.shutdown()
+
+
+def run_bands(context, pages, bands):
+    # Comme une requête d'une page : la page dispose de tous les CPU
+    processor = PDFProcessor(stamp_size_max=300, stamp_size_min=200, analysis_bands=bands, cpu_limit=bands)
+    started = time.perf_counter()
+    for page in pages:
+        processor.find_whitest_space(page, context)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Passage à l'échelle de l'analyse des pages")
+    parser.add_argument('--pdf', required=True, help='PDF source (ses pages sont répétées)')
+    parser.add_argument('--pages', type=int, default=64, help='Nombre de pages analysées')
+    parser.add_argument('--workers', type=int, nargs='+', default=None,
+                        help='Nombres de workers mesurés (défaut : puissances de 2 jusqu\'au nombre de CPU)')
+    parser.add_argument('--dpi', type=int, default=200, help='Résolution du rendu')
+    args = parser.parse_args()
+
+    cpu_count = math.ceil(detect_cpu_limit())
+    workers_list = args.workers or sorted({min(2 ** i, cpu_count) for i in range(cpu_count.bit_length() + 1)})
+    processor = PDFProcessor(stamp_size_max=300, stamp_size_min=200)
+    context = processor.default_context(dpi=args.dpi)
+    pages = render_pages(args.pdf, args.pages, args.dpi)
+
+    print(f"{len(pages)} pages à {args.dpi} DPI, {cpu_count} CPU disponibles")
+    print(f"{'mode':>8} {'workers':>8} {'pages/s':>9} {'accél.':>7} {'efficacité':>11}")
+    for mode in ('thread', 'process', 'bandes'):
+        baseline = None
+        for workers in workers_list:
+            if mode == 'thread':
+                elapsed = run_threads(processor, context, pages, workers)
+            elif mode == 'process':
+                elapsed = run_processes(context, pages, workers)
+            else:
+                elapsed = run_bands(context, pages, workers)
+            baseline = baseline or elapsed
+            speedup = baseline / elapsed
+            print(f"{mode:>8} {workers:>8} {len(pages) / elapsed:>9.1f} {speedup:>7.2f} {speedup / workers:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
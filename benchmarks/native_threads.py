@@ -0,0 +1,82 @@
+"""
+Répartition des threads internes d'OpenCV/BLAS entre les pages (NATIVE_THREADS) sur les
+deux formes de requête : une page seule (latence) et un lot de pages (débit).
+
+Chaque politique est mesurée sur le même document, analyse raster forcée (masques OpenCV) :
+  - auto : CPU répartis entre les pages en cours (NativeThreadPolicy)
+  - off  : réglage par défaut d'OpenCV (un thread par CPU dans chaque appel)
+  - N    : N threads par appel OpenCV quelle que soit la charge
+
+Usage :
+    python benchmarks/native_threads.py --pdf scan.pdf [--pages 1 64] [--policies auto off 1 4]
+"""
+import argparse
+import math
+import os
+import statistics
+import sys
+import time
+
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from render_backends import build_document  # noqa: E402
+from server import PDFProcessor, detect_cpu_limit  # noqa: E402
+
+
+def run_policy(policy, pdf_bytes, stamp_bytes, repeat):
+    """Traite le document repeat fois ; retourne les durées en secondes"""
+    if policy == 'off':
+        cv2.setNumThreads(-1)
+    processor = PDFProcessor(stamp_size_max=300, stamp_size_min=200, analysis_engine='raster',
+                             native_threads=None if policy == 'off' else policy)
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        output, _ = processor.process_document(pdf_bytes, stamp_bytes)
+        durations.append(time.perf_counter() - started)
+        output.close()
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Threads OpenCV/BLAS contre parallélisme des pages")
+    parser.add_argument('--pdf', required=True, help='PDF source, de préférence scanné (ses pages sont répétées)')
+    parser.add_argument('--stamp', default=None, help='Image du tampon (défaut : carré rouge 300x300)')
+    parser.add_argument('--pages', type=int, nargs='+', default=[1, 64], help='Tailles de documents mesurées')
+    parser.add_argument('--policies', nargs='+', default=None,
+                        help="Politiques mesurées (défaut : auto off 1 et le nombre de CPU)")
+    parser.add_argument('--repeat', type=int, default=5, help='Mesures par document de moins de 10 pages')
+    args = parser.parse_args()
+
+    cpu_count = math.ceil(detect_cpu_limit())
+    policies = args.policies or list(dict.fromkeys(['auto', 'off', '1', str(cpu_count)]))
+    if args.stamp:
+        with open(args.stamp, 'rb') as f:
+            stamp_bytes = f.read()
+    else:
+        import io
+        from PIL import Image
+        buffer = io.BytesIO()
+        Image.new("RGBA", (300, 300), (200, 30, 30, 255)).save(buffer, format="PNG")
+        stamp_bytes = buffer.getvalue()
+
+    print(f"{cpu_count} CPU disponibles, OpenCV {cv2.__version__}")
+    print(f"{'pages':>6} {'politique':>10} {'médiane (s)':>12} {'pages/s':>9}")
+    for num_pages in args.pages:
+        path = build_document(args.pdf, num_pages)
+        try:
+            with open(path, 'rb') as f:
+                pdf_bytes = f.read()
+        finally:
+            os.unlink(path)
+        repeat = args.repeat if num_pages < 10 else 1
+        for policy in policies:
+            # Première exécution hors mesure : initialisation des bibliothèques et des caches
+            run_policy(policy, pdf_bytes, stamp_bytes, 1)
+            elapsed = statistics.median(run_policy(policy, pdf_bytes, stamp_bytes, repeat))
+            print(f"{num_pages:>6} {policy:>10} {elapsed:>12.3f} {num_pages / elapsed:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
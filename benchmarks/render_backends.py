@@ -0,0 +1,78 @@
+"""
+Benchmark des backends de rendu de pages : PyMuPDF en mémoire ('fitz') contre pdftoppm
+via pdf2image ('pdf2image').
+
+Un PDF source est dupliqué pour obtenir des documents de 1, 50 et 500 pages, puis chaque
+page est rendue en niveaux de gris comme pour l'analyse du placement.
+
+Usage :
+    python benchmarks/render_backends.py --pdf exemple.pdf [--pages 1 50 500] [--dpi 200]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import fitz
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from server import PDFProcessor  # noqa: E402
+
+
+def build_document(source_path, num_pages):
+    """Construit un PDF de num_pages pages en répétant les pages du PDF source"""
+    src = fitz.open(source_path)
+    doc = fitz.open()
+    while doc.page_count < num_pages:
+        last = min(src.page_count, num_pages - doc.page_count) - 1
+        doc.insert_pdf(src, from_page=0, to_page=last)
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp_file:
+        path = tmp_file.name
+    doc.save(path, garbage=1, deflate=True)
+    doc.close()
+    src.close()
+    return path
+
+
+def run_backend(backend, pdf_path, dpi):
+    """Compte les pages puis rend chaque page ; retourne la durée totale en secondes"""
+    processor = PDFProcessor(render_backend=backend)
+    started = time.perf_counter()
+    if backend == 'pdf2image':
+        from pdf2image import pdfinfo_from_path
+        num_pages = pdfinfo_from_path(pdf_path)['Pages']
+    else:
+        num_pages = processor.get_page_count(pdf_path)
+    for page_num in range(1, num_pages + 1):
+        gray, pix = processor.render_page(page_num, pdf_path, dpi, grayscale=True)
+        del gray, pix
+    processor._release_render_documents(pdf_path)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark des backends de rendu')
+    parser.add_argument('--pdf', required=True, help='PDF source (ses pages sont répétées)')
+    parser.add_argument('--pages', type=int, nargs='+', default=[1, 50, 500], help='Tailles de documents')
+    parser.add_argument('--dpi', type=int, default=200, help='Résolution du rendu')
+    parser.add_argument('--backends', nargs='+', default=['fitz', 'pdf2image'], help='Backends à mesurer')
+    args = parser.parse_args()
+
+    print(f"{'pages':>6} {'backend':>10} {'total (s)':>10} {'ms/page':>9}")
+    for num_pages in args.pages:
+        pdf_path = build_document(args.pdf, num_pages)
+        try:
+            for backend in args.backends:
+                try:
+                    elapsed = run_backend(backend, pdf_path, args.dpi)
+                except Exception as e:
+                    print(f"{num_pages:>6} {backend:>10}  indisponible ({e})")
+                    continue
+                print(f"{num_pages:>6} {backend:>10} {elapsed:>10.2f} {elapsed / num_pages * 1000:>9.1f}")
+        finally:
+            os.remove(pdf_path)
+
+
+if __name__ == '__main__':
+    main()
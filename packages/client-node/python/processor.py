@@ -10,6 +10,9 @@ import argparse
 import tempfile
 import os
 import logging
+import hashlib
+import threading
+from collections import OrderedDict
 from pathlib import Path
 
 # Imports pour le traitement PDF
@@ -35,6 +38,169 @@ logger = logging.getLogger(__name__)
 Image.MAX_IMAGE_PIXELS = 933120000
 
 
+@lru_cache(maxsize=64)
+def load_label_font(font_path, font_size):
+    """Police du libellé, chargée une seule fois par (fichier, taille)"""
+    if font_path and os.path.exists(font_path):
+        try:
+            return ImageFont.truetype(font_path, font_size)
+        except Exception:
+            pass
+    try:
+        return ImageFont.load_default()
+    except Exception:
+        return None
+
+
+def parse_page_selection(spec, num_pages):
+    """
+    Pages désignées par une sélection textuelle, numérotées à partir de 1.
+
+    Éléments séparés par des virgules :
+    - un numéro ('3'), 'first' ou 'last'
+    - un intervalle 'a-b', ouvert 'a-' (jusqu'à la fin) ou '-b' (depuis le début) ;
+      les bornes acceptent 'first' et 'last'
+    - 'odd' ou 'even'
+    - un pas '/n' après un intervalle : une page sur n ('1-/5', '2-20/2')
+
+    Exemple : '1,5-7,last' (première page de chaque annexe d'un dossier fusionné).
+
+    Args:
+        spec (str): Sélection
+        num_pages (int): Nombre de pages du document
+
+    Returns:
+        list: Numéros de page triés, sans doublon
+
+    Raises:
+        ValueError: Sélection invalide ou ne désignant aucune page
+    """
+    def bound(token, default):
+        token = token.strip()
+        if not token:
+            return default
+        if token == 'first':
+            return 1
+        if token == 'last':
+            return num_pages
+        if not token.isdigit() or int(token) < 1:
+            raise ValueError(f"Sélection de pages invalide : '{spec}'")
+        return int(token)
+
+    pages = set()
+    for item in spec.lower().split(','):
+        item = item.strip()
+        if not item:
+            continue
+        item = {'odd': '1-/2', 'even': '2-/2'}.get(item, item)
+        item, has_step, step = item.partition('/')
+        if has_step and (not step.strip().isdigit() or int(step) < 1):
+            raise ValueError(f"Pas de sélection invalide : '{spec}'")
+        if '-' in item:
+            start_token, _, end_token = item.partition('-')
+            start = bound(start_token, 1)
+            end = min(bound(end_token, num_pages), num_pages)
+            if start > end and start <= num_pages:
+                raise ValueError(f"Intervalle de pages inversé : '{item}'")
+        elif has_step:
+            raise ValueError(f"Un pas s'applique à un intervalle : '{spec}'")
+        else:
+            start = end = bound(item, None)
+            if start > num_pages:
+                raise ValueError(f"Page {start} hors du document ({num_pages} pages)")
+        pages.update(range(start, end + 1, int(step) if has_step else 1))
+
+    if not pages:
+        raise ValueError(f"Aucune page sélectionnée par '{spec}'")
+    return sorted(pages)
+
+
+class StampCache:
+    """
+    Cache LRU des tampons redimensionnés, partagé entre les requêtes et les threads.
+
+    Les entrées sont indexées par l'empreinte SHA-256 du contenu du tampon (et non par
+    son chemin, qui change à chaque requête), la taille cible et le mode de rééchantillonnage.
+    L'éviction se fait sur le volume total des images en mémoire.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_digests=128):
+        """
+        Args:
+            max_bytes (int): Volume maximal des images en cache (octets)
+            max_digests (int): Nombre maximal d'empreintes de fichiers mémorisées
+        """
+        self.max_bytes = max_bytes
+        self.max_digests = max_digests
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._digests = OrderedDict()
+        self._lock = threading.Lock()
+
+    def content_digest(self, stamp_path):
+        """Empreinte SHA-256 du fichier, recalculée seulement si le fichier change"""
+        stat = os.stat(stamp_path)
+        file_key = (stamp_path, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            digest = self._digests.get(file_key)
+            if digest is not None:
+                self._digests.move_to_end(file_key)
+                return digest
+        with open(stamp_path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        with self._lock:
+            self._digests[file_key] = digest
+            while len(self._digests) > self.max_digests:
+                self._digests.popitem(last=False)
+        return digest
+
+    def get_or_create(self, key, factory):
+        """
+        Retourne l'image associée à key, en la construisant avec factory() si absente.
+        La construction se fait hors verrou ; l'image retournée ne doit pas être modifiée.
+        """
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return image
+            self.misses += 1
+
+        image = factory()
+        image_bytes = image.width * image.height * len(image.getbands())
+
+        with self._lock:
+            if key in self._entries:
+                # Construite entre-temps par un autre thread
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self._entries[key] = image
+            self._bytes += image_bytes
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.width * evicted.height * len(evicted.getbands())
+        return image
+
+    def get_stamp(self, stamp_path, size, resample=Image.Resampling.LANCZOS):
+        """Tampon RGBA redimensionné à size x size"""
+        key = ("stamp", self.content_digest(stamp_path), size, int(resample))
+        return self.get_or_create(key, lambda: self._resize_stamp(stamp_path, size, resample))
+
+    @staticmethod
+    def _resize_stamp(stamp_path, size, resample):
+        stamp_img = Image.open(stamp_path).convert("RGBA")
+        return stamp_img.resize((size, size), resample)
+
+    def stats(self):
+        """Compteurs du cache"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self._entries), "bytes": self._bytes}
+
+
 class PDFProcessor:
     """Processeur PDF autonome pour le tamponnage intelligent"""
 
@@ -44,7 +210,7 @@ class PDFProcessor:
         self.low_dpi = low_dpi
         self.margin = 10
         self.max_workers = min(8, multiprocessing.cpu_count())
-        self._stamp_cache = {}
+        self._stamp_cache = StampCache()
         self._kernel_cache = {}
 
     @lru_cache(maxsize=32)
@@ -175,6 +341,44 @@ class PDFProcessor:
         # Dernier recours
         return {"x": float(width - stamp_size_min - 40), "y": 20.0, "size": float(stamp_size_min + 20), "stamp_size": float(stamp_size_min)}
 
+    def _get_stamp_tile(self, stamp_path, stamp_size, text_line1, text_line2, fonts_dir):
+        """Tuile RGBA du tampon avec son libellé, centrée sur le tampon et mise en cache"""
+        key = ("tile", self._stamp_cache.content_digest(stamp_path), stamp_size, text_line1, text_line2, fonts_dir)
+
+        def render_tile():
+            stamp_img = self._stamp_cache.get_stamp(stamp_path, stamp_size)
+            font_path = os.path.join(fonts_dir, "OpenSans-regular.ttf") if fonts_dir else None
+            font = load_label_font(font_path, int(stamp_size * 0.12))
+            if font is None:
+                return stamp_img
+
+            try:
+                bbox1 = font.getbbox(text_line1)
+                bbox2 = font.getbbox(text_line2)
+                text_width1, text_height1 = bbox1[2] - bbox1[0], bbox1[3] - bbox1[1]
+                text_width2 = bbox2[2] - bbox2[0]
+                text_bottom2 = bbox2[3]
+            except AttributeError:
+                text_width1, text_height1 = font.getsize(text_line1)
+                text_width2, text_bottom2 = font.getsize(text_line2)
+
+            center = stamp_size // 2
+            line1 = (center - text_width1 / 2, center - text_height1 - 10)
+            line2 = (center - text_width2 / 2, center + 10)
+
+            # Débordement éventuel du libellé hors du carré du tampon
+            pad_x = max(0, int(np.ceil((max(text_width1, text_width2) - stamp_size) / 2))) + 2
+            pad_y = max(0, int(np.ceil(-line1[1])), int(np.ceil(line2[1] + text_bottom2 - stamp_size))) + 2
+
+            tile = Image.new("RGBA", (stamp_size + 2 * pad_x, stamp_size + 2 * pad_y), (0, 0, 0, 0))
+            tile.alpha_composite(stamp_img, (pad_x, pad_y))
+            draw = ImageDraw.Draw(tile)
+            draw.text((line1[0] + pad_x, line1[1] + pad_y), text_line1, fill="black", font=font)
+            draw.text((line2[0] + pad_x, line2[1] + pad_y), text_line2, fill="black", font=font)
+            return tile
+
+        return self._stamp_cache.get_or_create(key, render_tile)
+
     def _process_single_page(self, args):
         """Traite une seule page"""
         page_num, pdf_path, stamp_path, index, prefix, fonts_dir = args
@@ -193,53 +397,14 @@ class PDFProcessor:
                 zone_size = int(coords.get("size", stamp_size))
                 margin = (zone_size - stamp_size) // 2
 
-                # Charger et redimensionner le tampon
-                cache_key = (stamp_path, stamp_size)
-                if cache_key not in self._stamp_cache:
-                    stamp_img = Image.open(stamp_path).convert("RGBA")
-                    self._stamp_cache[cache_key] = stamp_img.resize((stamp_size, stamp_size), Image.Resampling.LANCZOS)
-
-                stamp_img = self._stamp_cache[cache_key].copy()
-                page_img.paste(stamp_img, (x + margin, y + margin), stamp_img)
-
-                # Ajouter le texte
-                draw = ImageDraw.Draw(page_img)
-                font_size = int(stamp_size * 0.12)
-
-                font = None
-                if fonts_dir:
-                    font_path = os.path.join(fonts_dir, "OpenSans-regular.ttf")
-                    if os.path.exists(font_path):
-                        try:
-                            font = ImageFont.truetype(font_path, font_size)
-                        except Exception:
-                            pass
-
-                if font is None:
-                    try:
-                        font = ImageFont.load_default()
-                    except Exception:
-                        font = None
-
-                if font:
-                    text_line1 = "Pièce n°"
-                    text_line2 = f"{prefix}-{index}" if prefix else str(index)
-
-                    center_x = x + margin + stamp_size // 2
-                    center_y = y + margin + stamp_size // 2
-
-                    try:
-                        bbox1 = draw.textbbox((0, 0), text_line1, font=font)
-                        text_width1 = bbox1[2] - bbox1[0]
-                        text_height1 = bbox1[3] - bbox1[1]
-                        bbox2 = draw.textbbox((0, 0), text_line2, font=font)
-                        text_width2 = bbox2[2] - bbox2[0]
-                    except AttributeError:
-                        text_width1, text_height1 = font.getsize(text_line1)
-                        text_width2, _ = font.getsize(text_line2)
-
-                    draw.text((center_x - text_width1/2, center_y - text_height1 - 10), text_line1, fill="black", font=font)
-                    draw.text((center_x - text_width2/2, center_y + 10), text_line2, fill="black", font=font)
+                text_line1 = "Pièce n°"
+                text_line2 = f"{prefix}-{index}" if prefix else str(index)
+
+                # Tampon + libellé pré-rendus une fois par (tampon, taille, libellé) : un seul paste par page
+                tile = self._get_stamp_tile(stamp_path, stamp_size, text_line1, text_line2, fonts_dir)
+                offset_x = (tile.width - stamp_size) // 2
+                offset_y = (tile.height - stamp_size) // 2
+                page_img.paste(tile, (x + margin - offset_x, y + margin - offset_y), tile)
 
             # Sauvegarder en PNG
             temp_img = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
@@ -252,54 +417,63 @@ class PDFProcessor:
             logger.error(f"Erreur traitement page {page_num}: {e}")
             raise
 
-    def process_document(self, pdf_path, stamp_path, index=1, prefix="", stamp_only_first_page=False, fonts_dir=None):
-        """Traite le document PDF"""
+    def process_document(self, pdf_path, stamp_path, index=1, prefix="", stamp_only_first_page=False, fonts_dir=None,
+                         pages=None):
+        """
+        Traite le document PDF
+
+        Seules les pages sélectionnées (pages, ou la première avec stamp_only_first_page) sont
+        rendues et tamponnées ; les autres sont conservées telles quelles dans le PDF original.
+        """
         try:
             info = pdfinfo_from_path(pdf_path)
             num_pages = info['Pages']
 
-            pages_to_process = 1 if stamp_only_first_page else num_pages
+            if pages:
+                selection = parse_page_selection(pages, num_pages)
+            elif stamp_only_first_page:
+                selection = [1]
+            else:
+                selection = None
+            pages_to_process = selection or list(range(1, num_pages + 1))
 
             # Adaptation du DPI selon la taille
-            if num_pages > 100:
+            if len(pages_to_process) > 100:
                 self.low_dpi = 150
-            elif num_pages > 20:
+            elif len(pages_to_process) > 20:
                 self.low_dpi = 180
 
-            page_args = [(i+1, pdf_path, stamp_path, index, prefix, fonts_dir) for i in range(pages_to_process)]
+            page_args = [(page_num, pdf_path, stamp_path, index, prefix, fonts_dir) for page_num in pages_to_process]
 
             # Traitement parallèle
-            workers = min(self.max_workers, pages_to_process)
+            workers = min(self.max_workers, len(page_args))
             with ThreadPoolExecutor(max_workers=workers) as executor:
                 results = list(executor.map(self._process_single_page, page_args))
 
             results.sort(key=lambda x: x[0])
             stamped_image_paths = [r[1] for r in results]
-            coordinates = [r[2] for r in results]
+            coordinates = [dict(r[2] or {"x": -1, "y": -1, "size": 0}, page_number=r[0]) for r in results]
 
             # Créer le PDF final
             with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp_file:
                 output_path = tmp_file.name
 
-            if stamp_only_first_page and num_pages > 1:
-                # Fusionner première page tamponnée avec le reste
+            if selection is not None and len(selection) < num_pages:
+                # Remplacer les pages tamponnées dans le PDF original
                 with open(output_path, "wb") as f:
                     f.write(img2pdf.convert(stamped_image_paths))
 
-                # Charger et fusionner
                 stamped_pdf = fitz.open(output_path)
-                original_pdf = fitz.open(pdf_path)
-
-                final_pdf = fitz.open()
-                final_pdf.insert_pdf(stamped_pdf, from_page=0, to_page=0)
-                if num_pages > 1:
-                    final_pdf.insert_pdf(original_pdf, from_page=1, to_page=num_pages-1)
+                final_pdf = fitz.open(pdf_path)
+                for stamped_index, page_num in enumerate(selection):
+                    final_pdf.insert_pdf(stamped_pdf, from_page=stamped_index, to_page=stamped_index,
+                                         start_at=page_num - 1)
+                    final_pdf.delete_page(page_num)
 
                 final_output = tempfile.NamedTemporaryFile(suffix='.pdf', delete=False).name
-                final_pdf.save(final_output)
+                final_pdf.save(final_output, garbage=1)
 
                 stamped_pdf.close()
-                original_pdf.close()
                 final_pdf.close()
                 os.remove(output_path)
                 output_path = final_output
@@ -327,6 +501,7 @@ def main():
     parser.add_argument('--index', type=int, default=1, help='Numéro de la pièce')
     parser.add_argument('--prefix', default='', help='Préfixe de numérotation')
     parser.add_argument('--first-page-only', action='store_true', help='Tamponner uniquement la première page')
+    parser.add_argument('--pages', help="Pages à tamponner, ex: '1,5-7,last', 'odd', '1-/3' (prioritaire sur --first-page-only)")
     parser.add_argument('--fonts-dir', help='Répertoire des polices')
     parser.add_argument('--json', action='store_true', help='Sortie JSON')
 
@@ -349,7 +524,8 @@ def main():
             args.index,
             args.prefix,
             args.first_page_only,
-            args.fonts_dir
+            args.fonts_dir,
+            args.pages
         )
 
         # Copier vers la destination finale
@@ -362,12 +538,12 @@ def main():
             "output": args.output,
             "coordinates": [
                 {
-                    "pageNumber": i + 1,
-                    "x": coord["x"] if coord else -1,
-                    "y": coord["y"] if coord else -1,
-                    "size": coord.get("stamp_size", coord.get("size", 0)) if coord else 0
+                    "pageNumber": coord["page_number"],
+                    "x": coord["x"],
+                    "y": coord["y"],
+                    "size": coord.get("stamp_size", coord.get("size", 0))
                 }
-                for i, coord in enumerate(coordinates)
+                for coord in coordinates
             ],
             "pagesProcessed": len(coordinates)
         }
@@ -18,6 +18,12 @@ export interface StampOptions {
   prefix?: string;
   /** Tamponner uniquement la première page */
   stampOnlyFirstPage?: boolean;
+  /**
+   * Pages à tamponner : numéros, intervalles, first/last, odd/even, pas
+   * (ex: '1,5-7,last', 'odd', '1-/3'). Prioritaire sur stampOnlyFirstPage ;
+   * les autres pages sont conservées sans traitement.
+   */
+  pages?: string;
 }
 
 export interface StampCoordinates {
@@ -219,6 +225,10 @@ export class Stampwise {
       args.push('--first-page-only');
     }
 
+    if (options.pages) {
+      args.push('--pages', options.pages);
+    }
+
     if (this.fontsDir) {
       args.push('--fonts-dir', this.fontsDir);
     }
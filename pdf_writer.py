@@ -0,0 +1,506 @@
+"""
+Écriture incrémentale d'un PDF d'images pleine page.
+
+Les pages sont ajoutées une à une dans le fichier de sortie (image XObject, flux de contenu,
+objet page) et leurs octets libérés aussitôt ; seuls l'arbre des pages, le catalogue et la
+table xref sont écrits à la fermeture. La mémoire et le disque temporaire ne dépendent donc
+que des pages en cours, pas de la longueur du document.
+
+Pour les documents dont seule une page est tamponnée, write_incremental_update ajoute au PDF
+original une section de mise à jour incrémentale au lieu de le réécrire.
+
+Le module fournit aussi les codecs des pages rastérisées : choix de l'espace couleur
+(1 bit, niveaux de gris ou RGB) d'après le contenu, puis Flate, JPEG ou CCITT G4.
+"""
+import io
+import os
+import re
+import shutil
+import struct
+import zlib
+
+import cv2
+import numpy as np
+from PIL import Image
+
+RASTER_CODECS = ('flate', 'jpeg')
+
+# Tolérance de détection : écart maximal entre canaux d'un pixel « gris », et part
+# maximale de pixels colorés / de demi-teintes pour rester en niveaux de gris / 1 bit
+GRAY_CHANNEL_TOLERANCE = 12
+MAX_COLOR_PIXELS_RATIO = 0.0001
+MAX_MIDTONE_PIXELS_RATIO = 0.005
+
+
+class EncodedImage:
+    """Image prête à être écrite comme XObject PDF (flux déjà compressé)"""
+
+    def __init__(self, width, height, colorspace, bits_per_component, filter_name, data, decode_parms=None):
+        """
+        Args:
+            width (int): Largeur en pixels
+            height (int): Hauteur en pixels
+            colorspace (str): Espace couleur PDF ('DeviceRGB', 'DeviceGray')
+            bits_per_component (int): Bits par composante
+            filter_name (str): Filtre PDF du flux ('FlateDecode', 'DCTDecode', 'CCITTFaxDecode')
+            data (bytes): Flux compressé
+            decode_parms (dict): Paramètres de décodage optionnels
+        """
+        self.width = width
+        self.height = height
+        self.colorspace = colorspace
+        self.bits_per_component = bits_per_component
+        self.filter_name = filter_name
+        self.data = data
+        self.decode_parms = decode_parms
+
+
+def encode_png(image, compress_level=9):
+    """
+    Encode une image PIL en PNG puis reprend ses données IDAT telles quelles comme flux
+    FlateDecode avec prédicteur PNG : même compression que le PNG, sans décodage.
+
+    Args:
+        image (PIL.Image): Image en mode 'RGB', 'L' ou '1'
+        compress_level (int): Niveau zlib du PNG
+
+    Returns:
+        EncodedImage: Image prête pour IncrementalPDFWriter.add_page
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', compress_level=compress_level)
+    png = buffer.getvalue()
+
+    pos = 8  # Signature PNG
+    idat = []
+    width = height = bit_depth = color_type = None
+    while pos < len(png):
+        length, chunk_type = struct.unpack('>I4s', png[pos:pos + 8])
+        chunk = png[pos + 8:pos + 8 + length]
+        if chunk_type == b'IHDR':
+            width, height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', chunk)
+            if interlace:
+                raise ValueError("PNG entrelacé non supporté")
+        elif chunk_type == b'IDAT':
+            idat.append(chunk)
+        elif chunk_type == b'IEND':
+            break
+        pos += 12 + length
+
+    if color_type == 2:
+        colorspace, colors = 'DeviceRGB', 3
+    elif color_type == 0:
+        colorspace, colors = 'DeviceGray', 1
+    else:
+        raise ValueError(f"Type de couleur PNG non supporté : {color_type}")
+
+    decode_parms = {"Predictor": 15, "Colors": colors, "BitsPerComponent": bit_depth, "Columns": width}
+    return EncodedImage(width, height, colorspace, bit_depth, 'FlateDecode', b''.join(idat), decode_parms)
+
+
+def detect_color_mode(image):
+    """
+    Espace couleur suffisant pour une page rendue.
+
+    Args:
+        image (PIL.Image): Page en RGB
+
+    Returns:
+        str: '1' (noir et blanc), 'L' (niveaux de gris) ou 'RGB'
+    """
+    array = np.asarray(image)
+    if array.ndim == 3:
+        red, green, blue = cv2.split(array)
+        chroma = cv2.max(cv2.absdiff(red, green), cv2.absdiff(green, blue))
+        _, colored = cv2.threshold(chroma, GRAY_CHANNEL_TOLERANCE, 1, cv2.THRESH_BINARY)
+        if cv2.countNonZero(colored) > MAX_COLOR_PIXELS_RATIO * chroma.size:
+            return 'RGB'
+        gray = cv2.cvtColor(array, cv2.COLOR_RGB2GRAY)
+    else:
+        gray = array
+
+    # Page bitonale (scan binarisé) : presque aucune demi-teinte
+    midtones = cv2.inRange(gray, 48, 207)
+    if cv2.countNonZero(midtones) <= MAX_MIDTONE_PIXELS_RATIO * gray.size:
+        return '1'
+    return 'L'
+
+
+def encode_jpeg(image, quality=85):
+    """Encode une image 'RGB' ou 'L' en flux DCTDecode"""
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    colorspace = 'DeviceGray' if image.mode == 'L' else 'DeviceRGB'
+    return EncodedImage(image.width, image.height, colorspace, 8, 'DCTDecode', buffer.getvalue())
+
+
+def encode_ccitt_g4(image):
+    """
+    Encode une image 1 bit en CCITT Groupe 4 via libtiff.
+
+    Returns:
+        EncodedImage: Flux CCITTFaxDecode, ou None si libtiff n'a pas produit une bande unique
+    """
+    buffer = io.BytesIO()
+    try:
+        image.save(buffer, format='TIFF', compression='group4', strip_size=2 ** 30)
+    except Exception:
+        return None
+    tiff = Image.open(io.BytesIO(buffer.getvalue()))
+    offsets = tiff.tag_v2.get(273)
+    counts = tiff.tag_v2.get(279)
+    if not offsets or len(offsets) != 1:
+        return None
+    data = buffer.getvalue()[offsets[0]:offsets[0] + counts[0]]
+    decode_parms = {"K": -1, "Columns": image.width, "Rows": image.height, "BlackIs1": "true"}
+    return EncodedImage(image.width, image.height, 'DeviceGray', 1, 'CCITTFaxDecode', data, decode_parms)
+
+
+def encode_image(image, codec='flate', color_mode=None, flate_level=6, jpeg_quality=85):
+    """
+    Encode une page rendue pour IncrementalPDFWriter.
+
+    Args:
+        image (PIL.Image): Page en RGB
+        codec (str): 'flate' (sans perte) ou 'jpeg' pour les pages en niveaux de gris / couleur
+        color_mode (str): '1', 'L' ou 'RGB' ; None = détection d'après le contenu
+        flate_level (int): Niveau zlib (6 : ~4x plus rapide que 9 pour quelques % de plus)
+        jpeg_quality (int): Qualité JPEG
+
+    Returns:
+        EncodedImage: Image encodée
+    """
+    color_mode = color_mode or detect_color_mode(image)
+    if color_mode == '1':
+        bitonal = image.convert('L').convert('1', dither=Image.Dither.NONE)
+        return encode_ccitt_g4(bitonal) or encode_png(bitonal, compress_level=flate_level)
+
+    image = image.convert(color_mode)
+    if codec == 'jpeg':
+        return encode_jpeg(image, jpeg_quality)
+    return encode_png(image, compress_level=flate_level)
+
+
+def encode_rgba(image, flate_level=6):
+    """
+    Encode une image RGBA (tuile du tampon) en image RGB et masque alpha (SMask).
+
+    Returns:
+        tuple: (EncodedImage RGB, EncodedImage masque en niveaux de gris)
+    """
+    return (encode_png(image.convert('RGB'), compress_level=flate_level),
+            encode_png(image.getchannel('A'), compress_level=flate_level))
+
+
+def _pdf_number(value):
+    """Nombre PDF compact (pas de notation scientifique)"""
+    if float(value).is_integer():
+        return str(int(value))
+    return f"{value:.4f}".rstrip('0').rstrip('.')
+
+
+def _pdf_dict(entries):
+    parts = []
+    for key, value in entries.items():
+        if isinstance(value, dict):
+            value = _pdf_dict(value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = _pdf_number(value)
+        parts.append(f"/{key} {value}")
+    return "<< " + " ".join(parts) + " >>"
+
+
+class IncrementalPDFWriter:
+    """
+    Écrit un PDF page par page dans un fichier.
+
+    La sortie est un chemin de fichier ou un fichier binaire déjà ouvert (BytesIO,
+    SpooledTemporaryFile...), laissé ouvert à la fermeture du writer.
+
+    Usage :
+        with IncrementalPDFWriter(path) as writer:
+            writer.add_page(encoded_image, (largeur_pt, hauteur_pt))
+
+    Les images superposées (tampon) sont écrites une seule fois par clé et partagées
+    entre toutes les pages qui les affichent.
+    """
+
+    CATALOG = 1
+    PAGES = 2
+
+    def __init__(self, output, flate_level=6):
+        self.flate_level = flate_level
+        self.page_count = 0
+        self._shared_images = {}
+        self._owns_file = isinstance(output, (str, os.PathLike))
+        self._file = open(output, 'wb') if self._owns_file else output
+        self._start = self._file.tell()
+        self._offsets = {}
+        self._page_refs = []
+        self._next_object = 3  # 1 et 2 réservés au catalogue et à l'arbre des pages
+        self._file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self._owns_file:
+            self._file.close()
+        return False
+
+    def _allocate(self):
+        number = self._next_object
+        self._next_object += 1
+        return number
+
+    def _write_object(self, number, body, stream=None):
+        self._offsets[number] = self._file.tell() - self._start
+        self._file.write(f"{number} 0 obj\n".encode())
+        self._file.write(body.encode())
+        if stream is not None:
+            self._file.write(b"\nstream\n")
+            self._file.write(stream)
+            self._file.write(b"\nendstream")
+        self._file.write(b"\nendobj\n")
+
+    def _write_image(self, image, smask_ref=None):
+        image_ref = self._allocate()
+        image_dict = {
+            "Type": "/XObject",
+            "Subtype": "/Image",
+            "Width": image.width,
+            "Height": image.height,
+            "ColorSpace": f"/{image.colorspace}",
+            "BitsPerComponent": image.bits_per_component,
+            "Filter": f"/{image.filter_name}",
+            "Length": len(image.data),
+        }
+        if image.decode_parms:
+            image_dict["DecodeParms"] = image.decode_parms
+        if smask_ref:
+            image_dict["SMask"] = f"{smask_ref} 0 R"
+        self._write_object(image_ref, _pdf_dict(image_dict), image.data)
+        return image_ref
+
+    def _shared_image(self, key, rgba_image):
+        """XObject d'une image superposée, écrit à la première utilisation de la clé"""
+        image_ref = self._shared_images.get(key)
+        if image_ref is None:
+            rgb, alpha = encode_rgba(rgba_image, self.flate_level)
+            image_ref = self._write_image(rgb, smask_ref=self._write_image(alpha))
+            self._shared_images[key] = image_ref
+        return image_ref
+
+    def add_page(self, image, page_size, overlays=None):
+        """
+        Ajoute une page affichant l'image sur toute sa surface.
+
+        Args:
+            image (EncodedImage): Image de la page
+            page_size (tuple): (largeur, hauteur) de la page en points
+            overlays (list): Images RGBA à superposer : tuples (clé, image PIL, (x, y)) avec
+                la position du coin haut-gauche en pixels de l'image de la page
+        """
+        width_pt, height_pt = page_size
+        image_ref = self._write_image(image)
+        xobjects = {"Im0": f"{image_ref} 0 R"}
+        content = [f"q {_pdf_number(width_pt)} 0 0 {_pdf_number(height_pt)} 0 0 cm /Im0 Do Q"]
+
+        # Pixels de l'image de la page -> points
+        scale_x = width_pt / image.width
+        scale_y = height_pt / image.height
+        for number, (key, rgba_image, (x, y)) in enumerate(overlays or (), start=1):
+            name = f"Im{number}"
+            xobjects[name] = f"{self._shared_image(key, rgba_image)} 0 R"
+            overlay_width = rgba_image.width * scale_x
+            overlay_height = rgba_image.height * scale_y
+            left = x * scale_x
+            bottom = height_pt - y * scale_y - overlay_height
+            content.append(f"q {_pdf_number(overlay_width)} 0 0 {_pdf_number(overlay_height)} "
+                           f"{_pdf_number(left)} {_pdf_number(bottom)} cm /{name} Do Q")
+
+        content = "\n".join(content).encode()
+        content_ref = self._allocate()
+        self._write_object(content_ref, _pdf_dict({"Length": len(content)}), content)
+
+        page_ref = self._allocate()
+        page_dict = {
+            "Type": "/Page",
+            "Parent": f"{self.PAGES} 0 R",
+            "MediaBox": f"[0 0 {_pdf_number(width_pt)} {_pdf_number(height_pt)}]",
+            "Resources": {"XObject": xobjects},
+            "Contents": f"{content_ref} 0 R",
+        }
+        self._write_object(page_ref, _pdf_dict(page_dict))
+        self._page_refs.append(page_ref)
+        self.page_count += 1
+
+    def close(self):
+        """Écrit l'arbre des pages, le catalogue et la table xref, puis ferme le fichier s'il a été ouvert ici"""
+        kids = " ".join(f"{ref} 0 R" for ref in self._page_refs)
+        self._write_object(self.PAGES, _pdf_dict({"Type": "/Pages", "Kids": f"[{kids}]",
+                                                  "Count": len(self._page_refs)}))
+        self._write_object(self.CATALOG, _pdf_dict({"Type": "/Catalog", "Pages": f"{self.PAGES} 0 R"}))
+
+        xref_offset = self._file.tell() - self._start
+        size = self._next_object
+        lines = [f"xref\n0 {size}\n", "0000000000 65535 f \n"]
+        for number in range(1, size):
+            lines.append(f"{self._offsets[number]:010d} 00000 n \n")
+        self._file.write("".join(lines).encode())
+        self._file.write(f"trailer\n{_pdf_dict({'Size': size, 'Root': f'{self.CATALOG} 0 R'})}\n"
+                         f"startxref\n{xref_offset}\n%%EOF\n".encode())
+        if self._owns_file:
+            self._file.close()
+
+
+# Clés des ressources de page susceptibles d'être complétées par une superposition
+_PAGE_RESOURCE_KEYS = ("XObject", "Font", "ExtGState", "ColorSpace", "Pattern", "Shading", "Properties")
+_REFERENCE = re.compile(r"(\d+) 0 R")
+
+
+def _referenced_xrefs(doc, xref, key):
+    """Numéros des objets indirects référencés par la clé key (chemin 'A/B' accepté) de l'objet xref"""
+    kind, value = doc.xref_get_key(xref, key)
+    if kind in ("xref", "array", "dict"):
+        return {int(number) for number in _REFERENCE.findall(value)}
+    return set()
+
+
+def _resources_owner(doc, page_xref):
+    """
+    Objet qui porte les ressources effectives d'une page : la page elle-même ou, par héritage
+    (ISO 32000-1 §7.7.3.4), le premier noeud /Pages ancêtre qui définit /Resources.
+
+    Returns:
+        int: xref du porteur, None si aucune ressource n'est définie
+    """
+    xref, seen = page_xref, set()
+    while xref not in seen:
+        seen.add(xref)
+        if doc.xref_get_key(xref, "Resources")[0] not in ("null", "none"):
+            return xref
+        kind, value = doc.xref_get_key(xref, "Parent")
+        if kind != "xref":
+            return None
+        xref = int(_REFERENCE.match(value).group(1))
+    return None
+
+
+def snapshot_page_objects(doc, page):
+    """
+    Mémorise l'état des objets qu'une superposition peut modifier sur une page : l'objet page,
+    ses flux de contenu, ses ressources (éventuellement héritées d'un noeud /Pages) et leurs
+    sous-dictionnaires indirects.
+
+    Returns:
+        dict: {xref: (source de l'objet, flux brut ou None)} - à passer à write_incremental_update
+    """
+    xrefs = {page.xref}
+    xrefs |= _referenced_xrefs(doc, page.xref, "Contents")
+    owner = _resources_owner(doc, page.xref)
+    if owner is not None:
+        # Ressources directes d'un ancêtre : c'est le noeud /Pages lui-même qui est modifié
+        xrefs.add(owner)
+        if doc.xref_get_key(owner, "Resources")[0] == "xref":
+            xrefs |= _referenced_xrefs(doc, owner, "Resources")
+        for key in _PAGE_RESOURCE_KEYS:
+            kind, value = doc.xref_get_key(owner, f"Resources/{key}")
+            if kind == "xref":
+                xrefs.add(int(_REFERENCE.match(value).group(1)))
+    return {xref: _object_state(doc, xref) for xref in xrefs}
+
+
+def _object_state(doc, xref):
+    stream = doc.xref_stream_raw(xref) if doc.xref_is_stream(xref) else None
+    return doc.xref_object(xref, compressed=True), stream
+
+
+def _read_tail(source, size=4096):
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source[-size:])
+    with open(source, "rb") as f:
+        f.seek(max(0, os.path.getsize(source) - size))
+        return f.read()
+
+
+def write_incremental_update(doc, source, output, snapshot, original_xref_length, flate_level=6):
+    """
+    Écrit dans output le PDF original suivi d'une section de mise à jour incrémentale
+    (ISO 32000-1 §7.5.6) contenant uniquement les objets modifiés depuis snapshot et ceux
+    créés au-delà de original_xref_length. Les octets originaux sont recopiés tels quels.
+
+    Args:
+        doc (fitz.Document): Document ouvert depuis source, modifié en mémoire
+        source (str | bytes): Chemin ou contenu du PDF original
+        output: Fichier binaire ouvert en écriture
+        snapshot (dict): Résultat de snapshot_page_objects avant modification
+        original_xref_length (int): doc.xref_length() avant modification
+        flate_level (int): Niveau zlib des flux écrits non compressés
+
+    Raises:
+        ValueError: Document chiffré, réparé à l'ouverture ou sans startxref exploitable
+    """
+    if doc.is_repaired:
+        raise ValueError("document réparé à l'ouverture")
+    if doc.xref_get_key(-1, "Encrypt")[0] != "null":
+        raise ValueError("document chiffré")
+    match = None
+    for match in re.finditer(rb"startxref\s+(\d+)\s+%%EOF", _read_tail(source)):
+        pass
+    if match is None:
+        raise ValueError("startxref introuvable")
+    previous_xref = int(match.group(1))
+
+    changed = [xref for xref, state in snapshot.items() if _object_state(doc, xref) != state]
+    changed += range(original_xref_length, doc.xref_length())
+
+    start = output.tell()
+    if isinstance(source, (bytes, bytearray)):
+        output.write(source)
+        ends_with_newline = source.endswith((b"\n", b"\r"))
+    else:
+        with open(source, "rb") as f:
+            shutil.copyfileobj(f, output, 1024 * 1024)
+        ends_with_newline = _read_tail(source, 1) in (b"\n", b"\r")
+    if not ends_with_newline:
+        output.write(b"\n")
+
+    offsets = {}
+    for xref in sorted(changed):
+        offsets[xref] = output.tell() - start
+        if doc.xref_is_stream(xref):
+            stream = doc.xref_stream_raw(xref)
+            if doc.xref_get_key(xref, "Filter")[0] == "null":
+                # Les flux créés par PyMuPDF ne sont compressés qu'à la sauvegarde complète
+                stream = zlib.compress(stream, flate_level)
+                doc.xref_set_key(xref, "Filter", "/FlateDecode")
+            doc.xref_set_key(xref, "Length", str(len(stream)))
+            output.write(f"{xref} 0 obj\n{doc.xref_object(xref, compressed=True)}\nstream\n".encode())
+            output.write(stream)
+            output.write(b"\nendstream\nendobj\n")
+        else:
+            output.write(f"{xref} 0 obj\n{doc.xref_object(xref, compressed=True)}\nendobj\n".encode())
+
+    # Table xref en sous-sections de numéros consécutifs
+    xref_offset = output.tell() - start
+    lines = ["xref\n"]
+    numbers = sorted(offsets)
+    first = 0
+    while first < len(numbers):
+        last = first
+        while last + 1 < len(numbers) and numbers[last + 1] == numbers[last] + 1:
+            last += 1
+        lines.append(f"{numbers[first]} {last - first + 1}\n")
+        lines.extend(f"{offsets[number]:010d} 00000 n \n" for number in numbers[first:last + 1])
+        first = last + 1
+
+    trailer = {"Size": doc.xref_length(), "Prev": previous_xref}
+    for key in ("Root", "Info", "ID"):
+        kind, value = doc.xref_get_key(-1, key)
+        if kind != "null":
+            trailer[key] = value
+    lines.append(f"trailer\n{_pdf_dict(trailer)}\nstartxref\n{xref_offset}\n%%EOF\n")
+    output.write("".join(lines).encode())
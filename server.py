@@ -1,19 +1,29 @@
+import asyncio
 import grpc
 from concurrent import futures
 import fitz
 import numpy as np
 import cv2
-from pdf2image import convert_from_path, pdfinfo_from_path
+from pdf2image import convert_from_path, convert_from_bytes
 import tempfile
 import requests
+import httpx
 import io
-import img2pdf
 from PIL import Image, ExifTags, ImageDraw, ImageFont
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import os
+import signal
 import multiprocessing
-from functools import lru_cache
+from multiprocessing import shared_memory
+from functools import lru_cache, partial
 import gc
+import math
+import time
+import threading
+import hashlib
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 
 import logging
 Image.MAX_IMAGE_PIXELS = 933120000
@@ -22,6 +32,10 @@ Image.MAX_IMAGE_PIXELS = 933120000
 import pdf_service_pb2
 import pdf_service_pb2_grpc
 
+from supervisor import Supervisor, WorkerLimits, current_rss
+from pdf_writer import (RASTER_CODECS, IncrementalPDFWriter, detect_color_mode, encode_image,
+                        snapshot_page_objects, write_incremental_update)
+
 # Configuration du logging selon l'environnement
 log_level = logging.DEBUG if os.getenv('ENABLE_DEBUG', 'false').lower() == 'true' else logging.INFO
 logging.basicConfig(level=log_level, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -29,17 +43,1110 @@ logging.basicConfig(level=log_level, format='%(asctime)s - %(levelname)s - %(mes
 # Configurer tempfile pour utiliser /tmp
 # En production, /tmp est sur disque (volume) pour éviter saturation RAM avec gros PDFs
 # En dev, peut être sur tmpfs (RAM) pour meilleures performances
+# Les requêtes sont traitées en mémoire : /tmp ne reçoit que les PDFs au-delà du seuil de bascule
 if os.path.exists('/tmp'):
     tempfile.tempdir = '/tmp'
     logging.info(f"Fichiers temporaires configurés pour utiliser /tmp")
 
+
+FONT_PATH = os.path.join("fonts", "OpenSans-regular.ttf")
+
+
+@lru_cache(maxsize=64)
+def load_label_font(font_size):
+    """Police du libellé, chargée une seule fois par taille"""
+    try:
+        return ImageFont.truetype(FONT_PATH, font_size)
+    except Exception:
+        return ImageFont.load_default()
+
+
+def is_in_memory(source):
+    """Vrai si la source est le contenu du fichier en mémoire plutôt qu'un chemin"""
+    return isinstance(source, (bytes, bytearray, memoryview))
+
+
+def open_pdf(source):
+    """Ouvre un PDF depuis un chemin ou depuis son contenu en mémoire"""
+    if source is None:
+        # fitz.open(None) créerait un document vide : le traitement réussirait sans rien produire
+        raise ValueError("Aucun PDF à ouvrir")
+    if is_in_memory(source):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
+
+
+def resolve_source(source):
+    """Source disponible, en attendant la fin de son téléchargement si c'est un Future"""
+    source = source.result() if isinstance(source, Future) else source
+    if source is None:
+        raise ValueError("Source absente : téléchargement sans contenu")
+    return source
+
+
+def read_source(source):
+    """Contenu d'une source (chemin ou octets)"""
+    if is_in_memory(source):
+        return bytes(source)
+    with open(source, 'rb') as f:
+        return f.read()
+
+
+class InvalidRequest(ValueError):
+    """Paramètre de requête invalide (sélection de pages, mode de sortie, source absente)"""
+
+
+def parse_page_selection(spec, num_pages):
+    """
+    Pages désignées par une sélection textuelle, numérotées à partir de 1.
+
+    Éléments séparés par des virgules :
+    - un numéro ('3'), 'first' ou 'last'
+    - un intervalle 'a-b', ouvert 'a-' (jusqu'à la fin) ou '-b' (depuis le début) ;
+      les bornes acceptent 'first' et 'last'
+    - 'odd' ou 'even'
+    - un pas '/n' après un intervalle : une page sur n ('1-/5', '2-20/2')
+
+    Exemple : '1,5-7,last' (première page de chaque annexe d'un dossier fusionné).
+
+    Args:
+        spec (str): Sélection
+        num_pages (int): Nombre de pages du document
+
+    Returns:
+        list: Numéros de page triés, sans doublon
+
+    Raises:
+        InvalidRequest: Sélection invalide ou ne désignant aucune page
+    """
+    def bound(token, default):
+        token = token.strip()
+        if not token:
+            return default
+        if token == 'first':
+            return 1
+        if token == 'last':
+            return num_pages
+        if not token.isdigit() or int(token) < 1:
+            raise InvalidRequest(f"Sélection de pages invalide : '{spec}'")
+        return int(token)
+
+    pages = set()
+    for item in spec.lower().split(','):
+        item = item.strip()
+        if not item:
+            continue
+        item = {'odd': '1-/2', 'even': '2-/2'}.get(item, item)
+        item, has_step, step = item.partition('/')
+        if has_step and (not step.strip().isdigit() or int(step) < 1):
+            raise InvalidRequest(f"Pas de sélection invalide : '{spec}'")
+        if '-' in item:
+            start_token, _, end_token = item.partition('-')
+            start = bound(start_token, 1)
+            end = min(bound(end_token, num_pages), num_pages)
+            if start > end and start <= num_pages:
+                raise InvalidRequest(f"Intervalle de pages inversé : '{item}'")
+        elif has_step:
+            raise InvalidRequest(f"Un pas s'applique à un intervalle : '{spec}'")
+        else:
+            start = end = bound(item, None)
+            if start > num_pages:
+                raise InvalidRequest(f"Page {start} hors du document ({num_pages} pages)")
+        pages.update(range(start, end + 1, int(step) if has_step else 1))
+
+    if not pages:
+        raise InvalidRequest(f"Aucune page sélectionnée par '{spec}'")
+    return sorted(pages)
+
+
+def map_bands(executor, fn, image, bands, halo, axis=0):
+    """
+    Applique fn en parallèle sur des bandes recouvrantes de l'image, puis recolle les résultats.
+
+    fn est une opération locale (seuillage, morphologie, filtre) : si chaque pixel du résultat
+    ne dépend que des pixels à moins de `halo` le long de axis, le résultat est identique à
+    fn(image). Les bandes sont au moins aussi larges que le recouvrement.
+
+    Args:
+        executor (Executor): Threads d'exécution des bandes (None = image d'un bloc)
+        fn (callable): fn(bande) -> tableau de même forme que la bande
+        image (np.ndarray): Image 2D
+        bands (int): Nombre de bandes souhaité
+        halo (int | tuple): Recouvrement en pixels, ou (avant, après)
+        axis (int): 0 = bandes horizontales (lignes), 1 = bandes verticales (colonnes)
+    """
+    before, after = (halo, halo) if isinstance(halo, int) else halo
+    length = image.shape[axis]
+    bands = min(bands, length // max(before, after, 64))
+    if executor is None or bands <= 1:
+        return fn(image)
+
+    bounds = np.linspace(0, length, bands + 1).astype(int)
+
+    def run(i):
+        start, end = int(bounds[i]), int(bounds[i + 1])
+        low, high = max(0, start - before), min(length, end + after)
+        result = fn(image[low:high] if axis == 0 else image[:, low:high])
+        return result[start - low:end - low] if axis == 0 else result[:, start - low:end - low]
+
+    return np.concatenate(list(executor.map(run, range(bands))), axis=axis)
+
+
+class SummedAreaTable:
+    """
+    Image intégrale (table de sommes cumulées) d'un masque.
+
+    La somme de n'importe quelle fenêtre carrée s'obtient en O(1).
+    """
+
+    def __init__(self, mask):
+        """
+        Args:
+            mask (np.ndarray): Masque 2D uint8 (0/255)
+        """
+        self.height, self.width = mask.shape
+        # float64 : sommes entières exactes jusqu'à 2**53, donc mêmes résultats que np.sum
+        self.table = cv2.integral(mask, sdepth=cv2.CV_64F)
+
+    def window_sum(self, x, y, size):
+        """Somme des pixels de la fenêtre [y:y+size, x:x+size]."""
+        table = self.table
+        return table[y + size, x + size] - table[y, x + size] - table[y + size, x] + table[y, x]
+
+
+class FreeSquareMap:
+    """
+    Carte « plus grand carré libre ancré ici » d'une page.
+
+    Pour chaque pixel (y, x), `sizes[y, x]` est le côté du plus grand carré sans aucun
+    pixel interdit dont le coin haut-gauche est (x, y). La plus grande zone utilisable
+    s'obtient en un seul argmax, et la meilleure position pour n'importe quelle taille
+    sans recalculer la carte.
+    """
+
+    def __init__(self, forbidden_mask, white_binary, max_size, executor=None, bands=1):
+        """
+        Args:
+            forbidden_mask (np.ndarray): Masque des zones interdites (0 = libre)
+            white_binary (np.ndarray): Image binaire des pixels blancs (255 = blanc)
+            max_size (int): Côté maximal utile, les valeurs de la carte sont plafonnées
+            executor (Executor): Threads de calcul par bandes horizontales (None = page d'un bloc)
+            bands (int): Nombre de bandes
+        """
+        self.height, self.width = forbidden_mask.shape
+        self.executor = executor
+        self.bands = bands
+        # Valeurs plafonnées à max_size : une ligne ne dépend que des max_size lignes suivantes
+        self.sizes = map_bands(executor, lambda blocked: self._build_sizes(blocked, max_size),
+                               forbidden_mask > 0, bands, (0, max_size))
+        self.white_sat = SummedAreaTable(white_binary)
+
+    @staticmethod
+    def _build_sizes(blocked, max_size):
+        """
+        Programmation dynamique du carré maximal, ligne par ligne du bas vers le haut :
+        sizes[y, x] = min(sizes[y+1, x] + 1, sizes[y+1, x+1] + 1, sizes[y, x+1] + 1).
+        La dépendance horizontale est résolue par un minimum cumulé de (v[j] + j),
+        ce qui vectorise chaque ligne.
+        """
+        height, width = blocked.shape
+        sizes = np.zeros((height + 1, width + 1), dtype=np.int32)
+        columns = np.arange(width, dtype=np.int32)
+
+        for y in range(height - 1, -1, -1):
+            below = sizes[y + 1]
+            candidates = np.minimum(below[:-1], below[1:]) + 1
+            candidates += columns
+            # Un pixel interdit borne à 0 la taille de tous les carrés qui le couvrent
+            np.copyto(candidates, columns, where=blocked[y])
+            row = np.minimum.accumulate(candidates[::-1])[::-1]
+            row -= columns
+            np.minimum(row, max_size, out=sizes[y, :width])
+
+        return sizes[:height, :width]
+
+    def largest_square(self):
+        """
+        Plus grand carré libre de la page.
+
+        Returns:
+            tuple: (x, y, côté) du premier plus grand carré en ordre de balayage
+        """
+        flat_index = int(np.argmax(self.sizes))
+        y, x = divmod(flat_index, self.width)
+        return x, y, int(self.sizes[y, x])
+
+    def best_position(self, size, white_threshold):
+        """
+        Meilleure position pour une zone de côté `size` : première position en ordre de
+        balayage (y puis x) sans pixel interdit et dont la blancheur dépasse le seuil.
+
+        Returns:
+            tuple: (x, y, blancheur) ou None si aucune position ne convient
+        """
+        search_height = self.height - size
+        search_width = self.width - size
+        if search_height <= 0 or search_width <= 0:
+            return None
+
+        bands = min(self.bands, search_height // 64) if self.executor is not None else 1
+        if bands <= 1:
+            return self._first_position(0, search_height, search_width, size, white_threshold)
+        # Bandes de lignes d'ancrage : la première bande qui a une position donne la première en balayage
+        bounds = np.linspace(0, search_height, bands + 1).astype(int)
+        positions = self.executor.map(
+            lambda i: self._first_position(int(bounds[i]), int(bounds[i + 1]), search_width, size, white_threshold),
+            range(bands))
+        return next((position for position in positions if position is not None), None)
+
+    def _first_position(self, start, end, search_width, size, white_threshold):
+        """Première position valide dont le coin haut-gauche est dans les lignes [start, end)"""
+        free = self.sizes[start:end, :search_width] >= size
+        ys, xs = np.nonzero(free)
+        if ys.size == 0:
+            return None
+        ys += start
+
+        table = self.white_sat.table
+        white_sums = table[ys + size, xs + size] - table[ys, xs + size] - table[ys + size, xs] + table[ys, xs]
+        white_ratios = white_sums / (size * size) / 255.0
+        valid = np.flatnonzero(white_ratios > white_threshold)
+        if valid.size == 0:
+            return None
+
+        first = valid[0]
+        return int(xs[first]), int(ys[first]), float(white_ratios[first])
+
+
+class StampCache:
+    """
+    Cache LRU des tampons redimensionnés, partagé entre les requêtes et les threads.
+
+    Les entrées sont indexées par l'empreinte SHA-256 du contenu du tampon (et non par
+    son chemin, qui change à chaque requête), la taille cible et le mode de rééchantillonnage.
+    L'éviction se fait sur le volume total des images en mémoire.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_digests=128):
+        """
+        Args:
+            max_bytes (int): Volume maximal des images en cache (octets)
+            max_digests (int): Nombre maximal d'empreintes de fichiers mémorisées
+        """
+        self.max_bytes = max_bytes
+        self.max_digests = max_digests
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._digests = OrderedDict()
+        self._lock = threading.Lock()
+
+    def content_digest(self, stamp_path):
+        """
+        Empreinte SHA-256 du tampon (chemin ou octets). Pour un fichier, elle n'est
+        recalculée que si le fichier change.
+        """
+        if is_in_memory(stamp_path):
+            return hashlib.sha256(stamp_path).hexdigest()
+        stat = os.stat(stamp_path)
+        file_key = (stamp_path, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            digest = self._digests.get(file_key)
+            if digest is not None:
+                self._digests.move_to_end(file_key)
+                return digest
+        with open(stamp_path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        with self._lock:
+            self._digests[file_key] = digest
+            while len(self._digests) > self.max_digests:
+                self._digests.popitem(last=False)
+        return digest
+
+    def get_or_create(self, key, factory):
+        """
+        Retourne l'image associée à key, en la construisant avec factory() si absente.
+        La construction se fait hors verrou ; l'image retournée ne doit pas être modifiée.
+        """
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return image
+            self.misses += 1
+
+        image = factory()
+        image_bytes = image.width * image.height * len(image.getbands())
+
+        with self._lock:
+            if key in self._entries:
+                # Construite entre-temps par un autre thread
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self._entries[key] = image
+            self._bytes += image_bytes
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.width * evicted.height * len(evicted.getbands())
+        return image
+
+    def get_stamp(self, stamp_path, size, resample=Image.Resampling.LANCZOS):
+        """Tampon RGBA redimensionné à size x size"""
+        key = ("stamp", self.content_digest(stamp_path), size, int(resample))
+        return self.get_or_create(key, lambda: self._resize_stamp(stamp_path, size, resample))
+
+    @staticmethod
+    def _resize_stamp(stamp_path, size, resample):
+        stamp_file = io.BytesIO(stamp_path) if is_in_memory(stamp_path) else stamp_path
+        stamp_img = Image.open(stamp_file).convert("RGBA")
+        # Si le redimensionnement est important, faire un upscale progressif pour préserver les détails
+        original_size = max(stamp_img.width, stamp_img.height)
+        if size > original_size * 1.5:
+            # Pour les grands agrandissements, redimensionner progressivement
+            intermediate_size = int(original_size * 1.5)
+            stamp_img = stamp_img.resize((intermediate_size, intermediate_size), resample)
+        # Redimensionnement final (LANCZOS par défaut, meilleure qualité)
+        return stamp_img.resize((size, size), resample)
+
+    def stats(self):
+        """Compteurs du cache"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self._entries), "bytes": self._bytes}
+
+
+class PageSession:
+    """
+    Pages d'une requête soumises au PageScheduler. S'utilise comme un executor (submit, map) ;
+    à la fermeture, les pages non démarrées sont annulées et les pages en cours attendues.
+    """
+
+    def __init__(self, scheduler, name, max_parallel):
+        self.name = name
+        self.max_parallel = max_parallel  # Pages de la requête exécutées simultanément au plus
+        self._scheduler = scheduler
+        self._tasks = deque()  # (future, fn, args) en attente
+        self._running = 0
+        self._scheduled = False  # Présente dans la file de service du scheduler
+        self._cancelled = False  # Requête abandonnée : plus aucune page n'est lancée
+
+    def submit(self, fn, *args):
+        future = Future()
+        self._scheduler._enqueue(self, (future, fn, args))
+        return future
+
+    def map(self, fn, iterable):
+        """Résultats dans l'ordre de iterable ; les pages restantes sont annulées en cas d'erreur"""
+        futures = [self.submit(fn, item) for item in iterable]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def cancel(self):
+        """Retire les pages en attente et refuse les suivantes (requête abandonnée)"""
+        self._scheduler._cancel_session(self)
+
+    def close(self):
+        self._scheduler._close_session(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class NativeThreadPolicy:
+    """
+    Threads internes d'OpenCV (et des BLAS chargés par NumPy, via threadpoolctl) répartis
+    selon le nombre de pages traitées simultanément : les CPU sont partagés entre les pages
+    au lieu d'être multipliés. Une page seule dispose de tous les CPU dans OpenCV, un lot de
+    pages d'un thread par page.
+
+    Le réglage est global au process et ne peut changer sans risque pendant un appel OpenCV/BLAS :
+    le scheduler ne fait que noter la cible (update) et l'applique quand aucune page n'est en
+    cours (apply_target). Une baisse nette (hystérésis) justifie d'attendre la fin des pages en
+    cours avant d'en lancer d'autres, au plus une fois par min_interval secondes.
+    """
+
+    def __init__(self, cpu_count, fixed=0, hysteresis=2, min_interval=2.0):
+        """
+        Args:
+            cpu_count (int): CPU partagés entre les pages (voir detect_cpu_limit)
+            fixed (int): Nombre de threads imposé quelle que soit la charge (0 = selon la charge)
+            hysteresis (float): Rapport entre threads appliqués et cible au-delà duquel les
+                pages en cours sont attendues pour baisser le réglage
+            min_interval (float): Délai minimal entre deux attentes de ce type, en secondes
+        """
+        self.cpu_count = max(1, cpu_count)
+        self.fixed = fixed
+        self.hysteresis = hysteresis
+        self.min_interval = min_interval
+        self.threads = None
+        self.target = fixed or self.cpu_count
+        self._applied_at = 0.0
+        self._lock = threading.Lock()
+        self._blas = None
+        try:
+            from threadpoolctl import ThreadpoolController
+            self._blas = ThreadpoolController()
+        except ImportError:
+            logging.debug("threadpoolctl indisponible : threads BLAS laissés à OPENBLAS_NUM_THREADS")
+        self.apply_target()
+
+    def threads_for(self, concurrent_pages):
+        """Threads par appel OpenCV quand concurrent_pages pages sont en cours"""
+        if self.fixed:
+            return self.fixed
+        return max(1, self.cpu_count // max(1, concurrent_pages))
+
+    def update(self, concurrent_pages):
+        """Nouvelle cible selon la charge ; aucun appel aux bibliothèques"""
+        self.target = self.threads_for(concurrent_pages)
+
+    def oversubscribed(self):
+        """Réglage appliqué nettement au-dessus de la cible et dernière reconfiguration assez ancienne"""
+        return (self.threads > self.target * self.hysteresis
+                and time.monotonic() - self._applied_at >= self.min_interval)
+
+    def apply_target(self):
+        """Applique la cible ; à n'appeler qu'en l'absence de travail OpenCV/BLAS en cours"""
+        with self._lock:
+            threads = self.target
+            if threads == self.threads:
+                return
+            self.threads = threads
+            self._applied_at = time.monotonic()
+            cv2.setNumThreads(threads)
+            if self._blas is not None:
+                self._blas.limit(limits=threads, user_api='blas')
+        logging.debug(f"Threads OpenCV/BLAS par page : {threads}")
+
+
+class PageScheduler:
+    """
+    Workers de pages uniques pour tout le process, partagés par les requêtes gRPC concurrentes.
+
+    Chaque requête ouvre une session et y soumet ses pages ; les workers servent les sessions
+    à tour de rôle (round-robin), une page à la fois : un document de 1 000 pages n'affame pas
+    un document de 2 pages arrivé après lui. Le nombre de threads reste fixe quel que soit
+    le nombre de requêtes ; `limit` (ajusté par le ConcurrencyController) borne les pages
+    exécutées simultanément en dessous de ce plafond.
+    """
+
+    def __init__(self, workers, native_threads=None):
+        """
+        Args:
+            workers (int): Nombre de workers (plafond de pages traitées simultanément)
+            native_threads (NativeThreadPolicy): Threads OpenCV/BLAS ajustés au nombre de pages
+                en cours ou prêtes à démarrer (None = réglage des bibliothèques inchangé)
+        """
+        self.workers = workers
+        self.limit = workers
+        self.native_threads = native_threads
+        self.concurrent_pages = 0  # Pages en cours ou prêtes à démarrer, au plus limit
+        self._condition = threading.Condition()
+        self._ready = deque()  # Sessions ayant des pages en attente, dans l'ordre de service
+        self._sessions = set()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._peak_queued = 0
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"page-worker-{i}", daemon=True).start()
+
+    def session(self, name, max_parallel=None, cancellation=None):
+        """
+        Ouvre la session d'une requête (à utiliser dans un bloc with).
+
+        Args:
+            cancellation (CancellationToken): Abandon de la requête : ses pages en attente sont retirées
+        """
+        session = PageSession(self, name, max_parallel or self.workers)
+        with self._condition:
+            self._sessions.add(session)
+        if cancellation is not None:
+            cancellation.add_callback(session.cancel)
+        return session
+
+    def _enqueue(self, session, task):
+        with self._condition:
+            if session not in self._sessions:
+                raise RuntimeError(f"Session fermée : {session.name}")
+            if session._cancelled:
+                task[0].cancel()
+                return
+            session._tasks.append(task)
+            if not session._scheduled:
+                session._scheduled = True
+                self._ready.append(session)
+            self._queued += 1
+            self._peak_queued = max(self._peak_queued, self._queued)
+            self._update_concurrency()
+            self._condition.notify()
+
+    def set_limit(self, limit):
+        """Pages exécutées simultanément, toutes requêtes confondues (entre 1 et workers)"""
+        with self._condition:
+            self.limit = max(1, min(self.workers, limit))
+            self._update_concurrency()
+            self._condition.notify_all()
+
+    def _update_concurrency(self):
+        """Pages simultanées à venir (sous verrou) : répartition des CPU dans OpenCV/BLAS et par page"""
+        self.concurrent_pages = min(self.limit, self._running + self._queued)
+        if self.native_threads is not None:
+            self.native_threads.update(self.concurrent_pages)
+
+    def _next_task(self):
+        """Prochaine page à exécuter (sous verrou) : première session servie qui n'est pas à sa limite"""
+        if self._running >= self.limit:
+            return None
+        if self.native_threads is not None and self._ready:
+            if self._running == 0:
+                # Aucune page dans OpenCV/BLAS : reconfiguration sans risque
+                self.native_threads.apply_target()
+            elif self.native_threads.oversubscribed():
+                # Threads trop nombreux pour les pages à venir : les pages en cours se terminent
+                # avant la reconfiguration
+                return None
+        for _ in range(len(self._ready)):
+            session = self._ready.popleft()
+            if session._running >= session.max_parallel:
+                self._ready.append(session)
+                continue
+            task = session._tasks.popleft()
+            if session._tasks:
+                # Retour en fin de file : les autres requêtes passent avant sa page suivante
+                self._ready.append(session)
+            else:
+                session._scheduled = False
+            self._queued -= 1
+            self._running += 1
+            session._running += 1
+            return session, task
+        return None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                picked = self._next_task()
+                while picked is None:
+                    self._condition.wait()
+                    picked = self._next_task()
+            session, (future, fn, args) = picked
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._condition:
+                    self._running -= 1
+                    session._running -= 1
+                    self._completed += 1
+                    self._update_concurrency()
+                    # Une place se libère : session à sa limite ou fermeture en attente
+                    self._condition.notify_all()
+
+    def _drop_pending(self, session):
+        """Annule les pages en attente d'une session (sous verrou)"""
+        for future, _, _ in session._tasks:
+            future.cancel()
+        self._queued -= len(session._tasks)
+        session._tasks.clear()
+        self._update_concurrency()
+        if session._scheduled:
+            self._ready.remove(session)
+            session._scheduled = False
+
+    def _cancel_session(self, session):
+        with self._condition:
+            if session._cancelled or session not in self._sessions:
+                return
+            session._cancelled = True
+            dropped = len(session._tasks)
+            self._drop_pending(session)
+        logging.info(f"Requête abandonnée ({session.name}) : {dropped} page(s) en attente retirée(s)")
+
+    def _close_session(self, session):
+        with self._condition:
+            self._sessions.discard(session)
+            self._drop_pending(session)
+            # Les pages en cours utilisent encore les ressources de la requête
+            while session._running:
+                self._condition.wait()
+
+    def stats(self):
+        """Profondeur de file et activité des workers"""
+        with self._condition:
+            return {
+                "workers": self.workers,
+                "limit": self.limit,
+                "active_requests": len(self._sessions),
+                "queued_pages": self._queued,
+                "running_pages": self._running,
+                "peak_queued_pages": self._peak_queued,
+                "completed_pages": self._completed,
+            }
+
+
+class ConcurrencyController:
+    """
+    Ajuste en continu le nombre de pages exécutées simultanément (PageScheduler.limit) d'après
+    le débit mesuré et le bridage CFS du conteneur, plutôt que d'après des seuils fixes.
+
+    Toutes les `interval` secondes où des pages attendent un worker, le débit (pages/s) est
+    attribué à la limite courante ; la limite passe à la voisine (±1) qui débite nettement
+    plus, ou explore une voisine sans mesure récente (recherche locale). Quand plus de
+    `max_throttled` des périodes CFS ont épuisé le quota, la limite baisse : les threads se
+    disputent des CPU absents.
+    """
+
+    def __init__(self, scheduler, cpu_limit, interval=5.0, max_throttled=0.1, tolerance=0.05, memory=60.0):
+        """
+        Args:
+            scheduler (PageScheduler): Scheduler piloté (son nombre de workers est le plafond)
+            cpu_limit (float): CPU disponibles (voir detect_cpu_limit), point de départ de la limite
+            interval (float): Période de mesure, en secondes
+            max_throttled (float): Part de périodes CFS bridées tolérée
+            tolerance (float): Écart relatif de débit attribué au bruit de mesure
+            memory (float): Durée de validité d'une mesure (la charge change), en secondes
+        """
+        self.scheduler = scheduler
+        self.cpu_limit = cpu_limit
+        self.interval = interval
+        self.max_throttled = max_throttled
+        self.tolerance = tolerance
+        self.memory = memory
+        # Plancher de la recherche : seul le bridage descend en dessous
+        self.min_limit = max(1, math.ceil(cpu_limit / 2))
+        self.pages_per_second = 0.0
+        self.throttled_ratio = 0.0
+        self._rates = {}  # limite -> (débit lissé, instant de la mesure)
+        # Une page par CPU pour commencer
+        scheduler.set_limit(math.ceil(cpu_limit))
+        threading.Thread(target=self._run, name="concurrency-controller", daemon=True).start()
+
+    def _run(self):
+        completed = self.scheduler.stats()["completed_pages"]
+        throttling = read_cpu_throttling()
+        last = time.monotonic()
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            stats = self.scheduler.stats()
+            current = read_cpu_throttling()
+            throttled_ratio = 0.0
+            if throttling is not None and current is not None and current[0] > throttling[0]:
+                throttled_ratio = (current[1] - throttling[1]) / (current[0] - throttling[0])
+            self._adjust((stats["completed_pages"] - completed) / (now - last), throttled_ratio,
+                         saturated=stats["queued_pages"] > 0, now=now)
+            completed, throttling, last = stats["completed_pages"], current, now
+
+    def _adjust(self, rate, throttled_ratio, saturated, now):
+        """Une période de mesure : nouvelle limite du scheduler"""
+        self.pages_per_second = rate
+        self.throttled_ratio = throttled_ratio
+        limit = self.scheduler.limit
+        if throttled_ratio > self.max_throttled and limit > 1:
+            logging.info(f"Bridage CPU ({throttled_ratio:.0%} des périodes) : {limit - 1} pages simultanées")
+            # Mesures faussées par le bridage
+            self._rates = {l: m for l, m in self._rates.items() if l < limit}
+            self.scheduler.set_limit(limit - 1)
+            return
+        if not saturated:
+            # Pas de pages en attente : le débit dépend de la charge, pas de la limite
+            return
+
+        previous = self._rates.get(limit)
+        self._rates[limit] = (rate if previous is None else (previous[0] + rate) / 2, now)
+        self._rates = {l: m for l, m in self._rates.items() if now - m[1] <= self.memory}
+        neighbours = [l for l in (limit + 1, limit - 1) if self.min_limit <= l <= self.scheduler.workers]
+        known = [l for l in neighbours if l in self._rates]
+        best = max(known, key=lambda l: self._rates[l][0], default=limit)
+        current = self._rates[limit][0]
+        if self._rates[best][0] > current * (1 + self.tolerance):
+            # Voisine nettement plus rapide
+            target = best
+        elif self._rates[best][0] <= current:
+            # Meilleure limite connue : exploration d'une voisine sans mesure récente (vers le haut d'abord)
+            target = next((l for l in neighbours if l not in self._rates), limit)
+        else:
+            target = limit
+        if target != limit:
+            logging.debug(f"Concurrence des pages : {rate:.1f} pages/s à {limit}, limite {target}")
+            self.scheduler.set_limit(target)
+
+
+def detect_memory_limit():
+    """Mémoire utilisable par le process : limite du cgroup (conteneur) ou, à défaut, RAM physique"""
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # 'max' (cgroup v2) ou valeur géante (cgroup v1) : pas de limite
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value)
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def detect_cpu_limit():
+    """
+    CPU utilisables par le process : CPU autorisés (affinité, cpuset) bornés par le quota CFS
+    du cgroup (`cpus:` de docker-compose), et non le nombre de cœurs de l'hôte.
+
+    Returns:
+        float: Nombre de CPU, éventuellement fractionnaire (quota de 1.5 CPU par exemple)
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else multiprocessing.cpu_count()
+    quota = None
+    try:
+        # cgroup v2 : "quota période" ou "max période"
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            value, period = f.read().split()
+        if value != 'max':
+            quota = int(value) / int(period)
+    except (OSError, ValueError):
+        for directory in ('/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct'):
+            try:
+                with open(os.path.join(directory, 'cpu.cfs_quota_us')) as f:
+                    value = int(f.read())
+                with open(os.path.join(directory, 'cpu.cfs_period_us')) as f:
+                    period = int(f.read())
+            except (OSError, ValueError):
+                continue
+            # -1 (cgroup v1) : pas de quota
+            if value > 0 and period > 0:
+                quota = value / period
+            break
+    return min(cpus, quota) if quota else float(cpus)
+
+
+def read_cpu_throttling():
+    """
+    Compteurs de bridage CFS du cgroup (cpu.stat) : périodes écoulées et périodes où le
+    quota a été épuisé.
+
+    Returns:
+        tuple: (nr_periods, nr_throttled), None sans cgroup CPU lisible
+    """
+    for path in ('/sys/fs/cgroup/cpu.stat', '/sys/fs/cgroup/cpu/cpu.stat', '/sys/fs/cgroup/cpu,cpuacct/cpu.stat'):
+        try:
+            with open(path) as f:
+                values = dict(line.split() for line in f if line.strip())
+            return int(values['nr_periods']), int(values['nr_throttled'])
+        except (OSError, KeyError, ValueError):
+            continue
+    return None
+
+
+class AdmissionRejected(Exception):
+    """Requête refusée par le MemoryBudget : pic estimé hors budget ou attente trop longue"""
+
+
+class MemoryBudget:
+    """
+    Budget mémoire partagé par les requêtes concurrentes (contrôle d'admission).
+
+    Chaque requête réserve son pic mémoire estimé avant de démarrer et le rend à la fin.
+    Une requête qui ne tient pas dans la place restante attend son tour, dans l'ordre
+    d'arrivée, au plus `timeout` secondes ; une requête plus grosse que le budget entier
+    est refusée d'emblée.
+    """
+
+    def __init__(self, capacity, timeout):
+        """
+        Args:
+            capacity (int): Budget en octets
+            timeout (float): Attente maximale d'une requête avant refus, en secondes
+        """
+        self.capacity = capacity
+        self.timeout = timeout
+        self._condition = threading.Condition()
+        self._waiting = deque()  # Requêtes en attente, dans l'ordre d'arrivée
+        self._reserved = 0
+        self._peak_reserved = 0
+        self._admitted = 0
+        self._rejected = 0
+
+    def acquire(self, nbytes, name, cancellation=None):
+        """
+        Réserve nbytes, en attendant si nécessaire que des requêtes en cours se terminent.
+
+        Args:
+            cancellation (CancellationToken): Abandon de la requête, qui quitte alors la file
+
+        Raises:
+            AdmissionRejected: Réservation impossible (budget dépassé ou délai écoulé)
+            RequestCancelled: Requête abandonnée pendant l'attente
+        """
+        mb = 1024 * 1024
+        if cancellation is not None:
+            cancellation.add_callback(self._wake_up)
+        with self._condition:
+            if nbytes > self.capacity:
+                self._rejected += 1
+                raise AdmissionRejected(f"{name} : {nbytes // mb} Mo estimés, au-delà du budget mémoire "
+                                        f"({self.capacity // mb} Mo)")
+            started = time.monotonic()
+            ticket = object()
+            self._waiting.append(ticket)
+            try:
+                # Premier arrivé, premier servi : une grosse requête n'est pas doublée indéfiniment
+                while self._waiting[0] is not ticket or self._reserved + nbytes > self.capacity:
+                    if cancellation is not None:
+                        cancellation.check()
+                    remaining = started + self.timeout - time.monotonic()
+                    if remaining <= 0:
+                        self._rejected += 1
+                        raise AdmissionRejected(f"{name} : {nbytes // mb} Mo estimés, budget mémoire occupé "
+                                                f"({self._reserved // mb}/{self.capacity // mb} Mo) "
+                                                f"depuis {self.timeout:.0f} s")
+                    if cancellation is not None and cancellation.deadline is not None:
+                        # Réveil à l'échéance de la requête pour quitter la file
+                        remaining = min(remaining, max(0.0, cancellation.deadline - time.monotonic()))
+                    self._condition.wait(remaining)
+            finally:
+                self._waiting.remove(ticket)
+                # La requête suivante peut tenir dans la place restante
+                self._condition.notify_all()
+            self._reserved += nbytes
+            self._peak_reserved = max(self._peak_reserved, self._reserved)
+            self._admitted += 1
+            reserved = self._reserved
+        logging.info(f"{name} admise : {nbytes // mb} Mo réservés ({reserved // mb}/{self.capacity // mb} Mo, "
+                     f"attente {time.monotonic() - started:.1f} s)")
+
+    def release(self, nbytes):
+        with self._condition:
+            self._reserved -= nbytes
+            self._condition.notify_all()
+
+    def _wake_up(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def stats(self):
+        """Budget, réservations en cours et requêtes en attente"""
+        with self._condition:
+            return {
+                "capacity": self.capacity,
+                "reserved": self._reserved,
+                "peak_reserved": self._peak_reserved,
+                "waiting": len(self._waiting),
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+            }
+
+
+class RequestCancelled(Exception):
+    """Requête abandonnée en cours de traitement : client déconnecté ou délai gRPC dépassé"""
+
+    def __init__(self, reason, expired=False):
+        super().__init__(reason)
+        self.expired = expired  # Échéance de la requête dépassée
+
+
+class CancellationToken:
+    """
+    Abandon d'une requête, signalé par le service gRPC (client déconnecté, délai dépassé) et
+    consulté par le traitement : pages en file retirées du scheduler, pages en cours
+    arrêtées entre deux étapes (rendu, analyse, encodage).
+    """
+
+    def __init__(self, deadline=None):
+        """
+        Args:
+            deadline (float): Échéance de la requête (time.monotonic()), None = sans délai
+        """
+        self.deadline = deadline
+        self.reason = None
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def cancel(self, reason):
+        """Abandonne la requête ; les callbacks enregistrés sont appelés une seule fois"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback):
+        """callback() appelé à l'abandon, immédiatement si la requête est déjà abandonnée"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    @property
+    def cancelled(self):
+        if not self._event.is_set() and self.expired:
+            self.cancel("délai de la requête dépassé")
+        return self._event.is_set()
+
+    @property
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def exception(self):
+        """Exception signalant l'abandon"""
+        return RequestCancelled(self.reason, self.expired)
+
+    def check(self):
+        """Point d'arrêt : RequestCancelled si la requête est abandonnée"""
+        if self.cancelled:
+            raise self.exception()
+
+    def __reduce__(self):
+        # Transmis au pool d'analyse avec le contexte : seule l'échéance a un sens dans un autre process
+        return CancellationToken, (self.deadline,)
+
+
+@dataclass(frozen=True)
+class ProcessingContext:
+    """
+    Paramètres d'une requête, figés à son démarrage et transmis à chaque étape du traitement.
+    Le PDFProcessor est partagé par les threads gRPC : rien de ce qui dépend de la requête
+    (DPI adapté au nombre de pages, workers...) n'est stocké sur l'instance.
+    """
+    dpi: int                  # Résolution d'analyse et de rendu des pages
+    workers: int              # Pages de la requête traitées en parallèle au plus (voir PageScheduler)
+    stamp_size_max: int       # Taille maximale du tampon en pixels (à dpi)
+    stamp_size_min: int       # Taille minimale du tampon en pixels (à dpi)
+    analysis_engine: str      # 'auto', 'raster' ou 'vector'
+    output_mode: str          # 'raster' ou 'overlay'
+    enable_debug: bool = False
+    cancellation: CancellationToken = field(default=None, compare=False)  # Abandon de la requête
+
+    def check_cancelled(self):
+        """Point d'arrêt entre deux étapes d'une page : RequestCancelled si la requête est abandonnée"""
+        if self.cancellation is not None:
+            self.cancellation.check()
+
+
+# Processeur local de chaque process du pool d'analyse (voir AnalysisPool)
+_analysis_worker = None
+# Barrière de démarrage commune aux process du pool
+_analysis_barrier = None
+
+
+def _init_analysis_worker(barrier):
+    """Initialisation d'un process d'analyse : cv2/fitz déjà importés, un processeur d'analyse seule"""
+    global _analysis_worker, _analysis_barrier
+    _analysis_barrier = barrier
+    # Une page par process : les CPU sont déjà répartis entre les process du pool, OpenCV et BLAS
+    # limités à un thread une fois pour toutes
+    _analysis_worker = PDFProcessor(page_scheduling=False, native_threads=1)
+
+
+def _analysis_worker_ready():
+    """Bloque jusqu'à ce que tous les process du pool soient initialisés"""
+    _analysis_barrier.wait(timeout=120)
+    return os.getpid()
+
+
+def _analyze_shared_page(shm_name, shape, context):
+    """Exécuté dans un process d'analyse : recherche de zone sur une page en mémoire partagée"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    image = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    try:
+        return _analysis_worker.find_whitest_space(image, context)[0]
+    finally:
+        del image
+        shm.close()
+
+
+class AnalysisPool:
+    """
+    Pool de process pour l'analyse raster des pages (find_whitest_space), dont les boucles
+    de candidats en Python gardent le GIL et plafonnent le pool de threads à 2-3 cœurs.
+
+    Les process sont démarrés une fois pour toute la durée du serveur depuis un forkserver
+    qui a préchargé numpy, cv2 et fitz. Les pages rendues leur sont transmises par
+    multiprocessing.shared_memory : une copie dans le segment, aucune sérialisation du tableau.
+    """
+
+    PRELOAD = ["numpy", "cv2", "fitz"]
+
+    def __init__(self, processes):
+        """
+        Args:
+            processes (int): Nombre de process d'analyse
+        """
+        self.processes = processes
+        self._lock = threading.Lock()
+        self._executor = self._start()
+
+    def _start(self):
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(self.PRELOAD)
+        # Le pool ne crée un process que pour une tâche sans process libre : une tâche par process,
+        # retenue par la barrière, les démarre tous maintenant plutôt que pendant les premières requêtes
+        barrier = context.Barrier(self.processes)
+        executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=context,
+                                       initializer=_init_analysis_worker, initargs=(barrier,))
+        ready = [executor.submit(_analysis_worker_ready) for _ in range(self.processes)]
+        for future in ready:
+            future.result()
+        logging.info(f"Pool d'analyse démarré : {self.processes} process")
+        return executor
+
+    def find_whitest_space(self, image, context):
+        """
+        Équivalent de PDFProcessor.find_whitest_space exécuté dans un process du pool.
+
+        Returns:
+            dict: Coordonnées du tampon, ou None si aucune zone sûre (les masques ne sont pas renvoyés)
+        """
+        executor = self._executor
+        shm = shared_memory.SharedMemory(create=True, size=max(1, image.size))
+        try:
+            np.ndarray(image.shape, dtype=np.uint8, buffer=shm.buf)[:] = image
+            return executor.submit(_analyze_shared_page, shm.name, image.shape, context).result()
+        except BrokenProcessPool:
+            self._restart(executor)
+            raise
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def _restart(self, broken_executor):
+        """Remplace le pool après la mort d'un process (OOM...), une seule fois par panne"""
+        with self._lock:
+            if self._executor is broken_executor:
+                broken_executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._start()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
 class PDFProcessor:
     """
     Classe qui gère tout le traitement des PDFs : détection des espaces vides
     et ajout des tampons.
     """
 
-    def __init__(self, high_dpi=300, low_dpi=200, stamp_size_max=300, stamp_size_min=90, enable_debug=False):
+    def __init__(self, high_dpi=300, low_dpi=200, stamp_size_max=300, stamp_size_min=90, enable_debug=False,
+                 analysis_engine='auto', output_mode='raster', render_backend='fitz', raster_codec='flate',
+                 jpeg_quality=85, flate_level=6, spill_threshold=64 * 1024 * 1024, analysis_processes=0,
+                 page_workers=None, cpu_limit=None, adaptive_concurrency=False, native_threads=None,
+                 analysis_bands=1, page_scheduling=True):
         """
           Initialise le processeur PDF avec les paramètres nécessaires.
 
@@ -49,9 +1156,33 @@ class PDFProcessor:
               stamp_size_max (int): Taille maximale du tampon en pixels (par défaut 300)
               stamp_size_min (int): Taille minimale du tampon en pixels pour lisibilité (par défaut 90)
               enable_debug (bool): Active la sauvegarde des images de debug (activé par défaut)
+              analysis_engine (str): Moteur de placement : 'auto' (choix par page), 'raster' (OpenCV) ou 'vector' (géométrie PyMuPDF)
+              output_mode (str): Sortie 'raster' (pages rastérisées) ou 'overlay' (tampon ajouté au PDF original)
+              render_backend (str): Rendu des pages : 'fitz' (PyMuPDF en mémoire) ou 'pdf2image' (pdftoppm)
+              raster_codec (str): Codec des pages rastérisées en gris/couleur : 'flate' (sans perte) ou 'jpeg'.
+                  Les pages noir et blanc sont toujours encodées en CCITT G4 (1 bit).
+              jpeg_quality (int): Qualité JPEG (codec 'jpeg')
+              flate_level (int): Niveau zlib du codec 'flate'
+              spill_threshold (int): Taille (octets) au-delà de laquelle un PDF téléchargé ou produit
+                  passe de la mémoire à un fichier temporaire
+              analysis_processes (int): Nombre de process dédiés à l'analyse raster des pages
+                  (0 = analyse dans les threads de traitement)
+              page_workers (int): Threads de traitement des pages partagés par toutes les requêtes
+                  (None = 2 par CPU, 16 au plus)
+              cpu_limit (float): CPU attribués au processeur (None = quota et affinité du conteneur,
+                  voir detect_cpu_limit)
+              adaptive_concurrency (bool): Pages simultanées ajustées au débit mesuré et au bridage
+                  CPU (ConcurrencyController), page_workers n'étant plus qu'un plafond
+              native_threads (str | int): Threads internes d'OpenCV/BLAS : 'auto' (CPU répartis
+                  entre les pages en cours, voir NativeThreadPolicy), un nombre fixe, ou None
+                  (réglage des bibliothèques inchangé)
+              analysis_bands (int): Bandes analysées en parallèle au plus pour une page qui dispose
+                  de plusieurs CPU (requête d'une page, première page seule) ; 1 = page d'un bloc
+              page_scheduling (bool): False = processeur d'analyse seule (process du pool d'analyse),
+                  sans scheduler ni threads de pages
           """
         self.high_dpi = high_dpi
-        self.low_dpi = low_dpi  # DPI par défaut augmenté pour meilleure qualité
+        self.low_dpi = low_dpi  # DPI par défaut (voir create_context : adapté par requête)
         self.points_per_inch = 72
 
         self.stamp_size_max = stamp_size_max
@@ -59,9 +1190,158 @@ class PDFProcessor:
         self.margin = 10  # Marge de sécurité réduite en pixels (entre le carré extérieur et le tampon)
         self.enable_debug = enable_debug
         self.enable_ocr = False  # Désactiver OCR par défaut pour gagner en performance
-        self.max_workers = min(8, multiprocessing.cpu_count())  # Augmenté à 8 workers pour gros fichiers
-        self._stamp_cache = {}  # Cache pour les tampons redimensionnés
+        self.analysis_engine = analysis_engine
+        self.output_mode = output_mode
+        self.render_backend = render_backend
+        self.raster_codec = raster_codec
+        self.jpeg_quality = jpeg_quality
+        self.flate_level = flate_level
+        self.spill_threshold = spill_threshold
+        self._render_documents = {}  # Documents PyMuPDF ouverts par PDF en cours et par thread de rendu
+        self._render_lock = threading.Lock()
+        self.scan_image_coverage = 0.5  # Au-delà de 50% de la page couverte par des images : page scannée
+        self.max_vector_drawings = 5000  # Au-delà, la géométrie coûte plus cher qu'un rendu raster
+        # Pic mesuré de l'analyse raster d'une page (rendu, masques OpenCV, sortie) : 55 à 70 octets par pixel
+        self.page_bytes_per_pixel = 72
+        # CPU du conteneur (quota CFS, affinité), et non les cœurs de l'hôte
+        self.cpu_limit = cpu_limit or detect_cpu_limit()
+        self.max_workers = min(8, math.ceil(self.cpu_limit))
+        self.native_threads = None
+        if native_threads is not None:
+            fixed = 0 if native_threads == 'auto' else int(native_threads)
+            self.native_threads = NativeThreadPolicy(math.ceil(self.cpu_limit), fixed)
+        # Budget de pages en cours pour tout le process, quelle que soit la charge
+        self.page_scheduler = None
+        self.concurrency = None
+        if page_scheduling:
+            self.page_scheduler = PageScheduler(page_workers or min(16, max(2, math.ceil(self.cpu_limit) * 2)),
+                                                self.native_threads)
+            if adaptive_concurrency:
+                self.concurrency = ConcurrencyController(self.page_scheduler, self.cpu_limit)
+        # Analyse d'une page par bandes : au plus analysis_bands, selon la part des CPU laissée à la page
+        self.analysis_bands = analysis_bands
+        self._band_executor = None
+        if analysis_bands > 1:
+            self._band_executor = futures.ThreadPoolExecutor(max_workers=analysis_bands,
+                                                             thread_name_prefix="page-band")
+        self._stamp_cache = StampCache()  # Tampons redimensionnés, partagés entre requêtes
         self._kernel_cache = {}  # Cache pour les kernels OpenCV
+        self._analysis_pool = None
+        if analysis_processes:
+            self._analysis_pool = AnalysisPool(analysis_processes)
+
+    def default_context(self, **overrides):
+        """Contexte construit sur la configuration du processeur (DPI et workers par défaut)"""
+        values = dict(dpi=self.low_dpi, workers=self.max_workers, stamp_size_max=self.stamp_size_max,
+                      stamp_size_min=self.stamp_size_min, analysis_engine=self.analysis_engine,
+                      output_mode=self.output_mode, enable_debug=self.enable_debug)
+        values.update(overrides)
+        return ProcessingContext(**values)
+
+    @staticmethod
+    def _select_pages(num_pages, pages=None, stamp_only_first_page=False):
+        """Pages sélectionnées (voir parse_page_selection), None = toutes les pages"""
+        if pages:
+            return parse_page_selection(pages, num_pages)
+        if stamp_only_first_page:
+            return [1]
+        return None
+
+    def _request_settings(self, processed_pages):
+        """
+        Workers et DPI adaptés au nombre de pages traitées.
+        DPI réduit pour meilleure performance sans sacrifier trop la qualité. Les pages de
+        la requête peuvent occuper tous les workers du scheduler : le nombre de pages
+        exécutées simultanément est borné globalement (PageScheduler.limit, ajusté au débit
+        et au bridage CPU) et partagé à tour de rôle entre les requêtes.
+
+        Returns:
+            tuple: (workers, dpi, libellé)
+        """
+        workers = self.page_scheduler.workers
+        if processed_pages > 300:
+            # Gros fichier : DPI faible pour performance
+            dpi, label = 120, "Gros fichier"
+        elif processed_pages > 100:
+            # Fichier moyen : DPI moyen pour équilibre qualité/performance
+            dpi, label = 150, "Fichier moyen"
+        elif processed_pages > 20:
+            # Fichier petit-moyen : DPI correct (réduit de 250)
+            dpi, label = 150, "Fichier petit-moyen"
+        else:
+            # Petit fichier : DPI bon pour qualité (réduit de 250)
+            dpi, label = 200, "Petit fichier"
+        return workers, dpi, label
+
+    def create_context(self, processed_pages, output_mode=None, cancellation=None):
+        """
+        Contexte d'une requête : DPI et nombre de workers adaptés au nombre de pages traitées.
+
+        Args:
+            processed_pages (int): Nombre de pages à traiter
+            output_mode (str): Mode de sortie de la requête (None = valeur du processeur)
+            cancellation (CancellationToken): Abandon de la requête (None = jamais abandonnée)
+        """
+        workers, dpi, label = self._request_settings(processed_pages)
+        logging.info(f"{label} détecté ({processed_pages} pages) - {workers} workers, DPI {dpi}")
+        return self.default_context(dpi=dpi, workers=workers, output_mode=output_mode or self.output_mode,
+                                    cancellation=cancellation)
+
+    def estimate_peak_memory(self, pdf_path, stamp_only_first_page=False, output_mode=None, pages=None):
+        """
+        Pic mémoire estimé d'une requête, calculé avant tout rendu : les plus grandes pages
+        de la sélection en cours d'analyse simultanée au DPI retenu pour la requête, plus
+        la source et la sortie en mémoire. Mêmes paramètres que process_document.
+
+        Returns:
+            int: Estimation en octets
+        """
+        with open_pdf(pdf_path) as doc:
+            num_pages = doc.page_count
+            selection = self._select_pages(num_pages, pages, stamp_only_first_page)
+            page_numbers = selection or range(1, num_pages + 1)
+            # Surface en points², indépendante de la rotation
+            areas = sorted((doc.page_cropbox(n - 1).get_area() for n in page_numbers), reverse=True)
+
+        workers, dpi, _ = self._request_settings(len(areas))
+        in_flight = min(workers, self.page_scheduler.workers, len(areas))
+        pixels_per_point = (dpi / self.points_per_inch) ** 2
+        pages_bytes = int(sum(areas[:in_flight]) * pixels_per_point * self.page_bytes_per_pixel)
+
+        source_bytes = len(pdf_path) if is_in_memory(pdf_path) else os.path.getsize(pdf_path)
+        if selection is None and (output_mode or self.output_mode) == 'raster':
+            # Pages rastérisées : au plus un octet par pixel une fois encodées
+            output_bytes = int(sum(areas) * pixels_per_point)
+        else:
+            # Tampons superposés au document original
+            output_bytes = source_bytes
+        # Au-delà du seuil de bascule, la sortie est écrite dans un fichier temporaire
+        output_bytes = min(output_bytes, self.spill_threshold)
+
+        # Source et documents de rendu ouverts sur la source
+        return pages_bytes + 2 * source_bytes + output_bytes
+
+    def _receive(self, response):
+        """
+        Lit le corps d'une réponse HTTP en mémoire. Au-delà de self.spill_threshold octets,
+        le contenu bascule dans un fichier temporaire.
+
+        Returns:
+            bytes | str: Contenu en mémoire, ou chemin du fichier temporaire (à supprimer par l'appelant)
+        """
+        buffer = io.BytesIO()
+        spill_file = None
+        for chunk in response.iter_content(chunk_size=1024 * 1024):
+            if spill_file is None and buffer.tell() + len(chunk) > self.spill_threshold:
+                spill_file = tempfile.NamedTemporaryFile(delete=False)
+                spill_file.write(buffer.getbuffer())
+                buffer = None
+            (spill_file or buffer).write(chunk)
+        if spill_file is not None:
+            spill_file.close()
+            logging.info(f"Fichier volumineux écrit sur disque : {spill_file.name}")
+            return spill_file.name
+        return buffer.getvalue()
 
     def download_from_gdrive(self, file_id, access_token):
         """
@@ -72,7 +1352,7 @@ class PDFProcessor:
             access_token (str): Le jeton d'accès OAuth2 pour l'authentification
 
         Returns:
-            BytesIO: Le contenu du fichier sous forme de buffer
+            bytes | str: Contenu du fichier, ou chemin d'un fichier temporaire s'il dépasse self.spill_threshold
         """
         try:
             # Construction des en-têtes avec le token d'authentification
@@ -87,8 +1367,7 @@ class PDFProcessor:
             response = requests.get(url, headers=headers, stream=True)
             response.raise_for_status()
 
-            # Retourne le contenu sous forme de BytesIO
-            return io.BytesIO(response.content)
+            return self._receive(response)
 
         except requests.exceptions.RequestException as e:
             logging.error(f"Erreur lors du téléchargement depuis Google Drive: {str(e)}")
@@ -97,10 +1376,11 @@ class PDFProcessor:
     def download_file(self, url):
         """Télécharge un fichier depuis une URL."""
         try:
-            response = requests.get(url)
+            response = requests.get(url, stream=True)
             response.raise_for_status()
+            content = self._receive(response)
             logging.info(f"Téléchargement du fichier depuis {url} réussi")
-            return io.BytesIO(response.content)
+            return content
         except requests.exceptions.RequestException as e:
             logging.error(f"Erreur lors du téléchargement : {str(e)}")
             raise ValueError(f"Erreur lors du téléchargement : {str(e)}")
@@ -112,30 +1392,107 @@ class PDFProcessor:
                 'XClientId': 'broker-defense',
                 'Authorization': f'Bearer {ooDriveFile.accessToken}'
             }
-            response = requests.get(f"https://sharing.oodrive.com/share/api/v1/io/items/{ooDriveFile.id}", headers=headers)
+            response = requests.get(f"https://sharing.oodrive.com/share/api/v1/io/items/{ooDriveFile.id}", headers=headers,
+                                    stream=True)
             response.raise_for_status()
-            return io.BytesIO(response.content)
+            return self._receive(response)
         except requests.exceptions.RequestException as e:
             logging.error(f"Erreur lors du téléchargement depuis Oodrive: {str(e)}")
+            raise ValueError(f"Échec du téléchargement depuis Oodrive: {str(e)}")
+
+    async def _receive_async(self, response):
+        """
+        Version asyncio de _receive : lit le corps d'une réponse httpx en streaming, en mémoire
+        jusqu'à self.spill_threshold octets, au-delà dans un fichier temporaire.
+
+        Returns:
+            bytes | str: Contenu en mémoire, ou chemin du fichier temporaire (à supprimer par l'appelant)
+        """
+        buffer = io.BytesIO()
+        spill_file = None
+        try:
+            async for chunk in response.aiter_bytes(chunk_size=1024 * 1024):
+                if spill_file is None and buffer.tell() + len(chunk) > self.spill_threshold:
+                    spill_file = tempfile.NamedTemporaryFile(delete=False)
+                    spill_file.write(buffer.getbuffer())
+                    buffer = None
+                (spill_file or buffer).write(chunk)
+        except BaseException:
+            # Téléchargement interrompu (erreur réseau, requête annulée) : pas de fichier orphelin
+            if spill_file is not None:
+                spill_file.close()
+                os.remove(spill_file.name)
+            raise
+        if spill_file is not None:
+            spill_file.close()
+            logging.info(f"Fichier volumineux écrit sur disque : {spill_file.name}")
+            return spill_file.name
+        return buffer.getvalue()
+
+    async def _download_async(self, client, url, headers=None):
+        """Téléchargement en streaming avec le client httpx partagé"""
+        async with client.stream('GET', url, headers=headers) as response:
+            response.raise_for_status()
+            return await self._receive_async(response)
+
+    async def download_file_async(self, client, url):
+        """Télécharge un fichier depuis une URL (version asyncio de download_file)."""
+        try:
+            content = await self._download_async(client, url)
+            logging.info(f"Téléchargement du fichier depuis {url} réussi")
+            return content
+        except httpx.HTTPError as e:
+            logging.error(f"Erreur lors du téléchargement : {str(e)}")
+            raise ValueError(f"Erreur lors du téléchargement : {str(e)}")
+
+    async def download_from_gdrive_async(self, client, file_id, access_token):
+        """Télécharge un fichier depuis Google Drive (version asyncio de download_from_gdrive)."""
+        try:
+            return await self._download_async(client, f'https://www.googleapis.com/drive/v3/files/{file_id}?alt=media',
+                                              headers={'Authorization': f'Bearer {access_token}'})
+        except httpx.HTTPError as e:
+            logging.error(f"Erreur lors du téléchargement depuis Google Drive: {str(e)}")
+            raise ValueError(f"Échec du téléchargement depuis Google Drive: {str(e)}")
+
+    async def download_from_oodrive_async(self, client, ooDriveFile):
+        """Télécharge un fichier depuis Oodrive (version asyncio de download_from_oodrive)."""
+        try:
+            return await self._download_async(client,
+                                              f"https://sharing.oodrive.com/share/api/v1/io/items/{ooDriveFile.id}",
+                                              headers={'XClientId': 'broker-defense',
+                                                       'Authorization': f'Bearer {ooDriveFile.accessToken}'})
+        except httpx.HTTPError as e:
+            logging.error(f"Erreur lors du téléchargement depuis Oodrive: {str(e)}")
+            raise ValueError(f"Échec du téléchargement depuis Oodrive: {str(e)}")
+
+    def _page_bands(self):
+        """
+        Bandes d'analyse d'une page : les CPU non occupés par les autres pages en cours
+        (tous pour une page seule, aucun en plus pour un lot de pages).
+        """
+        if self._band_executor is None:
+            return 1
+        share = math.ceil(self.cpu_limit) // max(1, self.page_scheduler.concurrent_pages)
+        return max(1, min(self.analysis_bands, share))
 
     @lru_cache(maxsize=32)
     def _get_text_detection_kernel(self, size):
         """Cache les kernels pour éviter de les recréer"""
         return cv2.getStructuringElement(cv2.MORPH_RECT, size)
 
-    def find_whitest_space(self, image):
+    def find_whitest_space(self, image, context=None):
         """
         Trouve le meilleur emplacement pour un tampon en évitant absolument les zones de texte,
         images et QR codes. La taille du tampon est adaptative entre min et max.
         Version optimisée sans OCR par défaut.
+
+        Args:
+            image (np.ndarray): Page en niveaux de gris
+            context (ProcessingContext): Bornes du tampon (None = configuration du processeur)
         """
+        context = context or self.default_context()
         height, width = image.shape
 
-        # Tailles adaptatives du tampon
-        stamp_size_max = self.stamp_size_max
-        stamp_size_min = self.stamp_size_min
-        margin = self.margin
-
         # Créer des masques séparés pour chaque type d'élément détecté
         forbidden_mask = np.zeros((height, width), dtype=np.uint8)
         text_mask = np.zeros((height, width), dtype=np.uint8)
@@ -184,133 +1541,129 @@ class PDFProcessor:
                 logging.warning(f"OCR non disponible: {e}")
                 self.enable_ocr = False  # Désactiver pour les prochaines pages
 
+        # Page découpée en bandes recouvrantes analysées en parallèle quand elle dispose de
+        # plusieurs CPU (requête d'une page) : le recouvrement couvre l'empreinte des noyaux
+        bands = self._page_bands()
+        executor = self._band_executor
+
         if not self.enable_ocr:
-            # Détection améliorée par seuillage (plus sensible au texte)
-            _, binary = cv2.threshold(image, 220, 255, cv2.THRESH_BINARY)  # Seuil plus élevé pour détecter plus de texte
+            horizontal_kernel = self._get_text_detection_kernel((30, 1))  # Kernel plus petit pour être plus précis
+            vertical_kernel = self._get_text_detection_kernel((1, 15))
+            small_kernel = self._get_text_detection_kernel((3, 3))
+            dilate_kernel = self._get_text_detection_kernel((30, 15))  # Zone de protection réduite
 
-            # Inversion pour avoir le texte en blanc
-            inverted = 255 - binary
+            def detect_text(band):
+                # Détection améliorée par seuillage (plus sensible au texte)
+                _, binary = cv2.threshold(band, 220, 255, cv2.THRESH_BINARY)  # Seuil plus élevé pour détecter plus de texte
 
-            # Détection des composants connectés (texte et graphiques)
-            # Détection horizontale (lignes de texte)
-            horizontal_kernel = self._get_text_detection_kernel((30, 1))  # Kernel plus petit pour être plus précis
-            horizontal_lines = cv2.morphologyEx(inverted, cv2.MORPH_OPEN, horizontal_kernel)
+                # Inversion pour avoir le texte en blanc
+                inverted = 255 - binary
 
-            # Détection verticale (colonnes, tableaux)
-            vertical_kernel = self._get_text_detection_kernel((1, 15))
-            vertical_lines = cv2.morphologyEx(inverted, cv2.MORPH_OPEN, vertical_kernel)
+                # Détection des composants connectés (texte et graphiques)
+                # Détection horizontale (lignes de texte)
+                horizontal_lines = cv2.morphologyEx(inverted, cv2.MORPH_OPEN, horizontal_kernel)
 
-            # Détection des petits éléments (points, caractères isolés)
-            small_kernel = self._get_text_detection_kernel((3, 3))
-            small_elements = cv2.morphologyEx(inverted, cv2.MORPH_CLOSE, small_kernel)
+                # Détection verticale (colonnes, tableaux)
+                vertical_lines = cv2.morphologyEx(inverted, cv2.MORPH_OPEN, vertical_kernel)
 
-            # Combiner toutes les détections de texte
-            text_combined = cv2.bitwise_or(horizontal_lines, vertical_lines)
-            text_combined = cv2.bitwise_or(text_combined, small_elements)
+                # Détection des petits éléments (points, caractères isolés)
+                small_elements = cv2.morphologyEx(inverted, cv2.MORPH_CLOSE, small_kernel)
 
-            # Dilater modérément pour créer des zones de protection autour du texte
-            dilate_kernel = self._get_text_detection_kernel((30, 15))  # Zone de protection réduite
-            text_mask = cv2.dilate(text_combined, dilate_kernel, iterations=1)  # 1 itération au lieu de 2
+                # Combiner toutes les détections de texte
+                text_combined = cv2.bitwise_or(horizontal_lines, vertical_lines)
+                text_combined = cv2.bitwise_or(text_combined, small_elements)
+
+                # Dilater modérément pour créer des zones de protection autour du texte
+                return cv2.dilate(text_combined, dilate_kernel, iterations=1)  # 1 itération au lieu de 2
+
+            # Dépendance verticale : ouverture 1x15 (14 lignes) puis dilatation 30x15 (7 lignes)
+            text_mask = map_bands(executor, detect_text, image, bands, 24)
             forbidden_mask = cv2.bitwise_or(forbidden_mask, text_mask)
 
         # DÉTECTION DES LIGNES HORIZONTALES (traits de séparation, bordures de tableaux)
         # Ces lignes sont souvent manquées par la détection de texte car elles sont continues
         try:
-            # Seuiller pour détecter les lignes noires (seuil plus bas pour capturer les lignes fines)
-            _, line_binary = cv2.threshold(image, 200, 255, cv2.THRESH_BINARY_INV)
-            
-            # Détecter les lignes horizontales longues (traits de séparation)
-            # Utiliser plusieurs kernels de différentes longueurs pour détecter les lignes de différentes tailles
-            line_masks = []
-            
-            # Lignes très longues (au moins 1/3 de la largeur) - traits de séparation principaux
-            if width > 100:
-                kernel_long = self._get_text_detection_kernel((max(100, width // 3), 1))
-                lines_long = cv2.morphologyEx(line_binary, cv2.MORPH_OPEN, kernel_long)
-                line_masks.append(lines_long)
-            
-            # Lignes moyennes (au moins 1/5 de la largeur) - traits de séparation secondaires
-            if width > 60:
-                kernel_medium = self._get_text_detection_kernel((max(60, width // 5), 1))
-                lines_medium = cv2.morphologyEx(line_binary, cv2.MORPH_OPEN, kernel_medium)
-                line_masks.append(lines_medium)
-            
-            # Lignes courtes mais significatives (au moins 1/10 de la largeur) - bordures de tableaux
-            if width > 30:
-                kernel_short = self._get_text_detection_kernel((max(30, width // 10), 1))
-                lines_short = cv2.morphologyEx(line_binary, cv2.MORPH_OPEN, kernel_short)
-                line_masks.append(lines_short)
-            
-            # Combiner toutes les détections de lignes horizontales
-            detected_horizontal_lines = np.zeros((height, width), dtype=np.uint8)
-            for mask in line_masks:
-                detected_horizontal_lines = cv2.bitwise_or(detected_horizontal_lines, mask)
-            
-            # Dilater verticalement pour créer une zone de protection autour des lignes
-            # Les lignes peuvent être fines, on veut éviter de placer le tampon même près d'elles
+            # Une ouverture par un segment garde les segments de pixels au moins aussi longs : l'union
+            # des lignes longues (1/3 de la largeur), moyennes (1/5) et courtes (1/10, bordures de
+            # tableaux) est l'ouverture par le segment le plus court
             line_dilate_kernel = self._get_text_detection_kernel((1, 15))  # Dilater de 15px verticalement (7-8px de chaque côté)
-            detected_horizontal_lines = cv2.dilate(detected_horizontal_lines, line_dilate_kernel, iterations=1)
-            
+
+            def detect_horizontal_lines(band):
+                # Seuiller pour détecter les lignes noires (seuil plus bas pour capturer les lignes fines)
+                _, line_binary = cv2.threshold(band, 200, 255, cv2.THRESH_BINARY_INV)
+                if width > 30:
+                    kernel_short = self._get_text_detection_kernel((max(30, width // 10), 1))
+                    lines = cv2.morphologyEx(line_binary, cv2.MORPH_OPEN, kernel_short)
+                else:
+                    lines = np.zeros_like(line_binary)
+                # Dilater verticalement pour créer une zone de protection autour des lignes
+                # Les lignes peuvent être fines, on veut éviter de placer le tampon même près d'elles
+                return cv2.dilate(lines, line_dilate_kernel, iterations=1)
+
+            # Ouverture ligne par ligne, seule la dilatation dépend des lignes voisines
+            detected_horizontal_lines = map_bands(executor, detect_horizontal_lines, image, bands, 8)
+
             # Ajouter au masque interdit
             forbidden_mask = cv2.bitwise_or(forbidden_mask, detected_horizontal_lines)
-            
-            # Détecter aussi les lignes verticales longues (bordures de colonnes)
-            vertical_line_masks = []
-            
-            if height > 100:
-                vertical_kernel_long = self._get_text_detection_kernel((1, max(100, height // 3)))
-                vertical_lines_long = cv2.morphologyEx(line_binary, cv2.MORPH_OPEN, vertical_kernel_long)
-                vertical_line_masks.append(vertical_lines_long)
-            
-            if height > 60:
-                vertical_kernel_medium = self._get_text_detection_kernel((1, max(60, height // 5)))
-                vertical_lines_medium = cv2.morphologyEx(line_binary, cv2.MORPH_OPEN, vertical_kernel_medium)
-                vertical_line_masks.append(vertical_lines_medium)
-            
-            # Combiner les lignes verticales
-            detected_vertical_lines = np.zeros((height, width), dtype=np.uint8)
-            for mask in vertical_line_masks:
-                detected_vertical_lines = cv2.bitwise_or(detected_vertical_lines, mask)
-            
-            # Dilater horizontalement pour créer une zone de protection
+
+            # Détecter aussi les lignes verticales longues (bordures de colonnes) : union des lignes
+            # longues (1/3 de la hauteur) et moyennes (1/5), soit l'ouverture par la plus courte
             vertical_line_dilate_kernel = self._get_text_detection_kernel((15, 1))  # Dilater de 15px horizontalement
-            detected_vertical_lines = cv2.dilate(detected_vertical_lines, vertical_line_dilate_kernel, iterations=1)
-            
+
+            def detect_vertical_lines(band):
+                _, line_binary = cv2.threshold(band, 200, 255, cv2.THRESH_BINARY_INV)
+                if height > 60:
+                    vertical_kernel_medium = self._get_text_detection_kernel((1, max(60, height // 5)))
+                    lines = cv2.morphologyEx(line_binary, cv2.MORPH_OPEN, vertical_kernel_medium)
+                else:
+                    lines = np.zeros_like(line_binary)
+                # Dilater horizontalement pour créer une zone de protection
+                return cv2.dilate(lines, vertical_line_dilate_kernel, iterations=1)
+
+            # Ouverture colonne par colonne : bandes verticales
+            detected_vertical_lines = map_bands(executor, detect_vertical_lines, image, bands, 8, axis=1)
+
             # Ajouter au masque interdit
             forbidden_mask = cv2.bitwise_or(forbidden_mask, detected_vertical_lines)
-            
-            logging.debug(f"Détection des lignes: {np.sum(detected_horizontal_lines > 0)} pixels horizontaux, {np.sum(detected_vertical_lines > 0)} pixels verticaux")
-            
+
+            logging.debug(f"Détection des lignes: {cv2.countNonZero(detected_horizontal_lines)} pixels horizontaux, {cv2.countNonZero(detected_vertical_lines)} pixels verticaux")
+
         except Exception as e:
             logging.warning(f"Erreur lors de la détection des lignes: {e}")
 
         # DÉTECTION DES IMAGES (zones avec beaucoup de variations de gris)
         # Les images ont généralement plus de variations que le texte simple
-        blurred = cv2.GaussianBlur(image, (5, 5), 0)
-        laplacian = cv2.Laplacian(blurred, cv2.CV_64F)
-        laplacian_abs = np.abs(laplacian)
-        
-        # Seuiller pour trouver les zones avec beaucoup de détails (images)
-        _, image_detection = cv2.threshold(laplacian_abs.astype(np.uint8), 30, 255, cv2.THRESH_BINARY)
-        
+        def detect_details(band):
+            blurred = cv2.GaussianBlur(band, (5, 5), 0)
+            laplacian = cv2.Laplacian(blurred, cv2.CV_64F)
+            laplacian_abs = np.abs(laplacian)
+
+            # Seuiller pour trouver les zones avec beaucoup de détails (images)
+            _, detection = cv2.threshold(laplacian_abs.astype(np.uint8), 30, 255, cv2.THRESH_BINARY)
+            return detection
+
+        # Flou 5x5 puis Laplacien 3x3 : 3 lignes de dépendance
+        image_detection = map_bands(executor, detect_details, image, bands, 8)
+
         # Filtrer les grandes zones (probablement des images, pas du texte)
         # Le texte a généralement des zones plus petites et linéaires
         contours, _ = cv2.findContours(image_detection, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         min_image_area = 5000  # Surface minimale pour considérer une zone comme image
-        
+
+        # Zones remplies une à une puis dilatées en une fois : la dilatation de l'union est
+        # l'union des dilatations
+        image_fill = np.zeros((height, width), dtype=np.uint8)
+        image_found = False
         for contour in contours:
             area = cv2.contourArea(contour)
             if area > min_image_area:
-                # Créer un masque pour cette zone d'image
-                contour_mask = np.zeros((height, width), dtype=np.uint8)
-                cv2.fillPoly(contour_mask, [contour], 255)
-                
-                # Dilater pour créer une zone de protection réduite
-                image_dilate_kernel = self._get_text_detection_kernel((30, 30))
-                contour_mask = cv2.dilate(contour_mask, image_dilate_kernel, iterations=1)
-                
-                image_mask = cv2.bitwise_or(image_mask, contour_mask)
-                forbidden_mask = cv2.bitwise_or(forbidden_mask, contour_mask)
+                cv2.fillPoly(image_fill, [contour], 255)
+                image_found = True
+        if image_found:
+            # Dilater pour créer une zone de protection réduite
+            image_dilate_kernel = self._get_text_detection_kernel((30, 30))
+            image_mask = cv2.dilate(image_fill, image_dilate_kernel, iterations=1)
+            forbidden_mask = cv2.bitwise_or(forbidden_mask, image_mask)
 
         # DÉTECTION DES QR CODES (patterns carrés répétitifs)
         # Les QR codes ont des patterns caractéristiques : carrés noirs/blancs alternés
@@ -318,7 +1671,9 @@ class PDFProcessor:
             # Détecter les contours carrés (caractéristiques des QR codes)
             _, qr_binary = cv2.threshold(image, 128, 255, cv2.THRESH_BINARY)
             qr_contours, _ = cv2.findContours(qr_binary, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-            
+
+            qr_fill = np.zeros((height, width), dtype=np.uint8)
+            qr_found = False
             # Filtrer les contours qui ressemblent à des QR codes (carrés imbriqués)
             for contour in qr_contours:
                 area = cv2.contourArea(contour)
@@ -327,7 +1682,7 @@ class PDFProcessor:
                     # Vérifier si c'est approximativement carré
                     x, y, w, h = cv2.boundingRect(contour)
                     aspect_ratio = float(w) / h if h > 0 else 0
-                    
+
                     # Les QR codes sont généralement proches du carré (ratio entre 0.7 et 1.3)
                     if 0.7 < aspect_ratio < 1.3:
                         # Vérifier la densité de pixels (QR codes ont beaucoup de variations)
@@ -337,27 +1692,46 @@ class PDFProcessor:
                             # Les QR codes ont une variance élevée (beaucoup de noir/blanc)
                             if std_dev > 40:
                                 # Marquer cette zone comme QR code potentiel
-                                qr_mask = np.zeros((height, width), dtype=np.uint8)
-                                cv2.fillPoly(qr_mask, [contour], 255)
-                                
-                                # Dilater modérément autour des QR codes
-                                qr_dilate_kernel = self._get_text_detection_kernel((40, 40))
-                                qr_mask = cv2.dilate(qr_mask, qr_dilate_kernel, iterations=1)
-                                
-                                qrcode_mask = cv2.bitwise_or(qrcode_mask, qr_mask)
-                                forbidden_mask = cv2.bitwise_or(forbidden_mask, qr_mask)
+                                cv2.fillPoly(qr_fill, [contour], 255)
+                                qr_found = True
+            if qr_found:
+                # Dilater modérément autour des QR codes
+                qr_dilate_kernel = self._get_text_detection_kernel((40, 40))
+                qrcode_mask = cv2.dilate(qr_fill, qr_dilate_kernel, iterations=1)
+                forbidden_mask = cv2.bitwise_or(forbidden_mask, qrcode_mask)
         except Exception as e:
             logging.warning(f"Erreur lors de la détection des QR codes: {e}")
 
+        # Créer une image binaire pour détecter les zones blanches
+        _, white_binary = cv2.threshold(image, 245, 255, cv2.THRESH_BINARY)  # Seuil plus strict pour le blanc
+
         # ÉTAPE 2 : RECHERCHE ADAPTATIVE DE ZONES BLANCHES
+        coords = self._find_stamp_position(forbidden_mask, white_binary, context)
+        return coords, forbidden_mask, text_mask, image_mask, qrcode_mask
+
+    def _find_stamp_position(self, forbidden_mask, white_binary, context):
+        """
+        Recherche adaptative de la zone du tampon à partir des masques d'occupation,
+        quel que soit le moteur qui les a produits (raster OpenCV ou géométrie vectorielle).
+
+        Args:
+            forbidden_mask (np.ndarray): Masque des zones interdites (255 = contenu)
+            white_binary (np.ndarray): Image binaire des pixels blancs (255 = blanc)
+            context (ProcessingContext): Bornes de taille du tampon
+
+        Returns:
+            dict: Position {"x", "y", "size", "stamp_size"} en pixels
+        """
+        height, width = forbidden_mask.shape
+
+        # Tailles adaptatives du tampon
+        stamp_size_max = context.stamp_size_max
+        stamp_size_min = context.stamp_size_min
+
         # Le tampon utilisera toute la taille disponible dans la zone trouvée (moins une petite marge minimale)
-        
         # Marge minimale pour éviter les bords (très réduite)
         min_margin = 5  # Marge minimale de sécurité en pixels
 
-        # Créer une image binaire pour détecter les zones blanches
-        _, white_binary = cv2.threshold(image, 245, 255, cv2.THRESH_BINARY)  # Seuil plus strict pour le blanc
-
         # Essayer différentes tailles de zone de recherche (de max à min)
         # Priorité : trouver la zone la plus grande possible dans la fourchette 200-300px
         # Le tampon utilisera toute la zone disponible jusqu'à 300px max
@@ -373,125 +1747,60 @@ class PDFProcessor:
 
         logging.info(f"Recherche de zones libres - Tailles testées: {search_sizes_to_try[:5]}...{search_sizes_to_try[-3:]} (tampon: {stamp_size_min}-{stamp_size_max}px)")
 
-        # Pour chaque taille de zone, chercher une zone libre
-        # PRIORITÉ : Arrêter dès qu'on trouve une zone de taille maximale (300px)
+        # Carte du plus grand carré libre ancré en chaque pixel : la plus grande zone
+        # utilisable se lit en un seul argmax, puis chaque taille s'interroge sans rebalayer la page
+        square_map = FreeSquareMap(forbidden_mask, white_binary, max_zone_size, self._band_executor,
+                                   self._page_bands())
+        largest_x, largest_y, largest_size = square_map.largest_square()
+        logging.debug(f"Plus grand carré libre: {largest_size}px à ({largest_x}, {largest_y})")
+
+        # PRIORITÉ : la plus grande taille qui possède une zone libre et blanche l'emporte,
+        # à la première position rencontrée en balayage ligne par ligne
         best_position = None
-        best_stamp_size = 0
-        
-        for square_size in search_sizes_to_try:
-            # Si on a déjà trouvé une zone maximale (300px), arrêter immédiatement
-            if best_stamp_size >= stamp_size_max:
-                break
-                
-            # Calculer la zone de recherche effective
-            search_width = width - square_size
-            search_height = height - square_size
 
-            if search_width <= 0 or search_height <= 0:
-                # Taille trop grande pour cette page, essayer la suivante
+        for square_size in search_sizes_to_try:
+            # Aucune zone libre de cette taille sur la page : inutile de l'interroger
+            if square_size > largest_size:
                 continue
 
-            # RECHERCHE OPTIMISÉE : Pas adaptatif selon la taille de zone
-            # Pour les grandes zones (proche de 300px), utiliser un pas plus petit pour ne rien rater
-            if square_size >= stamp_size_max + 2 * min_margin - 20:  # Zones proches du max
-                step = max(5, square_size // 30)  # Pas très fin pour grandes zones
-            else:
-                step = max(10, square_size // 20)  # Pas moyen pour zones moyennes
-            
-            logging.debug(f"Recherche zone {square_size}px avec pas de {step}px")
-
-            # Recherche avec pas adaptatif
-            for y in range(0, search_height, step):
-                for x in range(0, search_width, step):
-
-                    # VÉRIFICATION STRICTE : Aucune zone interdite tolérée
-                    roi_forbidden = forbidden_mask[y:y + square_size, x:x + square_size]
+            # Calculer la taille du tampon : utiliser toute la zone disponible
+            # Limiter à stamp_size_max (300px) et vérifier le minimum (200px)
+            available_stamp_size = min(square_size - 2 * min_margin, stamp_size_max)
+            if available_stamp_size < stamp_size_min:
+                continue
 
-                    if np.sum(roi_forbidden) == 0:  # ZÉRO pixel interdit - STRICTE
-                        # Vérifier que la zone est bien blanche
-                        roi_white = white_binary[y:y + square_size, x:x + square_size]
-                        white_ratio = np.mean(roi_white) / 255.0
+            # Pour les grandes zones, assouplir légèrement le critère de blancheur (95% au lieu de 98%)
+            white_threshold = 0.95 if square_size >= stamp_size_max + 2 * min_margin - 20 else 0.98
+            position = square_map.best_position(square_size, white_threshold)
+            if position is None:
+                continue
 
-                        # Pour les grandes zones, assouplir légèrement le critère de blancheur (95% au lieu de 98%)
-                        white_threshold = 0.95 if square_size >= stamp_size_max + 2 * min_margin - 20 else 0.98
-                        if white_ratio > white_threshold:
-                            # Calculer la taille du tampon : utiliser toute la zone disponible
-                            # Limiter à stamp_size_max (300px) et vérifier le minimum (200px)
-                            available_stamp_size = min(square_size - 2 * min_margin, stamp_size_max)
-                            # Vérifier que la taille minimale est respectée
-                            if available_stamp_size >= stamp_size_min:
-                                # Si c'est la taille maximale (300px), arrêter immédiatement
-                                if available_stamp_size >= stamp_size_max:
-                                    best_position = (x, y, white_ratio, available_stamp_size, square_size)
-                                    best_stamp_size = available_stamp_size
-                                    logging.info(f"Zone maximale (300px) trouvée immédiatement à ({x}, {y}) - Taille zone: {square_size}px - Taille tampon: {available_stamp_size}px")
-                                    break
-                                
-                                # Sinon, garder la meilleure trouvée jusqu'à présent
-                                if available_stamp_size > best_stamp_size:
-                                    best_position = (x, y, white_ratio, available_stamp_size, square_size)
-                                    best_stamp_size = available_stamp_size
-                                    logging.debug(f"Meilleure zone trouvée: {square_size}px -> tampon {available_stamp_size}px à ({x}, {y})")
-                    
-                    # Sortir de la boucle x si on a trouvé la taille maximale (300px)
-                    if best_stamp_size >= stamp_size_max:
-                        break
-                
-                # Sortir de la boucle y si on a trouvé la taille maximale (300px)
-                if best_stamp_size >= stamp_size_max:
-                    break
-            
-            # Sortir de la boucle square_size si on a trouvé la taille maximale (300px)
-            if best_stamp_size >= stamp_size_max:
-                break
+            best_position = position + (available_stamp_size, square_size)
+            if available_stamp_size >= stamp_size_max:
+                logging.info(f"Zone maximale (300px) trouvée immédiatement à ({position[0]}, {position[1]}) - Taille zone: {square_size}px - Taille tampon: {available_stamp_size}px")
+            # Les tailles suivantes sont plus petites : elles ne peuvent pas donner un tampon plus grand
+            break
 
         # Si on a trouvé une position, l'utiliser
         if best_position:
             best_x, best_y, best_white, found_stamp_size, found_square_size = best_position
-            
-            # Affiner la recherche autour de la meilleure position trouvée (seulement pour la taille trouvée)
-            # Réduire le rayon d'affinage pour performance
-            refine_radius = 5  # Réduit de 10 à 5
-            best_refined = None
-            best_refined_stamp_size = found_stamp_size
-            
-            search_width = width - found_square_size
-            search_height = height - found_square_size
-            
-            if search_width > 0 and search_height > 0:
-                # Recherche fine autour de la meilleure position (pas de 2px pour performance)
-                fine_step = 2  # Augmenté de 1 à 2 pour performance
-                for y in range(max(0, best_y - refine_radius), min(search_height, best_y + refine_radius + 1), fine_step):
-                    for x in range(max(0, best_x - refine_radius), min(search_width, best_x + refine_radius + 1), fine_step):
-                        roi_forbidden = forbidden_mask[y:y + found_square_size, x:x + found_square_size]
-                        if np.sum(roi_forbidden) == 0:
-                            roi_white = white_binary[y:y + found_square_size, x:x + found_square_size]
-                            white_ratio = np.mean(roi_white) / 255.0
-                            if white_ratio > 0.98:
-                                # Utiliser toute la zone disponible, limitée à 300px max
-                                available_stamp_size = min(found_square_size - 2 * min_margin, stamp_size_max)
-                                if available_stamp_size >= stamp_size_min:
-                                    if available_stamp_size > best_refined_stamp_size:
-                                        best_refined_stamp_size = available_stamp_size
-                                        best_refined = (x, y, white_ratio, available_stamp_size, found_square_size)
-            
-            # Utiliser la position affinée si meilleure, sinon la position originale
-            if best_refined and best_refined_stamp_size > found_stamp_size:
-                best_x, best_y, best_white, found_stamp_size, found_square_size = best_refined
-                logging.info(f"Zone optimale trouvée (affinée) à ({best_x}, {best_y}) - Taille zone: {found_square_size}px - Taille tampon: {found_stamp_size}px - Blancheur: {best_white:.3f}")
-            else:
-                logging.info(f"Zone optimale trouvée à ({best_x}, {best_y}) - Taille zone: {found_square_size}px - Taille tampon: {found_stamp_size}px - Blancheur: {best_white:.3f}")
-            
+            # La carte couvre toutes les positions au pixel près : pas d'affinage nécessaire
+            logging.info(f"Zone optimale trouvée à ({best_x}, {best_y}) - Taille zone: {found_square_size}px - Taille tampon: {found_stamp_size}px - Blancheur: {best_white:.3f}")
+
             return {
                 "x": float(best_x),
                 "y": float(best_y),
                 "size": float(found_square_size),
                 "stamp_size": float(found_stamp_size)
-            }, forbidden_mask, text_mask, image_mask, qrcode_mask
+            }
 
         # AUCUNE ZONE TOTALEMENT LIBRE TROUVÉE
         logging.warning("Aucune zone totalement libre trouvée - Passage au fallback")
 
+        # Les phases de secours mesurent des ratios : images intégrales pour des lookups O(1)
+        forbidden_sat = SummedAreaTable(forbidden_mask)
+        white_sat = square_map.white_sat
+
         # FALLBACK : Chercher dans les coins avec recherche adaptative de taille
         # Le tampon utilisera toute la taille disponible dans la zone trouvée
         corner_positions_base = [
@@ -528,11 +1837,8 @@ class PDFProcessor:
                     corner_x + square_size <= width and corner_y + square_size <= height):
 
                     # Analyser cette position de coin
-                    roi_forbidden = forbidden_mask[corner_y:corner_y + square_size, corner_x:corner_x + square_size]
-                    roi_white = white_binary[corner_y:corner_y + square_size, corner_x:corner_x + square_size]
-
-                    forbidden_ratio = np.sum(roi_forbidden) / (square_size * square_size)
-                    white_ratio = np.mean(roi_white) / 255.0
+                    forbidden_ratio = forbidden_sat.window_sum(corner_x, corner_y, square_size) / (square_size * square_size)
+                    white_ratio = white_sat.window_sum(corner_x, corner_y, square_size) / (square_size * square_size) / 255.0
 
                     # Priorité 1: Zéro zone interdite (strict)
                     # Priorité 2: Taille maximale (300px)
@@ -572,7 +1878,7 @@ class PDFProcessor:
 
         if best_corner:
             logging.warning(f"Position de fallback choisie - Taille zone: {best_corner['size']}px - Taille tampon: {best_stamp_size}px - Zones interdites: {best_forbidden_ratio*100:.1f}% - Blancheur: {best_white_ratio:.3f}")
-            return best_corner, forbidden_mask, text_mask, image_mask, qrcode_mask
+            return best_corner
 
         # 4. POSITIONS DE SECOURS avec recherche adaptative
         # Le tampon utilisera toute la taille disponible dans la zone trouvée
@@ -604,13 +1910,10 @@ class PDFProcessor:
                     x + square_size <= width and y + square_size <= height):
 
                     # VALIDATION ULTRA-STRICTE même pour les positions de secours
-                    roi_forbidden = forbidden_mask[y:y + square_size, x:x + square_size]
-
                     # AUCUN chevauchement autorisé, même en fallback
-                    if np.sum(roi_forbidden) == 0:
+                    if forbidden_sat.window_sum(x, y, square_size) == 0:
                         # Vérification supplémentaire de la blancheur
-                        roi_white = white_binary[y:y + square_size, x:x + square_size]
-                        white_ratio = np.mean(roi_white) / 255.0
+                        white_ratio = white_sat.window_sum(x, y, square_size) / (square_size * square_size) / 255.0
 
                         # Même en fallback, exiger 95% de blanc minimum
                         if white_ratio > 0.95:
@@ -630,7 +1933,7 @@ class PDFProcessor:
 
         if best_fallback:
             logging.info(f"Position de secours trouvée - Taille zone: {best_fallback['size']}px - Taille tampon: {best_fallback_stamp_size}px")
-            return best_fallback, forbidden_mask, text_mask, image_mask, qrcode_mask
+            return best_fallback
 
         # DERNIER RECOURS: Si aucune position sûre n'est trouvée
         # Calculer le pourcentage de contenu de la page
@@ -663,15 +1966,11 @@ class PDFProcessor:
                 if (emergency_x >= 0 and emergency_y >= 0 and
                     emergency_x + square_size <= width and emergency_y + square_size <= height):
 
-                    roi_forbidden = forbidden_mask[emergency_y:emergency_y + square_size,
-                                                 emergency_x:emergency_x + square_size]
-                    forbidden_ratio = np.sum(roi_forbidden) / (square_size * square_size)
+                    forbidden_ratio = forbidden_sat.window_sum(emergency_x, emergency_y, square_size) / (square_size * square_size)
 
                     # Essayer d'abord SANS chevauchement
                     if forbidden_ratio == 0:
-                        roi_white = white_binary[emergency_y:emergency_y + square_size,
-                                               emergency_x:emergency_x + square_size]
-                        white_ratio = np.mean(roi_white) / 255.0
+                        white_ratio = white_sat.window_sum(emergency_x, emergency_y, square_size) / (square_size * square_size) / 255.0
 
                         if white_ratio > 0.95:
                             available_stamp_size = min(square_size - 2 * min_margin, stamp_size_max)
@@ -689,7 +1988,7 @@ class PDFProcessor:
 
         if best_emergency and best_emergency_overlap == 0.0:
             logging.info(f"Position d'urgence sans chevauchement trouvée - Taille zone: {best_emergency['size']}px - Taille tampon: {best_emergency_stamp_size}px")
-            return best_emergency, forbidden_mask, text_mask, image_mask, qrcode_mask
+            return best_emergency
 
         # FALLBACK ULTIME : Autoriser un chevauchement MINIMAL (5-10%) dans les coins
         # Toujours trouver une zone pour placer le tampon
@@ -712,15 +2011,11 @@ class PDFProcessor:
                 if (emergency_x >= 0 and emergency_y >= 0 and
                     emergency_x + square_size <= width and emergency_y + square_size <= height):
 
-                    roi_forbidden = forbidden_mask[emergency_y:emergency_y + square_size,
-                                                 emergency_x:emergency_x + square_size]
-                    forbidden_ratio = np.sum(roi_forbidden) / (square_size * square_size)
+                    forbidden_ratio = forbidden_sat.window_sum(emergency_x, emergency_y, square_size) / (square_size * square_size)
 
                     # Autoriser jusqu'à 10% de chevauchement
                     if forbidden_ratio <= MAX_ALLOWED_OVERLAP:
-                        roi_white = white_binary[emergency_y:emergency_y + square_size,
-                                               emergency_x:emergency_x + square_size]
-                        white_ratio = np.mean(roi_white) / 255.0
+                        white_ratio = white_sat.window_sum(emergency_x, emergency_y, square_size) / (square_size * square_size) / 255.0
 
                         # Critère de blancheur plus souple (90% au lieu de 95%)
                         if white_ratio > 0.90:
@@ -753,7 +2048,7 @@ class PDFProcessor:
         if best_emergency:
             overlap_percent = best_emergency_overlap * 100
             logging.warning(f"Position d'urgence avec chevauchement minimal trouvée - Taille zone: {best_emergency['size']}px - Taille tampon: {best_emergency_stamp_size}px - Chevauchement: {overlap_percent:.1f}%")
-            return best_emergency, forbidden_mask, text_mask, image_mask, qrcode_mask
+            return best_emergency
 
         # SI VRAIMENT AUCUNE POSITION N'EST TROUVÉE (cas extrêmement rare)
         # Placer dans le coin haut droite par défaut avec la taille minimale
@@ -785,9 +2080,150 @@ class PDFProcessor:
             forced_overlap = np.sum(roi_forbidden) / actual_size * 100
             logging.warning(f"Position forcée dans le coin haut droite - Chevauchement: {forced_overlap:.1f}%")
 
-        return forced_position, forbidden_mask, text_mask, image_mask, qrcode_mask
+        return forced_position
+
+    def classify_page(self, page):
+        """
+        Classifieur rapide raster/vectoriel d'une page, sans rendu : présence d'une couche
+        texte, couverture de la page par des images et nombre de tracés.
+
+        Une page scannée (image couvrant la page, avec ou sans couche OCR) ou une page
+        de dessin très chargée part vers le moteur raster ; les pages natives vers le
+        moteur vectoriel.
+
+        Args:
+            page (fitz.Page): Page du document source
+
+        Returns:
+            str: 'vector' ou 'raster'
+        """
+        page_area = abs(page.rect)
+        if page_area <= 0:
+            return 'raster'
+
+        image_area = 0.0
+        for info in page.get_image_info():
+            image_area += abs(fitz.Rect(info["bbox"]) & page.rect)
+        image_coverage = min(1.0, image_area / page_area)
+
+        has_text = bool(page.get_text("text").strip())
+        drawing_count = len(page.get_cdrawings())
+
+        if image_coverage >= self.scan_image_coverage:
+            engine = 'raster'
+        elif drawing_count > self.max_vector_drawings:
+            engine = 'raster'
+        elif not has_text and image_area > 0:
+            # Fragments scannés sans couche texte : seul le raster voit leur contenu réel
+            engine = 'raster'
+        else:
+            engine = 'vector'
+
+        logging.debug(f"Classification page {page.number + 1}: texte={has_text}, images={image_coverage*100:.1f}%, "
+                      f"tracés={drawing_count} -> {engine}")
+        return engine
+
+    def find_whitest_space_vector(self, page, context):
+        """
+        Équivalent vectoriel de find_whitest_space pour les PDF natifs : l'occupation
+        de la page est construite à partir de la géométrie PyMuPDF (spans de texte,
+        tracés, images) au lieu d'une rastérisation analysée par OpenCV.
+        Les masques sont produits à l'échelle `context.dpi` pour réutiliser les mêmes règles
+        de taille et de marge que le moteur raster.
+
+        Args:
+            page (fitz.Page): Page du document source
+            context (ProcessingContext): Résolution des masques (identique à celle du moteur
+                raster) et bornes du tampon
+
+        Returns:
+            tuple: (coords, forbidden_mask, text_mask, image_mask, qrcode_mask)
+        """
+        scale = context.dpi / self.points_per_inch
+        # Coordonnées PyMuPDF (page non tournée) -> pixels de la page affichée
+        to_pixels = page.rotation_matrix * fitz.Matrix(scale, scale)
+        page_box = (page.rect * fitz.Matrix(scale, scale)).irect
+        height, width = page_box.height, page_box.width
 
-    def save_debug_image(self, image, forbidden_mask, stamp_position, page_num, output_dir="/app/debug", 
+        forbidden_mask = np.zeros((height, width), dtype=np.uint8)
+        text_mask = np.zeros((height, width), dtype=np.uint8)
+        image_mask = np.zeros((height, width), dtype=np.uint8)
+        qrcode_mask = np.zeros((height, width), dtype=np.uint8)
+        # Pixels réellement occupés (sans zone de protection) pour le critère de blancheur
+        content_mask = np.zeros((height, width), dtype=np.uint8)
+
+        def mark(mask, rect, pad_x, pad_y):
+            box = fitz.Rect(rect) * to_pixels
+            x0 = max(0, int(box.x0) - pad_x)
+            y0 = max(0, int(box.y0) - pad_y)
+            x1 = min(width, int(np.ceil(box.x1)) + pad_x)
+            y1 = min(height, int(np.ceil(box.y1)) + pad_y)
+            if x1 > x0 and y1 > y0:
+                mask[y0:y1, x0:x1] = 255
+
+        def mark_segment(p1, p2, thickness, pad):
+            a = fitz.Point(p1) * to_pixels
+            b = fitz.Point(p2) * to_pixels
+            points = (int(round(a.x)), int(round(a.y))), (int(round(b.x)), int(round(b.y)))
+            cv2.line(content_mask, *points, 255, max(1, thickness))
+            cv2.line(forbidden_mask, *points, 255, max(1, thickness) + 2 * pad)
+
+        # TEXTE : boîtes des spans, avec au moins la zone de protection de la dilatation (30, 15) du raster
+        text_flags = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+        for block in page.get_text("dict", flags=text_flags)["blocks"]:
+            for line in block.get("lines", []):
+                for span in line["spans"]:
+                    if span["text"].strip():
+                        mark(text_mask, span["bbox"], 16, 8)
+                        mark(content_mask, span["bbox"], 0, 0)
+
+        # TRACÉS : traits de séparation, bordures de tableaux, aplats
+        # Le raster protège les traits par la dilatation du texte (30, 15) puis celle des lignes (15) :
+        # on retient la plus large des deux autour de chaque trait
+        line_pad = 16
+        for path in page.get_drawings():
+            fill = path.get("fill")
+            stroke = path.get("color")
+            # Les aplats blancs (fonds de page) ne sont pas du contenu
+            if fill is not None and min(fill) < 0.96:
+                mark(forbidden_mask, path["rect"], line_pad, line_pad)
+                mark(content_mask, path["rect"], 0, 0)
+            if stroke is None:
+                continue
+            thickness = int(np.ceil((path.get("width") or 1) * scale))
+            # Seul le trait est interdit : l'intérieur d'un cadre reste disponible
+            for item in path["items"]:
+                kind = item[0]
+                if kind == "l":
+                    mark_segment(item[1], item[2], thickness, line_pad)
+                elif kind == "re":
+                    corners = fitz.Rect(item[1]).quad
+                    for p1, p2 in ((corners.ul, corners.ur), (corners.ur, corners.lr),
+                                   (corners.lr, corners.ll), (corners.ll, corners.ul)):
+                        mark_segment(p1, p2, thickness, line_pad)
+                elif kind == "qu":
+                    quad = item[1]
+                    for p1, p2 in ((quad.ul, quad.ur), (quad.ur, quad.lr),
+                                   (quad.lr, quad.ll), (quad.ll, quad.ul)):
+                        mark_segment(p1, p2, thickness, line_pad)
+                elif kind == "c":
+                    curve_box = fitz.Rect(item[1], item[1]) | item[2] | item[3] | item[4]
+                    mark(forbidden_mask, curve_box, line_pad, line_pad)
+                    mark(content_mask, curve_box, 0, 0)
+
+        # IMAGES (photos, logos, QR codes) : dilatation (30, 30) du raster, élargie du flou de détection
+        for info in page.get_image_info():
+            mark(image_mask, info["bbox"], 20, 20)
+            mark(content_mask, info["bbox"], 0, 0)
+
+        forbidden_mask = cv2.bitwise_or(forbidden_mask, text_mask)
+        forbidden_mask = cv2.bitwise_or(forbidden_mask, image_mask)
+        white_binary = cv2.bitwise_not(content_mask)
+
+        coords = self._find_stamp_position(forbidden_mask, white_binary, context)
+        return coords, forbidden_mask, text_mask, image_mask, qrcode_mask
+
+    def save_debug_image(self, image, forbidden_mask, stamp_position, page_num, output_dir="/app/debug",
                          text_mask=None, image_mask=None, qrcode_mask=None):
         """
         Sauvegarde une image de debug avec les masques et la position du tampon
@@ -957,98 +2393,494 @@ class PDFProcessor:
         except Exception as e:
             logging.error(f"Erreur lors de la sauvegarde debug: {e}")
 
-    def _merge_first_page_with_rest(self, stamped_first_page_path, original_pdf_path, num_pages):
+    def _new_output_buffer(self):
+        """
+        Tampon du PDF de sortie : en mémoire, basculé sur disque seulement au-delà de
+        self.spill_threshold octets. L'appelant lit le contenu puis ferme le tampon.
+        """
+        return tempfile.SpooledTemporaryFile(max_size=self.spill_threshold, suffix='.pdf')
+
+    def _overlay_stamps(self, pdf_path, stamp_path, coordinates, index, prefix, context):
+        """
+        Mode de sortie overlay : le tampon et le libellé sont dessinés directement sur le PDF
+        original. Le contenu existant reste vectoriel (texte sélectionnable), seuls les octets
+        du tampon sont ajoutés.
+
+        Args:
+            pdf_path (str | bytes): Chemin ou contenu du PDF source
+            stamp_path (str | bytes | Future): Chemin ou contenu de l'image du tampon
+            coordinates (list): Positions par page, en pixels à context.dpi (None = pas de tampon)
+            index (int): Numéro de la pièce
+            prefix (str): Préfixe de numérotation
+            context (ProcessingContext): Paramètres de la requête
+
+        Returns:
+            file: PDF tamponné (voir _new_output_buffer)
+        """
+        doc = open_pdf(pdf_path)
+        try:
+            self._apply_overlays(doc, read_source(resolve_source(stamp_path)), coordinates, index, prefix, context)
+            output = self._new_output_buffer()
+            output.write(doc.tobytes(garbage=1, deflate=True))
+        finally:
+            doc.close()
+
+        logging.info(f"Tampons appliqués en overlay vectoriel ({output.tell()} octets)")
+        output.seek(0)
+        return output
+
+    def _stamp_selected_pages(self, pdf_path, stamp_path, pages, index, prefix, context, session):
+        """
+        Chemin rapide des sélections de pages (pages, stampOnlyFirstPage) : seules les pages
+        sélectionnées sont analysées, le tampon y est superposé et le résultat est le PDF
+        original suivi d'une mise à jour incrémentale (objets modifiés ou ajoutés, nouvelle
+        table xref). Les autres pages ne sont ni rendues, ni analysées, ni réécrites.
+
+        Args:
+            pages (list): Numéros des pages à tamponner (voir parse_page_selection)
+            context (ProcessingContext): Paramètres de la requête
+            session (PageSession): Session de la requête dans le scheduler de pages
+
+        Returns:
+            tuple: (output, coordinates) - une entrée par page sélectionnée, avec son page_number
+        """
+        page_args = [(page_num, pdf_path, context) for page_num in pages]
+        results = list(session.map(self._analyze_page_for_overlay, page_args))
+        context.check_cancelled()
+
+        output = self._new_output_buffer()
+        doc = open_pdf(pdf_path)
+        try:
+            original_xref_length = doc.xref_length()
+            snapshot = {}
+            for page_num in pages:
+                snapshot.update(snapshot_page_objects(doc, doc[page_num - 1]))
+
+            placements = [None] * doc.page_count
+            for page_num, coords in results:
+                placements[page_num - 1] = coords
+            self._apply_overlays(doc, read_source(resolve_source(stamp_path)), placements, index, prefix, context)
+            try:
+                write_incremental_update(doc, pdf_path, output, snapshot, original_xref_length,
+                                         flate_level=self.flate_level)
+                logging.info(f"{len(pages)} page(s) tamponnée(s) par mise à jour incrémentale ({output.tell()} octets)")
+            except Exception as e:
+                # PDF chiffré, réparé à l'ouverture... : réécriture complète, toujours sans copie de pages
+                logging.warning(f"Mise à jour incrémentale impossible ({e}) - réécriture du document")
+                output.seek(0)
+                output.truncate()
+                output.write(doc.tobytes(deflate=True))
+        finally:
+            doc.close()
+
+        coordinates = [dict(coords or {"x": -1, "y": -1, "size": 0}, page_number=page_num)
+                       for page_num, coords in results]
+        output.seek(0)
+        return output, coordinates
+
+    def _apply_overlays(self, doc, stamp_bytes, coordinates, index, prefix, context):
+        """
+        Dessine tampons et libellés sur les pages de doc (modifié en place).
+
+        Args:
+            doc (fitz.Document): Document à tamponner
+            stamp_bytes (bytes): Image du tampon
+            coordinates (list): Positions par page, en pixels à context.dpi (None = pas de tampon)
+            index (int): Numéro de la pièce
+            prefix (str): Préfixe de numérotation
+            context (ProcessingContext): Paramètres de la requête
+        """
+        try:
+            font = fitz.Font(fontfile=FONT_PATH)
+            font_kwargs = {"fontname": "OpenSans", "fontfile": FONT_PATH}
+        except Exception:
+            font = fitz.Font("helv")
+            font_kwargs = {"fontname": "helv"}
+
+        text_line1 = "Pièce n°"
+        text_line2 = prefix + '-' + str(index) if prefix else str(index)
+        # Pixels d'analyse -> points PDF
+        scale = self.points_per_inch / context.dpi
+
+        stamp_sizes = {int(coords.get("stamp_size", context.stamp_size_max))
+                       for coords in coordinates
+                       if coords and coords.get("x", -1) >= 0 and coords.get("y", -1) >= 0}
+        if not stamp_sizes:
+            return
+        tiles, tile_pages = self._build_stamp_tiles(stamp_bytes, stamp_sizes, text_line1, text_line2,
+                                                    font, font_kwargs)
+        try:
+            for page_index, coords in enumerate(coordinates):
+                if not coords or coords.get("x", -1) < 0 or coords.get("y", -1) < 0:
+                    continue
+                page = doc[page_index]
+
+                stamp_size = int(coords.get("stamp_size", context.stamp_size_max))
+                zone_size = int(coords.get("size", stamp_size))
+                margin = (zone_size - stamp_size) // 2
+                tile_rect = tiles[tile_pages[stamp_size]].rect
+                # La tuile est centrée sur le tampon : le libellé peut déborder en largeur
+                overflow = (tile_rect.width - stamp_size) / 2
+                left = page.rect.x0 + (coords["x"] + margin - overflow) * scale
+                top = page.rect.y0 + (coords["y"] + margin) * scale
+                target = fitz.Rect(left, top, left + tile_rect.width * scale, top + tile_rect.height * scale)
+
+                # Coordonnées de la page affichée -> repère non tourné de PyMuPDF.
+                # Chaque page référence le même Form XObject : le tampon n'est embarqué qu'une fois.
+                page.show_pdf_page(target * page.derotation_matrix, tiles, tile_pages[stamp_size],
+                                   rotate=page.rotation)
+        finally:
+            tiles.close()
+
+    def _build_stamp_tiles(self, stamp_bytes, stamp_sizes, text_line1, text_line2, font, font_kwargs):
         """
-        Fusionne la première page tamponnée avec le reste du PDF original
+        Construit un document de tuiles : une page par taille de tampon distincte, contenant
+        le tampon et son libellé, en pixels d'analyse. L'image du tampon n'est insérée qu'une
+        fois, les autres tuiles réutilisent son xref.
+
+        Returns:
+            tuple: (tiles, tile_pages) - document de tuiles et numéro de page par taille
         """
+        tiles = fitz.open()
+        tile_pages = {}
+        image_xref = 0
+        for stamp_size in sorted(stamp_sizes):
+            # Même géométrie de libellé que la sortie raster
+            font_size = int(stamp_size * 0.12)
+            width1 = font.text_length(text_line1, fontsize=font_size)
+            width2 = font.text_length(text_line2, fontsize=font_size)
+            tile_width = max(stamp_size, width1, width2)
+            tile = tiles.new_page(width=tile_width, height=stamp_size)
+
+            offset = (tile_width - stamp_size) / 2
+            stamp_rect = fitz.Rect(offset, 0, offset + stamp_size, stamp_size)
+            if image_xref:
+                tile.insert_image(stamp_rect, xref=image_xref)
+            else:
+                image_xref = tile.insert_image(stamp_rect, stream=stamp_bytes)
+
+            center_x = tile_width / 2
+            center_y = stamp_size / 2
+            gap = 10
+            baseline1 = fitz.Point(center_x - width1 / 2, center_y - gap)
+            baseline2 = fitz.Point(center_x - width2 / 2, center_y + gap + font.ascender * font_size)
+            for text, point in ((text_line1, baseline1), (text_line2, baseline2)):
+                tile.insert_text(point, text, fontsize=font_size, color=(0, 0, 0), **font_kwargs)
+            tile_pages[stamp_size] = tile.number
+
         try:
-            # Charger les deux PDFs avec PyMuPDF (fitz)
-            stamped_pdf = fitz.open(stamped_first_page_path)
-            original_pdf = fitz.open(original_pdf_path)
+            # N'embarquer que les glyphes utilisés par le libellé (avant la copie dans le document)
+            tiles.subset_fonts()
+        except Exception as e:
+            logging.debug(f"Sous-ensemble de police non disponible : {e}")
+        return tiles, tile_pages
+
+    def _render_key(self, pdf_path):
+        # Source en mémoire : identité de l'objet (gardé référencé tant que ses documents sont ouverts)
+        return id(pdf_path) if is_in_memory(pdf_path) else pdf_path
+
+    def _get_render_document(self, pdf_path):
+        """
+        Document PyMuPDF du thread courant pour ce PDF, ouvert une seule fois par worker et par
+        requête au lieu d'une analyse complète du fichier à chaque page. Les workers étant
+        partagés entre requêtes, chaque thread peut garder un document par PDF en cours.
+        """
+        key = self._render_key(pdf_path)
+        thread_id = threading.get_ident()
+        with self._render_lock:
+            entry = self._render_documents.setdefault(key, {"source": pdf_path, "docs": {}})
+            doc = entry["docs"].get(thread_id)
+        if doc is None:
+            doc = open_pdf(pdf_path)
+            with self._render_lock:
+                entry["docs"][thread_id] = doc
+        return doc
+
+    def _release_render_documents(self, pdf_path):
+        """Ferme les documents de rendu d'un PDF dans tous les threads (fin de la requête)"""
+        with self._render_lock:
+            entry = self._render_documents.pop(self._render_key(pdf_path), None)
+        if entry:
+            for doc in entry["docs"].values():
+                doc.close()
+
+    def warm_up(self):
+        """
+        Traite un document de démonstration hors requête (rendu PyMuPDF, analyse OpenCV,
+        encodage, police et tuiles du tampon) : la première requête ne paie pas
+        l'initialisation de ces bibliothèques.
+        """
+        started = time.perf_counter()
+        doc = fitz.open()
+        page = doc.new_page()
+        page.insert_text((72, 72), "Préchauffage", fontsize=12)
+        pdf_bytes = doc.tobytes()
+        doc.close()
+        stamp = io.BytesIO()
+        Image.new("RGBA", (64, 64), (200, 30, 30, 255)).save(stamp, format="PNG")
+
+        for output_mode in ('raster', 'overlay'):
+            output, _ = self.process_document(pdf_bytes, stamp.getvalue(), output_mode=output_mode)
+            output.close()
+        # Page native : le moteur auto a choisi l'analyse vectorielle, l'analyse raster est chauffée à part
+        gray_image, pix = self.render_page(1, pdf_bytes, self.low_dpi, grayscale=True)
+        self.find_whitest_space(gray_image, self.default_context())
+        del gray_image, pix
+        self._release_render_documents(pdf_bytes)
+        logging.info(f"Préchauffage terminé en {time.perf_counter() - started:.2f} s")
+
+    def get_page_count(self, pdf_path):
+        """Nombre de pages du PDF, lu par PyMuPDF (sans processus pdfinfo)"""
+        with open_pdf(pdf_path) as doc:
+            return doc.page_count
+
+    def render_page(self, page_num, pdf_path, dpi, grayscale=False):
+        """
+        Rendu d'une page au DPI demandé.
 
-            # Créer un nouveau PDF
-            output_pdf = fitz.open()
+        Avec le backend 'fitz', la page est rendue en mémoire par PyMuPDF et le tableau NumPy
+        est une vue sur le buffer du Pixmap (aucune copie). Le backend 'pdf2image' reste
+        disponible en repli.
 
-            # Ajouter la première page tamponnée
-            output_pdf.insert_pdf(stamped_pdf, from_page=0, to_page=0)
+        Args:
+            page_num (int): Numéro de la page (à partir de 1)
+            pdf_path (str | bytes): Chemin ou contenu du PDF source
+            dpi (int): Résolution du rendu
+            grayscale (bool): Rendre directement en niveaux de gris (analyse seule)
+
+        Returns:
+            tuple: (array, pixmap) - array en niveaux de gris (H, W) ou RGB (H, W, 3).
+                pixmap doit rester référencé tant que array est utilisé (None avec pdf2image).
+        """
+        if self.render_backend == 'pdf2image':
+            convert = convert_from_bytes if is_in_memory(pdf_path) else convert_from_path
+            page_img = convert(pdf_path, dpi=dpi, first_page=page_num, last_page=page_num)[0]
+            if grayscale:
+                return np.asarray(page_img.convert("L")), None
+            return np.asarray(page_img.convert("RGB")), None
+
+        page = self._get_render_document(pdf_path)[page_num - 1]
+        colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+        pix = page.get_pixmap(dpi=dpi, colorspace=colorspace, alpha=False)
+        # Vue sans copie sur les échantillons ; stride peut inclure un bourrage de fin de ligne
+        samples = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.stride)
+        array = samples[:, :pix.width * pix.n]
+        if not grayscale:
+            array = array.reshape(pix.height, pix.width, pix.n)
+        return array, pix
+
+    def _analyze_page(self, page_num, pdf_path, context, render_output=True):
+        """
+        Analyse une page : choix du moteur, recherche de la zone du tampon et debug optionnel.
+
+        Args:
+            page_num (int): Numéro de la page (à partir de 1)
+            pdf_path (str | bytes): Chemin ou contenu du PDF source
+            context (ProcessingContext): Paramètres de la requête (DPI, moteur, debug)
+            render_output (bool): Produire aussi l'image de la page pour une sortie rastérisée.
+                En mode overlay, les pages vectorielles ne sont jamais rendues.
 
-            # Ajouter toutes les pages suivantes du PDF original (à partir de la page 2)
-            if num_pages > 1:
-                output_pdf.insert_pdf(original_pdf, from_page=1, to_page=num_pages-1)
+        Returns:
+            tuple: (coords, page_img) - page_img vaut None si aucun rendu n'a été nécessaire
+        """
+        # Requête abandonnée pendant que la page attendait son tour
+        context.check_cancelled()
+        analysis_started = time.perf_counter()
+        engine = context.analysis_engine
+        page_img = None
+        gray_image = None
+        if engine in ('auto', 'vector'):
+            page = self._get_render_document(pdf_path)[page_num - 1]
+            if engine == 'auto':
+                # Décision page par page : un document peut mêler pages natives et annexes scannées
+                engine = self.classify_page(page)
+            if engine == 'vector':
+                # PDF natif : placement calculé sur la géométrie, sans rendu ni morphologie OpenCV
+                result = self.find_whitest_space_vector(page, context)
+                analysis_ms = (time.perf_counter() - analysis_started) * 1000
+
+        if engine == 'vector':
+            if render_output or context.enable_debug:
+                # Rendu de la page pour la composition de la sortie
+                rgb_array, pix = self.render_page(page_num, pdf_path, context.dpi)
+                page_img = Image.fromarray(rgb_array, "RGB").copy()
+                if context.enable_debug:
+                    gray_image = cv2.cvtColor(rgb_array, cv2.COLOR_RGB2GRAY)
+                del rgb_array, pix
+        else:
+            if render_output:
+                # Conversion de la page en couleur pour la sortie, niveaux de gris pour l'analyse
+                rgb_array, pix = self.render_page(page_num, pdf_path, context.dpi)
+                page_img = Image.fromarray(rgb_array, "RGB").copy()
+                gray_image = cv2.cvtColor(rgb_array, cv2.COLOR_RGB2GRAY)
+                del rgb_array, pix
+            else:
+                # Analyse seule : rendu direct en niveaux de gris
+                gray_image, pix = self.render_page(page_num, pdf_path, context.dpi, grayscale=True)
+            # Pas de medianBlur pour préserver les lignes fines
 
-            # Sauvegarder le PDF fusionné
-            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp_file:
-                output_path = tmp_file.name
+            # Détection de l'espace blanc (étape la plus coûteuse : point d'arrêt après le rendu)
+            context.check_cancelled()
+            result = self._locate_stamp(gray_image, context)
+            analysis_ms = (time.perf_counter() - analysis_started) * 1000
+
+        if len(result) == 5:
+            coords, forbidden_mask, text_mask, image_mask, qrcode_mask = result
+        else:
+            # Fallback pour compatibilité
+            coords, forbidden_mask = result[0], result[1]
+            text_mask, image_mask, qrcode_mask = None, None, None
+
+        logging.info(f"Page {page_num}: moteur {engine} - analyse en {analysis_ms:.1f} ms")
+
+        # Si aucune position sûre n'a été trouvée, ne pas placer de tampon
+        if coords is None:
+            logging.warning(f"Page {page_num}: Aucune zone sûre trouvée - Tampon non placé")
+
+            # Debug même si pas de tampon pour voir pourquoi
+            if context.enable_debug:
+                # Créer une position fictive pour le debug (hors page)
+                fake_coords = {"x": -1000, "y": -1000, "size": 300}
+                self.save_debug_image(gray_image, forbidden_mask, fake_coords, page_num,
+                                     text_mask=text_mask, image_mask=image_mask, qrcode_mask=qrcode_mask)
+            return None, page_img
 
-            output_pdf.save(output_path)
+        coords["engine"] = engine
+        coords["analysis_ms"] = analysis_ms
 
-            # Fermer les PDFs
-            stamped_pdf.close()
-            original_pdf.close()
-            output_pdf.close()
+        # Debug optionnel
+        if context.enable_debug:
+            self.save_debug_image(gray_image, forbidden_mask, coords, page_num,
+                                 text_mask=text_mask, image_mask=image_mask, qrcode_mask=qrcode_mask)
 
-            logging.info(f"Fusion terminée avec succès : {output_path}")
-            return output_path
+        return coords, page_img
 
+    def _locate_stamp(self, gray_image, context):
+        """
+        Recherche raster de la zone du tampon, déportée dans le pool de process s'il existe.
+        Le mode debug, qui a besoin des masques, reste dans le thread courant.
+        """
+        if self._analysis_pool is not None and not context.enable_debug:
+            try:
+                return self._analysis_pool.find_whitest_space(gray_image, context), None, None, None, None
+            except BrokenProcessPool:
+                logging.warning("Pool d'analyse interrompu et redémarré - page analysée localement")
+        return self.find_whitest_space(gray_image, context)
+
+    def _analyze_page_for_overlay(self, args):
+        """Analyse seule d'une page pour le mode overlay (pour le traitement parallèle)"""
+        page_num, pdf_path, context = args
+        try:
+            coords, _ = self._analyze_page(page_num, pdf_path, context, render_output=False)
+            return page_num, coords
+        except RequestCancelled:
+            raise
         except Exception as e:
-            logging.error(f"Erreur lors de la fusion des PDFs : {e}")
+            logging.error(f"Erreur analyse page {page_num}: {e}")
             raise
 
+    def _get_stamp_tile(self, stamp_path, stamp_size, text_line1, text_line2):
+        """
+        Tuile RGBA du tampon redimensionné avec ses deux lignes de libellé déjà dessinées,
+        mise en cache avec les tampons.
+
+        La tuile est centrée sur le tampon : elle déborde symétriquement si le libellé est
+        plus large (ou plus haut) que le tampon.
+
+        Returns:
+            PIL.Image: Tuile à coller avec son canal alpha comme masque
+        """
+        key = ("tile", self._stamp_cache.content_digest(stamp_path), stamp_size, text_line1, text_line2)
+
+        def render_tile():
+            stamp_img = self._stamp_cache.get_stamp(stamp_path, stamp_size)
+            font_size = int(stamp_size * 0.12)  # Augmentation de 10% à 12% pour meilleure lisibilité
+            font = load_label_font(font_size)
+
+            try:
+                bbox1 = font.getbbox(text_line1)
+                bbox2 = font.getbbox(text_line2)
+                text_width1, text_height1 = bbox1[2] - bbox1[0], bbox1[3] - bbox1[1]
+                text_width2 = bbox2[2] - bbox2[0]
+                text_bottom2 = bbox2[3]
+            except AttributeError:
+                text_width1, text_height1 = font.getsize(text_line1)
+                text_width2, text_bottom2 = font.getsize(text_line2)
+
+            # Position des lignes par rapport au coin du tampon (mêmes règles que sur la page)
+            center = stamp_size // 2
+            line1 = (center - text_width1 / 2, center - text_height1 - 10)
+            line2 = (center - text_width2 / 2, center + 10)
+
+            # Débordement éventuel du libellé hors du carré du tampon
+            pad_x = max(0, int(np.ceil((max(text_width1, text_width2) - stamp_size) / 2))) + 2
+            pad_y = max(0, int(np.ceil(-line1[1])), int(np.ceil(line2[1] + text_bottom2 - stamp_size))) + 2
+
+            tile = Image.new("RGBA", (stamp_size + 2 * pad_x, stamp_size + 2 * pad_y), (0, 0, 0, 0))
+            tile.alpha_composite(stamp_img, (pad_x, pad_y))
+            draw = ImageDraw.Draw(tile)
+            draw.text((line1[0] + pad_x, line1[1] + pad_y), text_line1, fill="black", font=font)
+            draw.text((line2[0] + pad_x, line2[1] + pad_y), text_line2, fill="black", font=font)
+            return tile
+
+        return self._stamp_cache.get_or_create(key, render_tile)
+
+    def _encode_page(self, page_num, page_img):
+        """
+        Encode une page rendue avec le codec configuré, l'espace couleur étant choisi
+        d'après le contenu (1 bit, niveaux de gris ou RGB).
+
+        Returns:
+            tuple: (EncodedImage, stats) - stats : espace couleur, durée d'encodage et taille
+        """
+        encode_started = time.perf_counter()
+        color_mode = detect_color_mode(page_img)
+        encoded = encode_image(page_img, codec=self.raster_codec, color_mode=color_mode,
+                               flate_level=self.flate_level, jpeg_quality=self.jpeg_quality)
+        stats = {
+            "color_mode": color_mode,
+            "encode_ms": (time.perf_counter() - encode_started) * 1000,
+            "encoded_bytes": len(encoded.data),
+        }
+        logging.info(f"Page {page_num}: encodage {color_mode}/{encoded.filter_name} en "
+                     f"{stats['encode_ms']:.1f} ms - {stats['encoded_bytes']} octets")
+        return encoded, stats
+
     def _process_single_page(self, args):
-        """Traite une seule page (pour le traitement parallèle)"""
-        page_num, pdf_path, stamp_path, index, prefix = args
+        """
+        Traite une seule page (pour le traitement parallèle)
 
-        try:
-            # Conversion de la page
-            page_img = convert_from_path(pdf_path, dpi=self.low_dpi,
-                                        first_page=page_num, last_page=page_num)[0]
+        Returns:
+            tuple: (page_num, image encodée, taille de la page en points, superpositions, coords)
+                - le tampon est une superposition RGBA partagée, hors de l'image de la page
+        """
+        page_num, pdf_path, stamp_path, index, prefix, context = args
 
-            # Optimisation : Conversion directe en array numpy
-            # Pas de filtrage pour préserver les lignes fines
-            gray_image = cv2.cvtColor(np.array(page_img), cv2.COLOR_RGB2GRAY)
-            # Pas de medianBlur pour préserver les lignes fines
+        try:
+            coords, page_img = self._analyze_page(page_num, pdf_path, context)
+            # Taille affichée de la page originale en points (rotation comprise)
+            page_rect = self._get_render_document(pdf_path)[page_num - 1].rect
+            page_size = (page_rect.width, page_rect.height)
 
-            # Détection de l'espace blanc
-            result = self.find_whitest_space(gray_image)
-            if len(result) == 5:
-                coords, forbidden_mask, text_mask, image_mask, qrcode_mask = result
-            else:
-                # Fallback pour compatibilité
-                coords, forbidden_mask = result[0], result[1]
-                text_mask, image_mask, qrcode_mask = None, None, None
+            # Encodage de la page seule : le tampon couleur n'impose pas le RGB à une page noir et blanc
+            context.check_cancelled()
+            encoded_page, encode_stats = self._encode_page(page_num, page_img.convert("RGB"))
 
-            # Si aucune position sûre n'a été trouvée, ne pas placer de tampon
             if coords is None:
-                logging.warning(f"Page {page_num}: Aucune zone sûre trouvée - Tampon non placé")
-                
-                # Debug même si pas de tampon pour voir pourquoi
-                if self.enable_debug:
-                    # Créer une position fictive pour le debug (hors page)
-                    fake_coords = {"x": -1000, "y": -1000, "size": 300}
-                    self.save_debug_image(gray_image, forbidden_mask, fake_coords, page_num, 
-                                         text_mask=text_mask, image_mask=image_mask, qrcode_mask=qrcode_mask)
-                
-                # Retourner la page sans tampon en PNG avec compression maximale pour réduire la taille
-                temp_img = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
-                page_img.convert("RGB").save(temp_img, format='PNG', compress_level=9)
-                temp_img.close()
-                
-                return page_num, temp_img.name, None
+                # Retourner la page sans tampon
+                return page_num, encoded_page, page_size, [], None
 
-            # Debug optionnel
-            if self.enable_debug:
-                self.save_debug_image(gray_image, forbidden_mask, coords, page_num, 
-                                     text_mask=text_mask, image_mask=image_mask, qrcode_mask=qrcode_mask)
+            coords.update(encode_stats)
+            overlays = []
 
             # Application du tampon si position trouvée et valide
-            if coords is not None and coords.get("x", -1) >= 0 and coords.get("y", -1) >= 0:
-                page_img = page_img.convert("RGBA")  # Conversion RGBA seulement si nécessaire
+            if coords.get("x", -1) >= 0 and coords.get("y", -1) >= 0:
                 x = int(coords['x'])
                 y = int(coords['y'])
 
                 # Utiliser la taille adaptative du tampon trouvée par l'algorithme
                 # Le tampon utilise toute la zone disponible jusqu'à 300px max (centré)
-                stamp_size = coords.get("stamp_size", self.stamp_size_max)
+                stamp_size = coords.get("stamp_size", context.stamp_size_max)
                 zone_size = coords.get("size", stamp_size)
                 
                 # Utiliser le DPI réel de la page pour un meilleur calcul de taille
@@ -1061,209 +2893,140 @@ class PDFProcessor:
 
                 logging.info(f"Page {page_num}: Application du tampon de taille {stamp_size}px (ajusté: {adjusted_stamp_size}px) dans une zone de {adjusted_zone_size}px (centré, utilise {adjusted_stamp_size/adjusted_zone_size*100:.1f}% de la zone)")
 
-                # Utiliser le cache pour le tampon redimensionné avec qualité maximale
-                cache_key = (stamp_path, adjusted_stamp_size)
-                if cache_key not in self._stamp_cache:
-                    stamp_img = Image.open(stamp_path).convert("RGBA")
-                    # Redimensionner avec LANCZOS pour la meilleure qualité
-                    # Si le redimensionnement est important, faire un upscale progressif pour préserver les détails
-                    original_size = max(stamp_img.width, stamp_img.height)
-                    if adjusted_stamp_size > original_size * 1.5:
-                        # Pour les grands agrandissements, redimensionner progressivement
-                        intermediate_size = int(original_size * 1.5)
-                        stamp_img = stamp_img.resize((intermediate_size, intermediate_size), Image.Resampling.LANCZOS)
-                    # Redimensionnement final avec LANCZOS (meilleure qualité)
-                    self._stamp_cache[cache_key] = stamp_img.resize((adjusted_stamp_size, adjusted_stamp_size),
-                                                                   Image.Resampling.LANCZOS)
-                stamp_img = self._stamp_cache[cache_key].copy()
-                page_img.paste(stamp_img, (x + adjusted_margin, y + adjusted_margin), stamp_img)
-
-                # Ajouter le texte avec taille augmentée
-                draw = ImageDraw.Draw(page_img)
-                font_size = int(adjusted_stamp_size * 0.12)  # Augmentation de 10% à 12% pour meilleure lisibilité
-                font_path = "fonts/OpenSans-regular.ttf"
-
-                try:
-                    font = ImageFont.truetype(font_path, font_size)
-                except Exception:
-                    font = ImageFont.load_default()
-
                 text_line1 = "Pièce n°"
                 text_line2 = prefix + '-' + str(index) if prefix else str(index)
 
-                center_x = x + adjusted_margin + adjusted_stamp_size // 2
-                center_y = y + adjusted_margin + adjusted_stamp_size // 2
+                # Tampon + libellé pré-rendus une fois par (tampon, taille, libellé), écrits une seule
+                # fois dans le PDF et superposés à chaque page
+                # Premier besoin du tampon : son téléchargement a pu se poursuivre pendant l'analyse
+                tile = self._get_stamp_tile(resolve_source(stamp_path), adjusted_stamp_size, text_line1, text_line2)
+                offset_x = (tile.width - adjusted_stamp_size) // 2
+                offset_y = (tile.height - adjusted_stamp_size) // 2
+                tile_key = (adjusted_stamp_size, text_line1, text_line2)
+                overlays.append((tile_key, tile, (x + adjusted_margin - offset_x, y + adjusted_margin - offset_y)))
 
-                try:
-                    bbox1 = draw.textbbox((0, 0), text_line1, font=font)
-                    text_width1 = bbox1[2] - bbox1[0]
-                    text_height1 = bbox1[3] - bbox1[1]
-                    bbox2 = draw.textbbox((0, 0), text_line2, font=font)
-                    text_width2 = bbox2[2] - bbox2[0]
-                    text_height2 = bbox2[3] - bbox2[1]
-                except AttributeError:
-                    text_width1, text_height1 = font.getsize(text_line1)
-                    text_width2, text_height2 = font.getsize(text_line2)
-
-                draw.text((center_x - text_width1/2, center_y - text_height1 - 10),
-                         text_line1, fill="black", font=font)
-                draw.text((center_x - text_width2/2, center_y + 10),
-                         text_line2, fill="black", font=font)
-
-            # Sauvegarde en PNG avec compression maximale pour préserver les lignes fines sans perte
-            # compress_level=9 réduit la taille de ~30-40% par rapport à compress_level=1
-            temp_img = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
-            page_img.convert("RGB").save(temp_img, format='PNG', compress_level=9)
-            temp_img.close()
-
-            return page_num, temp_img.name, coords
+            return page_num, encoded_page, page_size, overlays, coords
 
+        except RequestCancelled:
+            raise
         except Exception as e:
             logging.error(f"Erreur traitement page {page_num}: {e}")
             raise
 
-    def process_document(self, pdf_path, stamp_path, index=1, prefix="", stamp_only_first_page=False):
+    @staticmethod
+    def _ordered_results(executor, fn, args_list, window):
         """
-        Processus optimisé avec traitement parallèle des pages et adaptation automatique
+        Exécute fn sur args_list dans le pool (executor ou PageSession) et produit les résultats dans l'ordre, avec au
+        plus `window` tâches soumises non consommées : la mémoire reste bornée par la fenêtre.
         """
+        pending = deque()
+        next_index = 0
         try:
-            info = pdfinfo_from_path(pdf_path)
-            num_pages = info['Pages']
-
-            # Si on ne doit tamponner que la première page
-            if stamp_only_first_page:
-                logging.info(f"Tamponnage uniquement de la première page (sur {num_pages} pages totales)")
-                
-                # Récupérer les dimensions exactes de la première page originale
-                original_pdf = fitz.open(pdf_path)
-                first_page = original_pdf[0]
-                page_rect = first_page.rect  # Récupère les dimensions de la page en points (72 DPI)
-                page_width_pt = page_rect.width
-                page_height_pt = page_rect.height
-                original_pdf.close()
-                
-                logging.info(f"Dimensions de la première page originale : {page_width_pt}x{page_height_pt} points")
-                
-                # Traiter uniquement la première page
-                page_args = [(1, pdf_path, stamp_path, index, prefix)]
-
-                # Traiter la première page
-                first_page_result = self._process_single_page(page_args[0])
-                stamped_image_paths = [first_page_result[1]]
-                coordinates = [first_page_result[2]]
-
-                # Créer un PDF avec la première page tamponnée en préservant les dimensions exactes
-                # Utiliser PyMuPDF directement pour garantir les mêmes dimensions
-                with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp_file:
-                    stamped_first_page_path = tmp_file.name
-                    try:
-                        logging.info(f"Création du PDF avec la première page tamponnée (dimensions: {page_width_pt}x{page_height_pt} points)")
-                        
-                        # Charger l'image tamponnée
-                        stamped_image = Image.open(stamped_image_paths[0])
-                        
-                        # Créer un nouveau PDF avec PyMuPDF en utilisant les dimensions exactes de la page originale
-                        new_pdf = fitz.open()
-                        # Créer une page avec les dimensions exactes de l'originale
-                        new_page = new_pdf.new_page(width=page_width_pt, height=page_height_pt)
-                        
-                        # Convertir l'image en bytes pour l'insérer dans le PDF
-                        img_bytes = io.BytesIO()
-                        stamped_image.save(img_bytes, format='PNG')
-                        img_bytes.seek(0)
-                        
-                        # Insérer l'image dans la page en la redimensionnant pour correspondre exactement aux dimensions de la page
-                        # rect définit la zone où l'image sera placée (toute la page)
-                        rect = fitz.Rect(0, 0, page_width_pt, page_height_pt)
-                        new_page.insert_image(rect, stream=img_bytes.getvalue())
-                        
-                        # Sauvegarder le PDF
-                        new_pdf.save(stamped_first_page_path)
-                        new_pdf.close()
-                        
-                        logging.info(f"Première page tamponnée créée avec succès avec dimensions préservées ({page_width_pt}x{page_height_pt} points)")
-                    except Exception as e:
-                        logging.error(f"Erreur lors de la création du PDF de la première page : {e}")
-                        raise
-
-                # Fusionner avec le reste du PDF original
-                if num_pages > 1:
-                    logging.info(f"Fusion de la première page tamponnée avec les {num_pages - 1} pages restantes")
-                    output_path = self._merge_first_page_with_rest(stamped_first_page_path, pdf_path, num_pages)
-                else:
-                    output_path = stamped_first_page_path
-
-                # Nettoyage des fichiers temporaires
-                for path in stamped_image_paths:
-                    os.remove(path)
-                if num_pages > 1 and stamped_first_page_path != output_path:
-                    os.remove(stamped_first_page_path)
-
-                return output_path, coordinates
-
-            # Optimisation adaptative basée sur le nombre de pages
-            # DPI réduit pour meilleure performance sans sacrifier trop la qualité
-            cpu_count = multiprocessing.cpu_count()
-            if num_pages > 300:
-                # Gros fichier : plus de workers, DPI faible pour performance
-                # Limiter à 2x le nombre de CPU pour éviter la surcharge sur serveurs limités
-                adaptive_workers = min(16, max(2, cpu_count * 2))
-                self.low_dpi = 120  # DPI faible pour performance
-                logging.info(f"Gros fichier détecté ({num_pages} pages) - {adaptive_workers} workers, DPI {self.low_dpi}")
-            elif num_pages > 100:
-                # Fichier moyen : workers moyens, DPI moyen pour équilibre
-                adaptive_workers = min(12, max(2, cpu_count * 2))
-                self.low_dpi = 150  # DPI moyen pour équilibre qualité/performance
-                logging.info(f"Fichier moyen détecté ({num_pages} pages) - {adaptive_workers} workers, DPI {self.low_dpi}")
-            elif num_pages > 20:
-                # Fichier petit-moyen : workers moyens, DPI correct
-                adaptive_workers = min(8, max(2, cpu_count))
-                self.low_dpi = 150  # DPI correct (réduit de 250)
-                logging.info(f"Fichier petit-moyen détecté ({num_pages} pages) - {adaptive_workers} workers, DPI {self.low_dpi}")
-            else:
-                # Petit fichier : moins de workers, DPI bon pour qualité
-                adaptive_workers = min(6, max(2, cpu_count))
-                self.low_dpi = 200  # DPI bon pour qualité (réduit de 250)
-                logging.info(f"Petit fichier détecté ({num_pages} pages) - {adaptive_workers} workers, DPI {self.low_dpi}")
-
-            # Préparation des arguments pour le traitement parallèle
-            page_args = [(i+1, pdf_path, stamp_path, index, prefix)
-                        for i in range(num_pages)]
-
-            # Traitement parallèle des pages avec workers adaptatifs
-            with ThreadPoolExecutor(max_workers=adaptive_workers) as executor:
-                results = list(executor.map(self._process_single_page, page_args))
-
-            # Tri des résultats par numéro de page
-            results.sort(key=lambda x: x[0])
+            while next_index < len(args_list) and len(pending) < window:
+                pending.append(executor.submit(fn, args_list[next_index]))
+                next_index += 1
+            while pending:
+                result = pending.popleft().result()
+                if next_index < len(args_list):
+                    pending.append(executor.submit(fn, args_list[next_index]))
+                    next_index += 1
+                yield result
+        finally:
+            # Erreur ou abandon : ne pas lancer les pages restantes
+            for future in pending:
+                future.cancel()
 
-            stamped_image_paths = [r[1] for r in results]
-            coordinates = [r[2] for r in results]
+    def process_document(self, pdf_path, stamp_path, index=1, prefix="", stamp_only_first_page=False,
+                         output_mode=None, pages=None, cancellation=None):
+        """
+        Processus optimisé avec traitement parallèle des pages et adaptation automatique
 
+        Args:
+            pdf_path (str | bytes): Chemin ou contenu du PDF source
+            stamp_path (str | bytes | Future): Chemin ou contenu de l'image du tampon, ou Future de
+                son téléchargement : les pages sont analysées sans attendre le tampon, attendu
+                seulement pour la composition
+            stamp_only_first_page (bool): Équivalent à pages='1'
+            output_mode (str): 'raster' (pages rastérisées, par défaut) ou 'overlay'
+                (tampon dessiné sur le PDF original). None = valeur du processeur.
+                Ignoré pour une sélection de pages : le tampon est toujours superposé
+                aux pages sélectionnées du PDF original.
+            pages (str): Sélection des pages à tamponner (voir parse_page_selection),
+                prioritaire sur stamp_only_first_page. None = toutes les pages.
+            cancellation (CancellationToken): Abandon de la requête : les pages en attente sont
+                retirées, les pages en cours s'arrêtent à l'étape suivante.
 
-            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp_file:
-                output_path = tmp_file.name
+        Returns:
+            tuple: (output, coordinates) - output est un fichier binaire positionné au début,
+                en mémoire sauf au-delà de self.spill_threshold ; l'appelant le ferme.
+        """
+        try:
+            num_pages = self.get_page_count(pdf_path)
+
+            # Sélection de pages : les pages non sélectionnées ne coûtent rien
+            selection = self._select_pages(num_pages, pages, stamp_only_first_page)
+            processed_pages = len(selection) if selection else num_pages
+
+            # Paramètres propres à la requête (DPI et workers adaptés au nombre de pages traitées) :
+            # l'instance, partagée entre les requêtes concurrentes, n'est pas modifiée
+            context = self.create_context(processed_pages, output_mode, cancellation)
+
+            # Pages soumises au scheduler partagé, servi à tour de rôle entre les requêtes
+            with self.page_scheduler.session(f"{processed_pages}/{num_pages} pages", context.workers,
+                                             cancellation) as session:
+                if selection is not None:
+                    logging.info(f"Tamponnage de {len(selection)} page(s) sélectionnée(s) sur {num_pages}")
+                    # Tampon superposé aux pages sélectionnées du document original, quel que soit le mode de sortie
+                    return self._stamp_selected_pages(pdf_path, stamp_path, selection, index, prefix, context,
+                                                      session)
+
+                if context.output_mode == 'overlay':
+                    # Analyse seule des pages, puis tampons dessinés sur le document original
+                    page_args = [(i+1, pdf_path, context) for i in range(num_pages)]
+                    coordinates = [coords for _, coords in session.map(self._analyze_page_for_overlay, page_args)]
+
+                    context.check_cancelled()
+                    output = self._overlay_stamps(pdf_path, stamp_path, coordinates, index, prefix, context)
+                    return output, coordinates
+
+                # Préparation des arguments pour le traitement parallèle
+                page_args = [(i+1, pdf_path, stamp_path, index, prefix, context)
+                            for i in range(num_pages)]
+
+                output = self._new_output_buffer()
+
+                # Les pages sont écrites dans l'ordre dès qu'elles sont prêtes, au plus 2 pages
+                # soumises par worker de la requête
+                coordinates = []
                 try:
-                    logging.info(f"Début de la conversion en PDF avec {len(stamped_image_paths)} images.")
-                    for i, img_path in enumerate(stamped_image_paths):
-                        logging.info(f"Image à convertir {i+1}/{len(stamped_image_paths)} : {img_path} (taille : {os.path.getsize(img_path)} octets)")
-                    with open(output_path, "wb") as f:
-                        # Options de compression optimisées pour img2pdf
-                        f.write(img2pdf.convert(stamped_image_paths))
-                    logging.info(f"Conversion en PDF terminée avec succès. Fichier : {output_path}")
+                    logging.info(f"Début de l'écriture du PDF ({num_pages} pages)")
+                    with IncrementalPDFWriter(output, flate_level=self.flate_level) as writer:
+                        for _, encoded_page, page_size, overlays, coords in self._ordered_results(
+                                session, self._process_single_page, page_args, context.workers * 2):
+                            writer.add_page(encoded_page, page_size, overlays)
+                            coordinates.append(coords)
+                    logging.info(f"Écriture du PDF terminée avec succès ({self.raster_codec}, {output.tell()} octets)")
                 except Exception as e:
-                    logging.error(f"Erreur lors de la conversion des images en PDF : {e}")
+                    logging.error(f"Erreur lors de l'écriture du PDF : {e}")
+                    output.close()
                     raise
 
-            # Nettoyage des fichiers temporaires
-            for path in stamped_image_paths:
-                os.remove(path)
-
-            return output_path, coordinates
+                output.seek(0)
+                return output, coordinates
 
+        except InvalidRequest:
+            # Erreur du client (sélection de pages) : transmise telle quelle à l'appelant
+            raise
         except Exception as e:
+            if cancellation is not None and cancellation.cancelled:
+                # Pages annulées ou arrêtées : l'abandon est la cause, pas une erreur de traitement
+                raise cancellation.exception() from e
             logging.error(f"Erreur lors de la conversion du PDF en images : {str(e)}")
             raise ValueError(f"Erreur lors de la conversion du PDF en images : {str(e)}")
+        finally:
+            # Session fermée (plus aucune page en cours) : documents de rendu de la requête libérés
+            self._release_render_documents(pdf_path)
+            logging.debug(f"Cache des tampons : {self._stamp_cache.stats()}")
 
     # def process_document(self, pdf_path, stamp_path, index=1, prefix=""):
     #     """
@@ -1307,123 +3070,432 @@ class PDFProcessor:
 
 
 class PDFServicer(pdf_service_pb2_grpc.PDFServiceServicer):
-    def __init__(self):
+    def __init__(self, worker_share=1.0):
+        """
+        Args:
+            worker_share (float): Part des ressources du conteneur (mémoire, threads de pages)
+                revenant à ce process : 1/N avec N workers pré-forkés (voir supervisor.py)
+        """
         # Configuration optimisée - debug désactivé par défaut en production pour meilleures performances
         # Le debug peut être activé via la variable d'environnement ENABLE_DEBUG=true
         # IMPORTANT: En production, forcer à False pour éviter la génération d'images debug gourmandes
         enable_debug = os.getenv('ENABLE_DEBUG', 'false').lower() == 'true'
         # Taille fixe : max 300px, min 200px - priorité à la zone la plus grande possible
-        self.processor = PDFProcessor(stamp_size_max=300, stamp_size_min=200, enable_debug=False, low_dpi=200)
-
-    def ProcessPDF(self, request, context):
-        #TODO : ADD AUTHORISATION VERIFICATION BEARER TOKEN FROM CONTEXT
-        pdf_path = None
-        stamp_path = None
-        processed_pdf_path = None
+        # Rendu des pages : 'fitz' (PyMuPDF en mémoire, par défaut) ou 'pdf2image' (pdftoppm) en repli
+        render_backend = os.getenv('RENDER_BACKEND', 'fitz').lower()
+        # Codec des pages rastérisées : 'flate' (sans perte, par défaut) ou 'jpeg'
+        raster_codec = os.getenv('RASTER_CODEC', 'flate').lower()
+        if raster_codec not in RASTER_CODECS:
+            logging.warning(f"RASTER_CODEC inconnu ({raster_codec}), utilisation de 'flate'")
+            raster_codec = 'flate'
+        # Les PDFs restent en mémoire jusqu'à SPILL_THRESHOLD_MB, au-delà ils passent sur /tmp
+        spill_threshold = int(os.getenv('SPILL_THRESHOLD_MB', '64')) * 1024 * 1024
+        # Analyse raster dans un pool de process (0 = dans les threads de traitement)
+        analysis_processes = int(os.getenv('ANALYSIS_PROCESSES', '0'))
+        # CPU du conteneur (quota CFS, affinité), partagés entre les workers pré-forkés
+        cpu_limit = detect_cpu_limit() * worker_share
+        # Plafond des pages traitées simultanément par le conteneur, toutes requêtes confondues
+        # (défaut : 2 par CPU, 16 au plus), réparti entre les workers comme le budget mémoire
+        page_workers = int(os.getenv('PAGE_WORKERS', '0')) or None
+        if worker_share < 1:
+            page_workers = page_workers or min(16, math.ceil(detect_cpu_limit()) * 2)
+            page_workers = max(2, int(page_workers * worker_share))
+        # Sous ce plafond, pages simultanées ajustées au débit mesuré et au bridage CPU du conteneur
+        adaptive_concurrency = os.getenv('ADAPTIVE_CONCURRENCY', 'true').lower() == 'true'
+        # Threads internes d'OpenCV/BLAS : 'auto' (CPU répartis entre les pages en cours), un nombre fixe,
+        # ou 'off' (OMP_NUM_THREADS et réglages par défaut des bibliothèques)
+        native_threads = os.getenv('NATIVE_THREADS', 'auto').lower()
+        # Bandes d'une page analysées en parallèle quand la page est seule (0 = une par CPU, 1 = page d'un bloc)
+        analysis_bands = int(os.getenv('ANALYSIS_BANDS', '0')) or math.ceil(cpu_limit)
+        self.processor = PDFProcessor(stamp_size_max=300, stamp_size_min=200, enable_debug=False, low_dpi=200,
+                                      render_backend=render_backend, raster_codec=raster_codec,
+                                      jpeg_quality=int(os.getenv('JPEG_QUALITY', '85')),
+                                      flate_level=int(os.getenv('FLATE_LEVEL', '6')),
+                                      spill_threshold=spill_threshold,
+                                      analysis_processes=analysis_processes,
+                                      page_workers=page_workers, cpu_limit=cpu_limit,
+                                      adaptive_concurrency=adaptive_concurrency,
+                                      native_threads=None if native_threads == 'off' else native_threads,
+                                      analysis_bands=analysis_bands)
+        # Contrôle d'admission : budget mémoire partagé par les requêtes (défaut : 75% de la limite du conteneur)
+        memory_budget = int(os.getenv('MEMORY_BUDGET_MB', '0')) * 1024 * 1024 or int(detect_memory_limit() * 0.75)
+        memory_budget = int(memory_budget * worker_share)
+        self.memory_budget = MemoryBudget(memory_budget, float(os.getenv('ADMISSION_TIMEOUT_S', '30')))
+        logging.info(f"Budget mémoire des requêtes : {memory_budget // (1024 * 1024)} Mo")
+        # Téléchargements des tampons, menés en parallèle du PDF (un par thread du serveur synchrone)
+        self._downloads = futures.ThreadPoolExecutor(max_workers=10, thread_name_prefix="stamp-download")
+        # Worker pré-forké : compteurs de recyclage (None hors superviseur)
+        self.lifecycle = None
+
+    def _record(self, pdf_source):
+        """Requête terminée : comptabilisée pour le recyclage du worker"""
+        if self.lifecycle is None:
+            return
+        if pdf_source is None:
+            nbytes = 0
+        elif is_in_memory(pdf_source):
+            nbytes = len(pdf_source)
+        else:
+            nbytes = os.path.getsize(pdf_source) if os.path.exists(pdf_source) else 0
+        self.lifecycle.record(nbytes)
+
+    def _fetch_pdf(self, request):
+        """PDF source de la requête : contenu transmis, Google Drive, OoDrive ou URL"""
+        if request.pdf_data:
+            # PDF transmis directement dans la requête (upload via le gateway)
+            return request.pdf_data
+        if request.googleDriveFile and request.googleDriveFile.id and request.googleDriveFile.accessToken:
+            return self.processor.download_from_gdrive(request.googleDriveFile.id, request.googleDriveFile.accessToken)
+        if request.ooDriveFile and request.ooDriveFile.id and request.ooDriveFile.accessToken:
+            return self.processor.download_from_oodrive(request.ooDriveFile)
+        if request.pdf_url and request.pdf_url.strip():
+            return self.processor.download_file(request.pdf_url)
+        raise InvalidRequest("Aucun fichier source fourni")
+
+    def _stamp(self, request, pdf_source, stamp_source, cancellation):
+        """
+        Traitement d'une requête dont les sources sont téléchargées : admission dans le budget
+        mémoire, tamponnage et construction de la réponse. Travail CPU uniquement.
 
+        Raises:
+            AdmissionRejected: Budget mémoire insuffisant
+            RequestCancelled: Requête abandonnée (client déconnecté, délai dépassé)
+        """
+        reserved = 0
         try:
-            # Télécharger le PDF source
-            pdf_buffer = None
-
-            print(request)
-
-            if request.googleDriveFile and request.googleDriveFile.id and request.googleDriveFile.accessToken:
-                pdf_buffer = self.processor.download_from_gdrive(request.googleDriveFile.id, request.googleDriveFile.accessToken)
-            elif request.ooDriveFile and request.ooDriveFile.id and request.ooDriveFile.accessToken:
-                pdf_buffer = self.processor.download_from_oodrive(request.ooDriveFile)
-            elif request.pdf_url and request.pdf_url.strip():
-                pdf_buffer = self.processor.download_file(request.pdf_url)
-            else:
-                raise ValueError("Aucun fichier source fourni")
-
-            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as pdf_tmp:
-                pdf_tmp.write(pdf_buffer.getvalue())
-                pdf_path = pdf_tmp.name
-
-            # Télécharger le tampon
-            stamp_buffer = self.processor.download_file(request.stamp_url)
-            with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as stamp_tmp:
-                stamp_tmp.write(stamp_buffer.getvalue())
-                stamp_path = stamp_tmp.name
-
-            # Traiter le document
-
-            try:
-                logging.debug(f"Début Traitement du document")
-                # Récupérer le paramètre stampOnlyFirstPage (par défaut False si non spécifié)
-                stamp_only_first_page = getattr(request, 'stampOnlyFirstPage', False)
-                logging.info(f"Paramètre stampOnlyFirstPage: {stamp_only_first_page}")
-
-                processed_pdf_path, coordinates = self.processor.process_document(
-                    pdf_path,
-                    stamp_path,
-                    request.document_index,
-                    request.prefix,
-                    stamp_only_first_page
-                )
-            except Exception as e:
-                logging.error(f"Erreur lors du traitement : {str(e)}")
-                context.set_code(grpc.StatusCode.INTERNAL)
-                context.set_details(str(e))
-                return pdf_service_pb2.PDFResponse()
+            logging.debug(f"Début Traitement du document")
+            # Récupérer le paramètre stampOnlyFirstPage (par défaut False si non spécifié)
+            stamp_only_first_page = getattr(request, 'stampOnlyFirstPage', False)
+            logging.info(f"Paramètre stampOnlyFirstPage: {stamp_only_first_page}")
+            pages = request.pages.strip() or None
+            if pages:
+                logging.info(f"Paramètre pages: {pages}")
+            output_mode = request.output_mode or None
+            if output_mode not in (None, 'raster', 'overlay'):
+                raise InvalidRequest(f"Mode de sortie inconnu : {output_mode}")
+
+            # Pic mémoire réservé avant le rendu des pages, rendu une fois la réponse construite
+            estimate = self.processor.estimate_peak_memory(pdf_source, stamp_only_first_page, output_mode, pages)
+            self.memory_budget.acquire(estimate, f"Requête index {request.document_index}", cancellation)
+            reserved = estimate
+
+            output, coordinates = self.processor.process_document(
+                pdf_source,
+                stamp_source,
+                request.document_index,
+                request.prefix,
+                stamp_only_first_page,
+                output_mode,
+                pages,
+                cancellation
+            )
+            # Échec du téléchargement du tampon : la requête échoue, même si aucune page n'a reçu de tampon
+            resolve_source(stamp_source)
 
-            # Lire le PDF traité
-            with open(processed_pdf_path, 'rb') as f:
-                pdf_bytes = f.read()
+            # Lire le PDF traité, sérialisé une seule fois dans la réponse
+            with output:
+                pdf_bytes = output.read()
 
             # Créer la réponse
-            response = pdf_service_pb2.PDFResponse(
+            return pdf_service_pb2.PDFResponse(
                 processed_pdf=pdf_bytes,
                 coordinates=[
                     pdf_service_pb2.Coordinates(
-                        page_number=i+1,
+                        page_number=coord.get('page_number', i+1) if coord else i+1,
                         x=coord['x'] if coord else -1,
                         y=coord['y'] if coord else -1,
-                        size=coord['size'] if coord else 0
+                        size=coord['size'] if coord else 0,
+                        engine=coord.get('engine', '') if coord else '',
+                        analysis_ms=coord.get('analysis_ms', 0) if coord else 0,
+                        color_mode=coord.get('color_mode', '') if coord else '',
+                        encode_ms=coord.get('encode_ms', 0) if coord else 0,
+                        encoded_bytes=coord.get('encoded_bytes', 0) if coord else 0
                     ) for i, coord in enumerate(coordinates)
                 ]
             )
+        finally:
+            if reserved:
+                self.memory_budget.release(reserved)
+            # Forcer le garbage collection pour libérer la mémoire RAM immédiatement
+            # Particulièrement important après traitement de gros PDFs
+            gc.collect()
+            logging.debug("Garbage collection effectué - Mémoire RAM libérée")
 
-            return response
-
-        except Exception as e:
+    @staticmethod
+    def _cancellation(context):
+        """Jeton d'abandon de la requête, à l'échéance de l'appel gRPC s'il en a une"""
+        remaining = context.time_remaining()
+        return CancellationToken(time.monotonic() + remaining if remaining is not None else None)
+
+    @staticmethod
+    def _fail(context, e):
+        """Code d'erreur gRPC de l'échec d'une requête ; réponse vide"""
+        if isinstance(e, RequestCancelled):
+            # Plus personne n'attend la réponse : pas une erreur de traitement
+            logging.info(f"Traitement interrompu : {e}")
+            context.set_code(grpc.StatusCode.DEADLINE_EXCEEDED if e.expired else grpc.StatusCode.CANCELLED)
+        elif isinstance(e, AdmissionRejected):
+            logging.warning(f"Requête refusée : {e}")
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+        elif isinstance(e, InvalidRequest):
+            logging.warning(f"Requête invalide : {e}")
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+        else:
             logging.error(f"Erreur lors du traitement : {str(e)}")
             context.set_code(grpc.StatusCode.INTERNAL)
-            context.set_details(str(e))
-            return pdf_service_pb2.PDFResponse()
+        context.set_details(str(e))
+        return pdf_service_pb2.PDFResponse()
+
+    @staticmethod
+    def _remove_sources(*sources):
+        """
+        NETTOYAGE SYSTÉMATIQUE : fichiers temporaires des sources volumineuses
+        Cela évite l'accumulation de fichiers dans /tmp
+        """
+        for source in sources:
+            if isinstance(source, Future):
+                # Téléchargement encore en cours : abandonné si possible, sinon nettoyé à son terme
+                source.cancel()
+                source.add_done_callback(
+                    lambda f: f.cancelled() or f.exception() or PDFServicer._remove_sources(f.result()))
+                continue
+            if isinstance(source, str) and os.path.exists(source):
+                try:
+                    os.remove(source)
+                    logging.debug(f"Fichier temporaire supprimé : {source}")
+                except Exception as cleanup_error:
+                    logging.warning(f"Impossible de supprimer {source} : {cleanup_error}")
+
+    def ProcessPDF(self, request, context):
+        #TODO : ADD AUTHORISATION VERIFICATION BEARER TOKEN FROM CONTEXT
+        # Sources en mémoire (bytes) ; chemin de fichier temporaire seulement au-delà du seuil de bascule
+        pdf_source = None
+        stamp_source = None
+        # Fin de l'appel (client déconnecté, délai dépassé) : pages en attente retirées, pages en cours arrêtées
+        cancellation = self._cancellation(context)
+        context.add_callback(lambda: cancellation.cancel("appel gRPC terminé par le client ou son délai"))
+
+        try:
+            # Télécharger le PDF source (contenu transmis exclu du journal)
+            logging.debug(f"Requête reçue : {request.pdf_url or f'{len(request.pdf_data)} octets transmis'} - "
+                          f"index {request.document_index}, pages '{request.pages}'")
+            # Le tampon se télécharge en parallèle du PDF, puis de l'analyse des pages
+            stamp_source = self._downloads.submit(self.processor.download_file, request.stamp_url)
+            pdf_source = self._fetch_pdf(request)
+
+            # Traiter le document
+            return self._stamp(request, pdf_source, stamp_source, cancellation)
+
+        except Exception as e:
+            return self._fail(context, e)
 
         finally:
-            # NETTOYAGE SYSTÉMATIQUE des fichiers temporaires
-            # Cela évite l'accumulation de fichiers dans /tmp
-            temp_files = [pdf_path, stamp_path, processed_pdf_path]
-            for temp_file in temp_files:
-                if temp_file and os.path.exists(temp_file):
-                    try:
-                        os.remove(temp_file)
-                        logging.debug(f"Fichier temporaire supprimé : {temp_file}")
-                    except Exception as cleanup_error:
-                        logging.warning(f"Impossible de supprimer {temp_file} : {cleanup_error}")
+            self._record(pdf_source)
+            self._remove_sources(pdf_source, stamp_source)
+
+    def GetStatus(self, request, context):
+        """Profondeur de file et activité du scheduler de pages, réservations du budget mémoire"""
+        stats = self.processor.page_scheduler.stats()
+        memory = self.memory_budget.stats()
+        concurrency = self.processor.concurrency
+        return pdf_service_pb2.StatusResponse(
+            page_workers=stats["workers"],
+            page_limit=stats["limit"],
+            active_requests=stats["active_requests"],
+            queued_pages=stats["queued_pages"],
+            running_pages=stats["running_pages"],
+            peak_queued_pages=stats["peak_queued_pages"],
+            completed_pages=stats["completed_pages"],
+            memory_budget_bytes=memory["capacity"],
+            memory_reserved_bytes=memory["reserved"],
+            memory_peak_reserved_bytes=memory["peak_reserved"],
+            admission_waiting=memory["waiting"],
+            admitted_requests=memory["admitted"],
+            rejected_requests=memory["rejected"],
+            # Process qui a répondu (un worker parmi d'autres derrière le superviseur)
+            worker_pid=os.getpid(),
+            worker_jobs=self.lifecycle.jobs if self.lifecycle else 0,
+            worker_rss_bytes=current_rss(),
+            cpu_limit=self.processor.cpu_limit,
+            pages_per_second=concurrency.pages_per_second if concurrency else 0.0,
+            cpu_throttled_ratio=concurrency.throttled_ratio if concurrency else 0.0,
+            native_threads=self.processor.native_threads.threads if self.processor.native_threads else 0
+        )
+
+
+class AsyncPDFServicer(PDFServicer):
+    """
+    Service gRPC asyncio (grpc.aio) : les téléchargements sont attendus sur la boucle
+    d'événements (httpx) sans occuper de thread, le traitement CPU des documents part dans
+    un executor borné. Le nombre de requêtes en cours ne dépend plus du nombre de threads :
+    des centaines de requêtes peuvent attendre leurs téléchargements à moindre coût.
+    """
 
-            # Forcer le garbage collection pour libérer la mémoire RAM immédiatement
-            # Particulièrement important après traitement de gros PDFs
-            gc.collect()
-            logging.debug("Garbage collection effectué - Mémoire RAM libérée")
+    def __init__(self, processing_slots, max_connections, worker_share=1.0):
+        """
+        Args:
+            processing_slots (int): Documents traités simultanément (threads de l'executor)
+            max_connections (int): Téléchargements simultanés au plus
+            worker_share (float): Voir PDFServicer
+        """
+        super().__init__(worker_share)
+        self._executor = futures.ThreadPoolExecutor(max_workers=processing_slots, thread_name_prefix="pdf-request")
+        # Mêmes comportements que requests : redirections suivies (Google Drive), pas de délai global
+        self._http = httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=httpx.Timeout(None, connect=30.0, read=120.0),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=20)
+        )
+
+    async def _fetch_pdf_async(self, request):
+        """PDF source de la requête (voir _fetch_pdf), téléchargé sans bloquer la boucle"""
+        if request.pdf_data:
+            return request.pdf_data
+        if request.googleDriveFile and request.googleDriveFile.id and request.googleDriveFile.accessToken:
+            return await self.processor.download_from_gdrive_async(
+                self._http, request.googleDriveFile.id, request.googleDriveFile.accessToken)
+        if request.ooDriveFile and request.ooDriveFile.id and request.ooDriveFile.accessToken:
+            return await self.processor.download_from_oodrive_async(self._http, request.ooDriveFile)
+        if request.pdf_url and request.pdf_url.strip():
+            return await self.processor.download_file_async(self._http, request.pdf_url)
+        raise InvalidRequest("Aucun fichier source fourni")
+
+    async def ProcessPDF(self, request, context):
+        pdf_source = None
+        stamp_source = None
+        work = None
+        cancellation = self._cancellation(context)
+        context.add_done_callback(lambda _: cancellation.cancel("appel gRPC terminé par le client ou son délai"))
 
-def serve():
-    """Démarre le serveur gRPC."""
+        try:
+            logging.debug(f"Requête reçue : {request.pdf_url or f'{len(request.pdf_data)} octets transmis'} - "
+                          f"index {request.document_index}, pages '{request.pages}'")
+            loop = asyncio.get_running_loop()
+            # Le tampon se télécharge sur la boucle en parallèle du PDF, puis de l'analyse des pages :
+            # le traitement ne l'attend qu'au moment de le composer
+            stamp_source = asyncio.run_coroutine_threadsafe(
+                self.processor.download_file_async(self._http, request.stamp_url), loop)
+            pdf_source = await self._fetch_pdf_async(request)
+
+            # Requêtes en attente d'un slot sans thread ; annulées avant démarrage si le client abandonne.
+            # Future de l'executor conservé : l'annulation de l'appel n'arrête pas un traitement démarré
+            work = self._executor.submit(self._stamp, request, pdf_source, stamp_source, cancellation)
+            return await asyncio.wrap_future(work, loop=loop)
+
+        except asyncio.CancelledError:
+            # Appel annulé : le traitement en cours dans l'executor s'arrête à l'étape suivante
+            cancellation.cancel("appel gRPC annulé")
+            raise
+        except Exception as e:
+            return self._fail(context, e)
+
+        finally:
+            self._record(pdf_source)
+            if work is not None and not work.done():
+                # Annulation ou délai dépassé pendant le traitement : _stamp lit encore les sources,
+                # supprimées seulement à la fin de son exécution
+                work.add_done_callback(lambda _: self._remove_sources(pdf_source, stamp_source))
+            else:
+                self._remove_sources(pdf_source, stamp_source)
+
+    async def GetStatus(self, request, context):
+        return super().GetStatus(request, context)
+
+    async def aclose(self):
+        await self._http.aclose()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+GRPC_OPTIONS = [
+    ('grpc.max_send_message_length', 200 * 1024 * 1024),  # 200MB
+    ('grpc.max_receive_message_length', 200 * 1024 * 1024),  # 200MB
+]
+
+
+def _grpc_options(worker_share):
+    if worker_share == 1:
+        return GRPC_OPTIONS
+    # Workers pré-forkés sur le même port : les connexions sont réparties par le noyau (SO_REUSEPORT)
+    # et renouvelées régulièrement pour que les canaux longs (gateway) se répartissent aussi
+    return GRPC_OPTIONS + [('grpc.so_reuseport', 1), ('grpc.max_connection_age_ms', 60 * 1000)]
+
+
+def serve_sync(lifecycle=None, worker_share=1.0):
+    """Démarre le serveur gRPC synchrone : un thread par requête en cours (10 au plus)."""
+    servicer = PDFServicer(worker_share)
+    servicer.lifecycle = lifecycle
+    # Bibliothèques initialisées avant l'ouverture du port
+    servicer.processor.warm_up()
     server = grpc.server(
         futures.ThreadPoolExecutor(max_workers=10),
-        options=[
-            ('grpc.max_send_message_length', 200 * 1024 * 1024),  # 200MB
-            ('grpc.max_receive_message_length', 200 * 1024 * 1024),  # 200MB
-        ]
+        options=_grpc_options(worker_share)
     )
-    pdf_service_pb2_grpc.add_PDFServiceServicer_to_server(
-        PDFServicer(), server)
+    pdf_service_pb2_grpc.add_PDFServiceServicer_to_server(servicer, server)
     server.add_insecure_port('[::]:50051')
     server.start()
-    print("Serveur démarré sur le port 50051")
+    # SIGTERM (docker stop, recyclage) : plus de nouvelles requêtes, celles en cours se terminent
+    grace = float(os.getenv('SHUTDOWN_GRACE_S', '110'))
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop(grace))
+    print(f"Serveur démarré sur le port 50051 (pid {os.getpid()})")
+    if lifecycle is not None:
+        lifecycle.ready()
     server.wait_for_termination()
 
+
+async def serve_aio(lifecycle=None, worker_share=1.0):
+    """Démarre le serveur gRPC asyncio."""
+    # Requêtes acceptées simultanément (téléchargements compris), au-delà : RESOURCE_EXHAUSTED
+    max_concurrent_rpcs = int(os.getenv('MAX_CONCURRENT_RPCS', '500'))
+    # Documents traités simultanément, le reste attend sans occuper de thread
+    processing_slots = int(os.getenv('PROCESSING_SLOTS', '10'))
+    servicer = AsyncPDFServicer(processing_slots, max_connections=max_concurrent_rpcs, worker_share=worker_share)
+    servicer.lifecycle = lifecycle
+    # Bibliothèques initialisées avant l'ouverture du port
+    servicer.processor.warm_up()
+    server = grpc.aio.server(options=_grpc_options(worker_share), maximum_concurrent_rpcs=max_concurrent_rpcs)
+    pdf_service_pb2_grpc.add_PDFServiceServicer_to_server(servicer, server)
+    server.add_insecure_port('[::]:50051')
+    await server.start()
+    # SIGTERM (docker stop, recyclage) : plus de nouvelles requêtes, celles en cours se terminent
+    grace = float(os.getenv('SHUTDOWN_GRACE_S', '110'))
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(server.stop(grace)))
+    print(f"Serveur asyncio démarré sur le port 50051 (pid {os.getpid()}, {max_concurrent_rpcs} requêtes, "
+          f"{processing_slots} traitements simultanés)")
+    if lifecycle is not None:
+        lifecycle.ready()
+    try:
+        await server.wait_for_termination()
+    finally:
+        await servicer.aclose()
+
+
+def _serve_mode(lifecycle=None, worker_share=1.0):
+    if os.getenv('GRPC_SERVER_MODE', 'aio').lower() == 'sync':
+        serve_sync(lifecycle, worker_share)
+    else:
+        asyncio.run(serve_aio(lifecycle, worker_share))
+
+
+def serve():
+    """
+    Démarre le serveur gRPC (GRPC_SERVER_MODE : 'aio' par défaut, ou 'sync').
+
+    Avec WORKER_PROCESSES=N, un superviseur maintient N workers pré-forkés sur le port 50051,
+    recyclés après WORKER_MAX_JOBS requêtes, WORKER_MAX_MB Mo de PDF traités ou un RSS de
+    WORKER_MAX_RSS_MB Mo (0 = pas de limite).
+    """
+    worker_processes = int(os.getenv('WORKER_PROCESSES', '0'))
+    if not worker_processes:
+        _serve_mode()
+        return
+
+    limits = WorkerLimits(max_jobs=int(os.getenv('WORKER_MAX_JOBS', '0')),
+                          max_bytes=int(os.getenv('WORKER_MAX_MB', '0')) * 1024 * 1024,
+                          max_rss=int(os.getenv('WORKER_MAX_RSS_MB', '0')) * 1024 * 1024)
+    supervisor = Supervisor(worker_processes, partial(_serve_mode, worker_share=1 / worker_processes), limits,
+                            drain_timeout=float(os.getenv('SHUTDOWN_GRACE_S', '110')))
+    supervisor.run()
+
+
 if __name__ == '__main__':
     serve()
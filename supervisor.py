@@ -0,0 +1,266 @@
+"""
+Superviseur de workers pré-forkés pour le service gRPC.
+
+Le process parent a déjà importé les bibliothèques lourdes (OpenCV, PyMuPDF, NumPy) : chaque
+worker est forké avec ces imports en mémoire partagée, se chauffe, puis ouvre le port commun
+(SO_REUSEPORT) et se déclare prêt. Un worker est recyclé après un nombre de requêtes, un volume
+traité ou un RSS plafond : son remplaçant est démarré et prêt avant qu'il ne cesse d'accepter
+des requêtes, et il termine celles en cours (SIGTERM). La fragmentation mémoire des gros
+buffers NumPy/PIL disparaît avec le process.
+
+Signaux du superviseur : SIGTERM/SIGINT arrêtent proprement tous les workers, SIGHUP les
+remplace un par un (redémarrage sans interruption).
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from dataclasses import dataclass
+from multiprocessing.connection import wait
+
+
+@dataclass(frozen=True)
+class WorkerLimits:
+    """Seuils de recyclage d'un worker (0 = pas de limite)"""
+    max_jobs: int = 0        # Requêtes traitées
+    max_bytes: int = 0       # Octets de PDF traités
+    max_rss: int = 0         # Mémoire résidente, en octets
+
+
+def current_rss():
+    """Mémoire résidente du process courant, en octets"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class WorkerLifecycle:
+    """
+    Côté worker : compteurs de recyclage et messages au superviseur. Le service appelle
+    ready() une fois le port ouvert, puis record() à la fin de chaque requête.
+    """
+
+    def __init__(self, conn, slot, limits):
+        self.slot = slot
+        self.limits = limits
+        self.jobs = 0
+        self.bytes_processed = 0
+        self._conn = conn
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()  # Requêtes terminées en parallèle dans plusieurs threads
+        self._recycle_requested = False
+
+    def ready(self):
+        self._send(("ready",))
+
+    def record(self, nbytes):
+        """Comptabilise une requête terminée ; demande le recyclage quand un seuil est atteint"""
+        with self._lock:
+            self.jobs += 1
+            self.bytes_processed += nbytes
+            if self._recycle_requested:
+                return
+            rss = current_rss()
+            reason = None
+            if self.limits.max_jobs and self.jobs >= self.limits.max_jobs:
+                reason = f"{self.jobs} requêtes"
+            elif self.limits.max_bytes and self.bytes_processed >= self.limits.max_bytes:
+                reason = f"{self.bytes_processed // (1024 * 1024)} Mo traités"
+            elif self.limits.max_rss and rss >= self.limits.max_rss:
+                reason = f"RSS {rss // (1024 * 1024)} Mo"
+            if reason is None:
+                return
+            self._recycle_requested = True
+        self._send(("recycle", reason))
+
+    def stats(self):
+        with self._lock:
+            return {"pid": os.getpid(), "jobs": self.jobs, "bytes": self.bytes_processed, "rss": current_rss()}
+
+    def _send(self, message):
+        with self._send_lock:
+            try:
+                self._conn.send(message)
+            except OSError:
+                # Superviseur disparu : le worker continue de servir jusqu'à son arrêt
+                logging.warning(f"Worker {self.slot} : superviseur injoignable ({message[0]})")
+
+
+class _Worker:
+    """Côté superviseur : un process worker et sa connexion"""
+
+    def __init__(self, slot, process, conn):
+        self.slot = slot
+        self.process = process
+        self.conn = conn
+        self.started = time.monotonic()
+        self.ready = False
+        self.retiring = False  # SIGTERM envoyé : termine ses requêtes en cours
+        self.retire_started = None
+
+
+class Supervisor:
+    """
+    Maintient worker_count workers pré-forkés, les recycle sans interruption de service et
+    relance ceux qui meurent.
+    """
+
+    def __init__(self, worker_count, run_worker, limits, drain_timeout=120):
+        """
+        Args:
+            worker_count (int): Nombre de workers
+            run_worker (callable): run_worker(lifecycle), exécuté dans chaque worker : sert les
+                requêtes, appelle lifecycle.ready() une fois prêt et rend la main après un SIGTERM
+                quand les requêtes en cours sont terminées
+            limits (WorkerLimits): Seuils de recyclage
+            drain_timeout (float): Délai laissé à un worker arrêté pour terminer ses requêtes
+        """
+        self.worker_count = worker_count
+        self.limits = limits
+        self.drain_timeout = drain_timeout
+        self._run_worker = run_worker
+        # fork : les workers héritent des imports du parent (aucun thread ni socket ouvert à ce stade)
+        self._context = multiprocessing.get_context('fork')
+        self._slots = {}        # slot -> worker en service
+        self._replacing = {}    # slot -> remplaçant en cours de démarrage
+        self._retiring = []     # Workers remplacés, en fin de requêtes
+        self._stopping = False
+        self._rolling = []      # Slots à remplacer (SIGHUP)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGHUP, self._request_rolling_restart)
+        logging.info(f"Superviseur {os.getpid()} : {self.worker_count} workers, recyclage {self.limits}")
+        for slot in range(self.worker_count):
+            self._slots[slot] = self._spawn(slot)
+
+        while not self._stopping:
+            self._step(timeout=1.0)
+        self._shutdown()
+
+    def _spawn(self, slot):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=self._worker_main, args=(child_conn, slot),
+                                        name=f"pdf-worker-{slot}")
+        process.start()
+        child_conn.close()
+        logging.info(f"Worker {slot} démarré (pid {process.pid})")
+        return _Worker(slot, process, parent_conn)
+
+    def _worker_main(self, conn, slot):
+        # Signaux du superviseur hérités du fork : le worker gère SIGTERM lui-même, Ctrl+C passe par le superviseur
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self._run_worker(WorkerLifecycle(conn, slot, self.limits))
+
+    def _workers(self):
+        return list(self._slots.values()) + list(self._replacing.values()) + self._retiring
+
+    def _step(self, timeout):
+        workers = self._workers()
+        events = {}
+        for worker in workers:
+            events[worker.conn] = worker
+            events[worker.process.sentinel] = worker
+        try:
+            ready = wait(list(events), timeout=timeout)
+        except InterruptedError:
+            ready = []
+        for obj in ready:
+            worker = events[obj]
+            if obj is worker.conn:
+                self._receive(worker)
+            elif not worker.process.is_alive():
+                self._on_exit(worker)
+        self._advance_rolling_restart()
+
+    def _receive(self, worker):
+        try:
+            message = worker.conn.recv()
+        except (EOFError, OSError):
+            return
+        if message[0] == "ready":
+            worker.ready = True
+            logging.info(f"Worker {worker.slot} prêt (pid {worker.process.pid}, "
+                         f"{time.monotonic() - worker.started:.1f} s)")
+            if self._replacing.get(worker.slot) is worker:
+                # Remplaçant en service : l'ancien worker n'accepte plus de requêtes et termine les siennes
+                del self._replacing[worker.slot]
+                self._retire(self._slots[worker.slot])
+                self._slots[worker.slot] = worker
+        elif message[0] == "recycle":
+            self._replace(worker.slot, message[1])
+
+    def _replace(self, slot, reason):
+        if self._stopping or slot in self._replacing or self._slots[slot].retiring:
+            return
+        logging.info(f"Recyclage du worker {slot} (pid {self._slots[slot].process.pid}) : {reason}")
+        self._replacing[slot] = self._spawn(slot)
+
+    def _retire(self, worker):
+        worker.retiring = True
+        worker.retire_started = time.monotonic()
+        self._retiring.append(worker)
+        if worker.process.is_alive():
+            os.kill(worker.process.pid, signal.SIGTERM)
+
+    def _on_exit(self, worker):
+        worker.process.join()
+        worker.conn.close()
+        if worker in self._retiring:
+            self._retiring.remove(worker)
+            logging.info(f"Worker {worker.slot} (pid {worker.process.pid}) arrêté après ses requêtes en cours")
+            return
+        if self._replacing.get(worker.slot) is worker:
+            del self._replacing[worker.slot]
+        elif self._slots.get(worker.slot) is worker:
+            del self._slots[worker.slot]
+        else:
+            return
+        logging.warning(f"Worker {worker.slot} (pid {worker.process.pid}) terminé de façon inattendue "
+                        f"(code {worker.process.exitcode})")
+        if self._stopping:
+            return
+        # Worker mort au démarrage : pas de relance en boucle serrée
+        if time.monotonic() - worker.started < 5:
+            time.sleep(1)
+        if worker.slot not in self._slots:
+            self._slots[worker.slot] = self._spawn(worker.slot)
+
+    def _request_stop(self, signum, frame):
+        self._stopping = True
+
+    def _request_rolling_restart(self, signum, frame):
+        self._rolling = sorted(self._slots)
+
+    def _advance_rolling_restart(self):
+        # Un slot à la fois : la capacité de service ne baisse jamais
+        if self._rolling and not self._replacing:
+            self._replace(self._rolling.pop(0), "redémarrage demandé (SIGHUP)")
+        # Workers remplacés qui dépassent le délai de fin de requêtes
+        for worker in self._retiring:
+            if worker.process.is_alive() and time.monotonic() - worker.retire_started > self.drain_timeout + 10:
+                logging.warning(f"Worker {worker.slot} (pid {worker.process.pid}) ne s'arrête pas : SIGKILL")
+                worker.process.kill()
+
+    def _shutdown(self):
+        logging.info("Arrêt des workers (requêtes en cours terminées)")
+        for worker in list(self._slots.values()) + list(self._replacing.values()):
+            if not worker.retiring:
+                self._retire(worker)
+        self._slots.clear()
+        self._replacing.clear()
+        deadline = time.monotonic() + self.drain_timeout + 10
+        for worker in self._retiring:
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+        logging.info("Superviseur arrêté")
@@ -0,0 +1,65 @@
+"""
+Mise à jour incrémentale (pdf_writer.write_incremental_update) d'une page dont les
+ressources sont héritées d'un noeud /Pages.
+"""
+import io
+import os
+import sys
+
+import fitz
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pdf_writer import snapshot_page_objects, write_incremental_update  # noqa: E402
+
+
+def inherited_resources_pdf():
+    """PDF de deux pages dont les ressources sont portées par le noeud /Pages racine"""
+    doc = fitz.open()
+    for i in range(2):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Page {i + 1}", fontsize=12)
+    pages_xref = int(doc.xref_get_key(doc.pdf_catalog(), "Pages")[1].split()[0])
+    doc.xref_set_key(pages_xref, "Resources", doc.xref_get_key(doc[0].xref, "Resources")[1])
+    for page in doc:
+        doc.xref_set_key(page.xref, "Resources", "null")
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def stamp_pdf():
+    """Tampon : carré rouge plein"""
+    doc = fitz.open()
+    page = doc.new_page(width=100, height=100)
+    page.draw_rect(page.rect, color=(1, 0, 0), fill=(1, 0, 0))
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def test_stamp_resolves_with_inherited_resources():
+    source = inherited_resources_pdf()
+    doc = fitz.open(stream=source, filetype="pdf")
+    assert doc.xref_get_key(doc[0].xref, "Resources")[0] == "null"
+
+    original_xref_length = doc.xref_length()
+    snapshot = snapshot_page_objects(doc, doc[0])
+    stamp = fitz.open(stream=stamp_pdf(), filetype="pdf")
+    doc[0].show_pdf_page(fitz.Rect(400, 50, 500, 150), stamp, 0)
+
+    output = io.BytesIO()
+    write_incremental_update(doc, source, output, snapshot, original_xref_length)
+    doc.close()
+
+    result = fitz.open(stream=output.getvalue(), filetype="pdf")
+    fitz.TOOLS.mupdf_warnings(reset=True)
+    page = result[0]
+    assert page.get_xobjects(), "XObject du tampon absent des ressources de la page"
+    pix = page.get_pixmap(clip=fitz.Rect(410, 60, 490, 140))
+    assert "cannot find" not in fitz.TOOLS.mupdf_warnings()
+    pixels = np.frombuffer(pix.samples, np.uint8).reshape(pix.h, pix.w, pix.n)
+    red = (pixels[..., 0] > 200) & (pixels[..., 1] < 60) & (pixels[..., 2] < 60)
+    assert red.mean() > 0.9
+    # Le texte des deux pages, qui partagent les ressources héritées, reste lisible
+    assert "Page 1" in page.get_text() and "Page 2" in result[1].get_text()